@@ -0,0 +1,4 @@
+from src.modules.BatchExporter import main
+
+if __name__ == '__main__':
+    main()
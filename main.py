@@ -1,4 +1,6 @@
+from multiprocessing import freeze_support
 from src.SECM import run_main
 
 if __name__ == '__main__':
-    run_main()
\ No newline at end of file
+    freeze_support()  # Worker processes (i.e. for exporting) in the .exe
+    run_main()
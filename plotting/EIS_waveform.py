@@ -1,4 +1,3 @@
-import struct
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -9,24 +8,10 @@ colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
 
 
-struct_fmt = 'f' #float
-struct_len = struct.calcsize(struct_fmt)
-struct_unpack = struct.Struct(struct_fmt).unpack_from
-
-
 tplfile = 'C:/Users/BRoehrich/Desktop/_auto_eis-10kHz_1.tpl'
 
-buff = []
-with open(tplfile, 'rb') as f:
-    while True:
-        data = f.read(struct_len)
-        if not data: 
-            break
-        s = struct_unpack(data)
-        buff.append(*s)
-
-
-arr = np.array(buff)
+# .tpl is little-endian float32, see src/utils/tpl_io.py
+arr = np.fromfile(tplfile, dtype='<f4').astype(float)
 arr *= 50/(max(arr) - min(arr))
 
 
@@ -16,6 +16,7 @@ from .modules.ADC import ADC
 from .modules.Piezo import Piezo
 from .modules.FeedbackController import FeedbackController, make_datapoint_from_file, load_echem_from_file
 from .modules.Plotter import Plotter, ExporterGenerator
+from .modules.CampaignIndex import CampaignIndex
 from .modules.DataStorage import Experiment, EISDataPoint, load_from_file
 from .modules.Picomotor import PicoMotor
 from .modules.ImageCorrelator import ImageCorrelator
@@ -137,6 +138,7 @@ class MasterModule(Logger):
     def set_expt(self, expt, name=None):
         self.check_save()
         self.expt = expt
+        self.GUI.apply_data_settings(expt)
         title = name if name else 'SECM Controller'
         self.GUI.root.title(title)
             
@@ -290,6 +292,17 @@ class GUI(Logger):
         
         menu_settings.add_command(label='Save settings...', command=self.save_settings)
         menu_settings.add_command(label='Load settings...', command=self.load_settings)
+        menu_settings.add_separator()
+        self.save_v2 = StringVar(value='0')
+        menu_settings.add_checkbutton(label='Save indexed .secmdata files (v2)',
+                                      variable=self.save_v2,
+                                      onvalue='1', offvalue='0',
+                                      command=self.apply_data_settings)
+        self.compact_CVs = StringVar(value='0')
+        menu_settings.add_checkbutton(label='Store CVs as float32', 
+                                      variable=self.compact_CVs,
+                                      onvalue='1', offvalue='0',
+                                      command=self.apply_data_settings)
         
         menu_analysis.add_command(label='Set analysis function...', command=self.set_analysis_func)
         
@@ -381,6 +394,7 @@ class GUI(Logger):
             'Current @ ... (t)',
             'Z height',
             'Avg. current',
+            '|Z| @ ... (Hz)',
             'Analysis func.'
             ]
         self.heatmapselection = StringVar(topfigframe)
@@ -686,6 +700,8 @@ class GUI(Logger):
             'Heatmap_maxval': self.heatmap_cmap_maxval,         # StringVar
             'fig2selection': self.fig2selection,                # StringVar
             'fig2EISselection': self.EIS_view_selection,        # StringVar
+            'save_v2': self.save_v2,                            # StringVar
+            'compact_CVs': self.compact_CVs,                    # StringVar
             'params': {
                 'CV': self.params['CV'],            # dict
                 'amp': self.params['amp'],          # dict
@@ -771,12 +787,21 @@ class GUI(Logger):
     def newFile(self):
         pass
     
+    # apply data storage options from the Settings menu
+    def apply_data_settings(self, expt=None):
+        if expt is None:
+            expt = self.master.expt
+        expt.file_version = 2 if self.save_v2.get() == '1' else 1
+        compact = self.compact_CVs.get() == '1'
+        expt.set_compact('float32' if compact else None)
+    
     # load previous data
     def openFile(self):
         f = filedialog.askopenfilename(initialdir='D:\SECM\Data')
         if not f.endswith('.secmdata'):
             return
-        expt = load_from_file(f)
+        # Traces are read when needed, so large files show up right away
+        expt = load_from_file(f, lazy=True)
         self.master.set_expt(expt, name=f.split('/')[-1])
         self.master.Plotter.load_from_expt(expt)
         if hasattr(expt, 'settings') and expt.settings is not None:
@@ -921,6 +946,7 @@ class GUI(Logger):
             return settings_dict
         
         set_all(self.__settings, loaded)
+        self.apply_data_settings()
         
         return
     
@@ -938,7 +964,19 @@ class GUI(Logger):
         
         
     def export_heatmap_data(self):
-        print('Heatmap data export not implemented')
+        if not self.master.expt:
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.csv',
+                    filetypes=[('CSV', '*.csv'), ('NumPy', '*.npz'),
+                               ('Parquet', '*.parquet')])
+        if not path:
+            return
+        # Add the heatmap as displayed, labeled by its display option
+        Heatmap = self.master.Plotter.Heatmap
+        option, value = Heatmap.get_display_option()
+        name = option if value in (None, '') else f'{option} {value}'
+        self.master.expt.export_pixel_table(path, {name: Heatmap.data})
+        self.log(f'Saved to {path}')
     
     def export_echem_fig_data(self):
         path = filedialog.asksaveasfilename(defaultextension='.csv')
@@ -1221,6 +1259,7 @@ class GUI(Logger):
             
             # Run hopping mode scan
             success = self._run_hopping(this_fname)
+            self.index_campaign(this_fname)
             
             if not success:
                 self.log('Multi hopping aborted due to incomplete scan')
@@ -1242,6 +1281,16 @@ class GUI(Logger):
         time.sleep(0.5 + abs(n_steps)/1000)
         return
     
+    def index_campaign(self, fname):
+        # Add a just-saved scan to the campaign index in its folder
+        try:
+            index = CampaignIndex(os.path.dirname(fname))
+            index.add_file(fname, expt=self.master.expt)
+            index.close()
+        except Exception as e:
+            print(f'Error updating campaign index: {e}')
+    
+    
     def run_hopping_image(self): 
         '''
         Run hopping mode scan patterned on user-input binary image
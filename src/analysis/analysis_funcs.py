@@ -1,8 +1,9 @@
-from tkinter import *
-from tkinter.ttk import *
 import matplotlib
 import numpy as np
 from scipy.signal import find_peaks, savgol_filter
+from ..modules.DataStorage import first_crossing, EISDataPoint
+from .circuit_fitting import get_models, fit_datapoints, model_Z
+from .drt import DEFAULT_LAMBDA, drt_datapoints, drt_Z
 
 
 '''
@@ -36,6 +37,10 @@ def get_functions():
                                     'Integral of the reverse redox peak.\nInput: none'),
         'Peak integral (ratio)': (peak_integration_ratio,
                                   'Ratio of the forward to reverse charges.\nInput: none'),
+        'Circuit fit': (circuit_fit_analysis,
+                        f'Fitted equivalent circuit parameter of EIS spectra.\nInput format: "model,param" or "param" (Randles model)\nModels: {", ".join(get_models())}. "error" = relative RMS fit error'),
+        'DRT': (DRT_analysis,
+                f'Largest peak of the distribution of relaxation times of EIS spectra.\nInput format: "x" or "x,lambda" (default lambda = {DEFAULT_LAMBDA})\nx = tau (peak time constant), height (peak gamma), R_inf (Re Z at highest freq), or R_pol (Re Z at lowest freq - R_inf).\nR_inf and R_pol are read from the spectrum, not the DRT. R_pol is too low if Re Z is still rising at the lowest freq (i.e. diffusion)'),
         }
 
 
@@ -150,71 +155,95 @@ def find_peak_bounds(t, V, I, fpeak, bpeak):
     the point on the other side down, drawing a slanted line, until it reaches
     the local minimum and starts tracing back, causing the line to intersect the data
     inside of the bound. Use that last point as the other bound.
+    
+    The flat line search reduces to finding the minimum closest to the peak on
+    each side, and the slanted line search to a walk along the lower convex
+    hull (see chord_visibility()), so each peak is bounded in O(n).
     '''
     half = len(t)//2
         
     ft, fV, fI = t[:half], V[:half], I[:half]
     bt, bV, bI = t[half:], V[half:], I[half:]
     
-    # Same peak choosing parameters as in find_redox_peaks()
-    min_peak_width = max(4, int(len(t)//100)) # Don't choose spiky peaks
-    prominence = 5e-12   
-    
     def find_bounds(I, peak, add = 0):
         if I[peak] < 0:
             I = -I + min(-I)
-        lbound = rbound = peak
-        found = None
-        # Forward peak
-        for i in range(1, min(len(I) - peak, peak) ):
-            lbound = peak - i
-            rbound = peak + i
-            # Check left side
-            if all( I[:peak] - I[lbound] >= 0):
-                found = 'left'
-                break
-            # Check right side
-            if all( I[peak:] - I[rbound] >= 0):
-                found = 'right'
-                break
+        n = len(I)
+        
+        # Outward steps checked by the flat line: i = 1 ... limit-1
+        limit = min(n - peak, peak)
+        
+        # Steps needed for the flat line to reach the lowest point on
+        # each side. Left side is checked first on a tie.
+        left_dist = right_dist = n
+        if peak > 0:
+            left_dist = np.argmin(I[:peak][::-1]) + 1
+        right_min = np.flatnonzero(I[peak+1:] == np.min(I[peak:]))
+        if len(right_min) > 0:
+            right_dist = right_min[0] + 1
+        
+        if (left_dist < limit) and (left_dist <= right_dist):
+            found, i = 'left', left_dist
+        elif right_dist < limit:
+            found, i = 'right', right_dist
+        else:
+            found, i = None, max(limit - 1, 0)
+        lbound = peak - i
+        rbound = peak + i
         
         if found == 'right':
-            # rbound was fixed, draw lines to set lbound
-            x = np.arange(len(I))
-            x2, y2 = rbound, I[rbound]
-            for lbound in reversed(range(0, peak-i)):
-                x1, y1 = lbound, I[lbound]
-
-                m = (y2 - y1) / (x2 - x1)
-                b = y1 - m*x1
-                
-                subtracted = I - (m*x + b)
-                
-                if min(subtracted[lbound:rbound]) < 0:
-                    lbound += 1
-                    break
+            # rbound was fixed, step lbound left from peak-i-1 until the
+            # line to rbound cuts through the data
+            visible = chord_visibility(I, rbound, 0)[::-1] # indexed by lbound
+            failed  = np.flatnonzero(~visible[:peak-i])
+            lbound  = failed[-1] + 1 if len(failed) > 0 else 0
                 
         elif found == 'left':
-            # lbound was fixed, draw lines to set rbound
-            x = np.arange(len(I))
-            x2, y2 = lbound, I[lbound]
-            for rbound in reversed(range(peak+i, len(I))):
-                x1, y1 = rbound, I[rbound]
-
-                m = (y2 - y1) / (x2 - x1)
-                b = y1 - m*x1
-                
-                subtracted = I - (m*x + b)
-                
-                if min(subtracted[lbound:rbound]) < 0:
-                    rbound -= 1
-                    break
-        return lbound+add, rbound+add
+            # lbound was fixed, step rbound in from the end of the scan
+            # until the line to lbound cuts through the data
+            visible = chord_visibility(I, lbound, n-1) # indexed by rbound-lbound-1
+            failed  = np.flatnonzero(~visible[2*i-1:])
+            rbound  = failed[-1] + peak + i - 1 if len(failed) > 0 else peak + i
+            
+        return int(lbound)+add, int(rbound)+add
     
     fbounds = find_bounds(fI, fpeak)
     rbounds = find_bounds(bI, bpeak-half, add = half)
     
     return fbounds, rbounds
+
+
+def chord_visibility(I, anchor, stop):
+    '''
+    Walk from index anchor to index stop (inclusive), one point at a time.
+    
+    returns: bool array, one entry per point walked over (excluding anchor).
+             True if the straight line from that point to the anchor lies on
+             or below every point in between.
+    
+    Keeps the lower convex hull of the points walked so far on a stack. The
+    line from a new point to the anchor is clear of the data exactly when
+    every other hull vertex gets popped. Each point is pushed and popped at
+    most once, so the walk is O(n).
+    '''
+    y    = np.asarray(I, dtype=float).tolist()
+    step = 1 if stop >= anchor else -1
+    idxs = range(anchor + step, stop + step, step)
+    
+    visible = np.zeros(len(idxs), dtype=bool)
+    hull = [anchor]
+    for k, p in enumerate(idxs):
+        yp = y[p]
+        while len(hull) >= 2:
+            a, b = hull[-2], hull[-1]
+            # Pop b if it is on or above the line from p to a
+            cross = (y[b] - yp)*(a - p) - (y[a] - yp)*(b - p)
+            if cross*step > 0:
+                break
+            hull.pop()
+        visible[k] = (len(hull) == 1)
+        hull.append(p)
+    return visible
     
 
 def integrate(t, I, start_idx, end_idx):
@@ -235,18 +264,18 @@ def integrate(t, I, start_idx, end_idx):
 
 def current_threshold(V, I, threshold):
     '''
-    Returns first voltage v such that I(v) reaches or passes the threshold
+    Returns first voltage v such that I(v) reaches or passes the threshold,
+    interpolated between samples. Returns the last voltage if it is never
+    reached.
+    
+    V, I can be 2D arrays of shape (n_traces, n_samples) to evaluate many
+    CVs (or CV cycles) at once.
     '''
-    negative = False
-    if threshold < V[0]:
-        negative = True
-    for i, v in zip(I, V):
-        if negative:
-            if i <= threshold:
-                break
-        elif not negative:
-            if i >= threshold:
-                break
+    V = np.asarray(V, dtype=float)
+    negative = threshold < V[..., 0]
+    v, _ = first_crossing(V, I, threshold, negative)
+    if v.ndim == 0:
+        return float(v)
     return v
 
 
@@ -254,14 +283,281 @@ def count_CV_cycles(V):
     '''
     Returns number of cycles present in voltage data
     '''
-    # number of differently-sloped segments
-    # TODO: might fail if recording at a constant voltage due to noise
-    # might try: (np.diff(np.sign(np.diff(V)[abs(np.diff(V)) >= 0.001])) != 0).sum()
-    # removes segments of V where the slope is very close to 0
-    n_scans = (np.diff(np.sign(np.diff(V))) != 0).sum() 
-    return int(np.ceil(n_scans/2))   
+    return len(get_cycle_offsets(get_sweep_segments(V))) - 1
+
+
+def get_sweep_segments(V):
+    '''
+    Returns array of indices where each linear sweep starts. Last element
+    is len(V), so segment k is V[segs[k]:segs[k+1]]
+    
+    Turning points are local extrema of V which stand out from the rest of
+    the trace by at least 10% of the full potential range (or 5 mV), so
+    noise and staircase steps don't split a sweep.
+    '''
+    V = np.asarray(V, dtype=float)
+    if len(V) < 3:
+        return np.array([0, len(V)])
+    prominence = max(0.1*np.ptp(V), 5e-3)
+    tops, _    = find_peaks(V, prominence=prominence)
+    bottoms, _ = find_peaks(-V, prominence=prominence)
+    turns = np.sort(np.concatenate((tops, bottoms)))
+    return np.concatenate(([0], turns, [len(V)])).astype(int)
+
+
+def get_sweep_segments_from_params(t, V, CV_params):
+    '''
+    Same as get_sweep_segments(), but uses the vertex potentials and ramp
+    times the CV was recorded with (see HekaIO.generate_CV_params()).
     
+    CV_params: parameter values indexed 0-7 as in generate_CV_params(),
+               i.e. its dict or a list in the same order
     
+    Returns (segments, sweeps_per_cycle), or (None, 0) if the vertices
+    can't be found in the data. segments starts after the quiet time.
+    '''
+    E0    = CV_params[0]
+    ramps = [(CV_params[i], CV_params[i+1]) for i in (2, 4, 6)
+             if CV_params[i+1] > 0]
+    if len(ramps) == 0:
+        return None, 0
+    
+    t = np.asarray(t, dtype=float)
+    V = np.asarray(V, dtype=float)
+    dt = np.median(np.diff(t)) if len(t) > 1 else 0
+    
+    # Sweep direction of each ramp, starting from the holding potential
+    potentials = [E0] + [E for E, _ in ramps]
+    directions = [1 if b >= a else -1 for a, b in zip(potentials, potentials[1:])]
+    
+    # Each cycle holds at E0 for the quiet time, then ramps through the 
+    # vertices in order. Search for each vertex starting half a ramp time 
+    # after the last one (plus the quiet time, for the first ramp)
+    n_quiet = int(CV_params[1]/dt) if dt > 0 else 0
+    first = int(np.searchsorted(t, t[0] + CV_params[1])) if len(t) else 0
+    turns = []
+    idx   = first
+    while idx < len(V):
+        start_idx = idx
+        prev = E0
+        for k, (E, ramp_time) in enumerate(ramps):
+            tol   = max(0.02*abs(E - prev), 1e-3)
+            start = idx + (int(0.5*ramp_time/dt) if dt > 0 else 1)
+            if k == 0 and turns:
+                start += n_quiet
+            near  = np.abs(V[start:] - E) <= tol
+            if not near.any():
+                break
+            j = start + np.argmax(near)
+            near = near[j - start:]
+            width = np.argmax(~near) if not near.all() else len(near)
+            if k + 1 < len(ramps) and directions[k+1] != directions[k]:
+                # Turning point: most extreme V while near the vertex
+                idx = j + np.argmax(directions[k]*V[j:j+width])
+            else:
+                # Sweep continues or holds: first point to reach the vertex
+                reached = directions[k]*(V[j:j+width] - E) >= -tol/4
+                idx = j + (np.argmax(reached) if reached.any() else 0)
+            turns.append(idx)
+            prev = E
+        if idx == start_idx:
+            break
+        if len(turns) % len(ramps) != 0:
+            break   # Stopped partway through a cycle
+    
+    if len(turns) == 0:
+        return None, 0
+    # Drop the end of the last sweep if the recording stops right after it
+    min_len = int(0.5*min(rt for _, rt in ramps)/dt) if dt > 0 else 1
+    turns = [i for i in turns if first < i < len(V) - max(min_len, 1)]
+    return np.array([first, *turns, len(V)], dtype=int), len(ramps)
+
+
+def get_cycle_offsets(segments, sweeps_per_cycle=2):
+    '''
+    Returns array of indices where each cycle starts. Last element is
+    the total length, so cycle k is V[cycles[k]:cycles[k+1]]
+    
+    Trailing sweeps which don't make up a full cycle are added to the
+    last cycle.
+    '''
+    n_segs = len(segments) - 1
+    starts = segments[0 : max(n_segs - sweeps_per_cycle + 1, 1) : sweeps_per_cycle]
+    return np.concatenate((starts, segments[-1:])).astype(int)
+
+
+def get_CV_segments(CVDataPoint):
+    '''
+    Returns (segments, cycles) offsets for a CVDataPoint. Uses the CV's
+    recorded parameters if available, falling back to turning point 
+    detection.
+    '''
+    t, V, _ = CVDataPoint.data
+    segments, sweeps_per_cycle = None, 2
+    CV_params = getattr(CVDataPoint, 'CV_params', None)
+    if CV_params:
+        try:
+            segments, sweeps_per_cycle = get_sweep_segments_from_params(
+                                                          t, V, CV_params)
+        except Exception as e:
+            print(f'Error segmenting CV from parameters: {e}')
+            segments = None
+    if segments is None:
+        segments, sweeps_per_cycle = get_sweep_segments(V), 2
+    return segments, get_cycle_offsets(segments, sweeps_per_cycle)
+
+
+def get_lower_vertices(V, segments):
+    '''
+    Returns indices of segment boundaries where V turns from a negative-going
+    to a positive-going sweep.
+    '''
+    V = np.asarray(V, dtype=float)
+    bounds = segments[1:-1]
+    if len(bounds) == 0:
+        return np.array([], dtype=int)
+    before = V[segments[:-2]]
+    after  = V[segments[2:] - 1]
+    return bounds[(V[bounds] < before) & (V[bounds] < after)]
+
+
+def str_to_float(s):
+    '''
+    Convert string with SI prefix to float, i.e. '-100p' -> -1e-10
+    '''
+    d = {'p':'e-12',
+         'n':'e-9',
+         'u':'e-6',
+         'm':'e-3'}
+    for key in d.keys():
+        s = s.replace(key, d[key])
+    return float(s)
+
+
+
+
+#############################################
+########                             ########
+########     FEATURE EXTRACTION      ########
+########                             ########
+#############################################
+
+'''
+CV features are computed once per CVDataPoint and stored as a dictionary
+in CVDataPoint.features. All CV analysis functions read from it.
+
+    'I_smooth'   : savgol filtered current
+    'n_cycles'   : number of CV cycles
+    'segments'   : indices where each sweep starts (see get_CV_segments)
+    'cycles'     : indices where each cycle starts (see get_cycle_offsets)
+    'vertices'   : indices of the negative potential limit in each cycle
+    'peaks'      : (fpeak, bpeak) from find_redox_peaks, or None
+    'bounds'     : (fbounds, rbounds) from find_peak_bounds, or None
+    'integrals'  : (forward, reverse, ratio) baseline-subtracted peak areas
+    'E0'         : midpoint potential of the two peaks
+    'thresholds' : {threshold current: first voltage reaching it}
+
+Features are derived data, they are not saved with the Experiment. They
+are recomputed if the CV's data changes (see DataPoint.get_features).
+'''
+
+def extract_CV_features(CVDataPoints, thresholds=()):
+    '''
+    Compute the feature table for each CVDataPoint in the list which
+    doesn't have one yet. Traces with the same length are smoothed together
+    as one 2D array.
+
+    thresholds: list of float currents to also find threshold voltages for
+    '''
+    CVDataPoints = [pt for pt in CVDataPoints
+                    if 'CVDataPoint' in pt.__repr__()]
+
+    by_length = {}
+    for pt in CVDataPoints:
+        if 'I_smooth' not in pt.get_features():
+            by_length.setdefault(len(pt.data[2]), []).append(pt)
+
+    for length, pts in by_length.items():
+        I = np.array([pt.data[2] for pt in pts], dtype=float)
+        if length > 15:
+            I = savgol_filter(I, 15, 1, axis=-1)  # Do a little filtering
+        for pt, I_smooth in zip(pts, I):
+            pt.get_features().update(_CV_features(pt, I_smooth))
+
+    for thresh in thresholds:
+        by_length = {}
+        for pt in CVDataPoints:
+            if thresh not in pt.features['thresholds']:
+                by_length.setdefault(len(pt.data[1]), []).append(pt)
+        for length, pts in by_length.items():
+            V = np.array([pt.data[1] for pt in pts], dtype=float)
+            I = np.array([pt.features['I_smooth'] for pt in pts])
+            for pt, v in zip(pts, current_threshold(V, I, thresh)):
+                pt.features['thresholds'][thresh] = float(v)
+    return CVDataPoints
+
+
+def get_CV_features(CVDataPoint, thresholds=()):
+    '''
+    Returns the feature table of a single CVDataPoint
+    '''
+    extract_CV_features([CVDataPoint], thresholds)
+    return CVDataPoint.features
+
+
+def prepare_CV_features(DataPoints, *args):
+    '''
+    Experiment.do_analysis() calls func.prepare(DataPoints, *args) before
+    running func on each point, so features are extracted in one batch
+    '''
+    extract_CV_features(DataPoints)
+
+
+def _prepare_threshold_features(DataPoints, thresh):
+    try:
+        float_thresh = str_to_float(thresh.split(',')[0])
+    except:
+        float_thresh = None
+    if float_thresh is None:
+        return extract_CV_features(DataPoints)
+    extract_CV_features(DataPoints, thresholds=[float_thresh])
+
+
+def _CV_features(CVDataPoint, I):
+    t, V, _ = CVDataPoint.data
+    t = np.asarray(t)
+    V = np.asarray(V)
+
+    segments, cycles = get_CV_segments(CVDataPoint)
+
+    features = {'I_smooth'  : I,
+                'n_cycles'  : len(cycles) - 1,
+                'segments'  : segments,
+                'cycles'    : cycles,
+                'vertices'  : get_lower_vertices(V, segments),
+                'peaks'     : None,
+                'bounds'    : None,
+                'integrals' : (0.0, 0.0, 0.0),
+                'E0'        : 0.0,
+                'thresholds': {},
+                }
+
+    peaks = find_redox_peaks(t, V, I)
+    if not peaks:
+        return features
+    fpeak, bpeak = peaks
+    fbounds, rbounds = find_peak_bounds(t, V, I, fpeak, bpeak)
+    forward_integral = integrate(t, I, *fbounds)
+    reverse_integral = integrate(t, I, *rbounds)
+
+    features['peaks']     = (fpeak, bpeak)
+    features['bounds']    = (fbounds, rbounds)
+    features['integrals'] = (forward_integral, reverse_integral,
+                             abs(forward_integral/reverse_integral))
+    features['E0']        = (V[fpeak] + V[bpeak])/2
+    return features
+
+
 
 
 #############################################
@@ -293,13 +589,10 @@ def CV_decay_analysis(CVDataPoint, n):
     
         
     t, V, I = CVDataPoint.data
-    dt = np.mean(np.diff(t[:1000]))
-    t = np.arange(t[0], dt*len(t), dt)
     
     try:
-        arr = -(np.abs(V - min(V)) - max(V))
-        peaks, props = find_peaks(arr, height=0.01)
-        peak_currs = I[peaks]
+        features = get_CV_features(CVDataPoint)
+        peak_currs = np.array(I, dtype=float)[features['vertices']]
         peak_currs /= peak_currs[0]
         if true_n >= len(peak_currs):
             true_n = -1
@@ -326,21 +619,11 @@ def threshold_current_analysis(CVDataPoint, thresh):
         return CVDataPoint
     
     
-    d = {'p':'e-12',
-         'n':'e-9',
-         'u':'e-6',
-         'm':'e-3'}
-    
-    str_thresh = thresh  # Make local copy to not overwrite analysis dict args
-    for key in d.keys():
-        str_thresh = str_thresh.replace(key, d[key])
-    
-    float_thresh = float(str_thresh)
-    
-    t, V, I = CVDataPoint.data
-    I = savgol_filter(I, 15, 1)
+    float_thresh = str_to_float(thresh)
     
-    v = current_threshold(V, I, float_thresh)
+    features = get_CV_features(CVDataPoint, thresholds=[float_thresh])
+    I = features['I_smooth']
+    v = features['thresholds'][float_thresh]
     
     ln = matplotlib.lines.Line2D( [v, v],
                                   [min(I), float_thresh], color='black')
@@ -367,17 +650,7 @@ def threshold_current_decay_analysis(CVDataPoint, thresh_and_n):
     
     try:
         thresh, n = thresh_and_n.split(',')
-
-        d = {'p':'e-12',
-             'n':'e-9',
-             'u':'e-6',
-             'm':'e-3'}
-        
-        str_thresh = thresh  # Make local copy to not overwrite analysis dict args
-        for key in d.keys():
-            str_thresh = str_thresh.replace(key, d[key])
-        
-        float_thresh = float(str_thresh)
+        float_thresh = str_to_float(thresh)
         int_n = int(n)
     except:
         print(f'Invalid input for analysis function: {thresh_and_n}')
@@ -394,22 +667,24 @@ def threshold_current_decay_analysis(CVDataPoint, thresh_and_n):
     
     
     # Find how many cycles
-    n_cycles = count_CV_cycles(V)
-    if n_cycles < int_n:
+    features = get_CV_features(CVDataPoint)
+    n_cycles = features['n_cycles']
+    if n_cycles <= int_n:
         print(f'Cannot evaluate after {int_n} cycles, only detected {n_cycles} in the CV')
         CVDataPoint.analysis[(threshold_current_decay_analysis, thresh_and_n)] = 0.0
         return CVDataPoint
     
-    # number of points per cycle
-    n_pts = len(t)//n_cycles
+    cycles = features['cycles']
+    first  = slice(cycles[0], cycles[1])
+    nth    = slice(cycles[int_n], cycles[int_n + 1])
+    V = np.asarray(V, dtype=float)
+    I = np.asarray(I, dtype=float)
     
     # do threshold at 1st cycle
-    cycle_1_thresh = current_threshold(V[:n_pts], I[:n_pts], float_thresh)
+    cycle_1_thresh = current_threshold(V[first], I[first], float_thresh)
     
     # do threshold at nth cycle
-    cycle_n_thresh = current_threshold( V[(int_n)*n_pts : (int_n + 1)*n_pts],
-                                        I[(int_n)*n_pts : (int_n + 1)*n_pts],
-                                        float_thresh)
+    cycle_n_thresh = current_threshold(V[nth], I[nth], float_thresh)
     
     delta = cycle_n_thresh - cycle_1_thresh
     
@@ -442,15 +717,15 @@ def E0_finder_analysis(CVDataPoint, *args):
         CVDataPoint.analysis[(E0_finder_analysis, *args)] = 0.0
         return CVDataPoint
     
-    t, V, I = CVDataPoint.data
-    I = savgol_filter(I, 15, 1)  # Do a little filtering
-    peaks = find_redox_peaks(t,V,I)
-    if not peaks:
+    t, V, _ = CVDataPoint.data
+    features = get_CV_features(CVDataPoint)
+    I = features['I_smooth']
+    if not features['peaks']:
         CVDataPoint.analysis[(E0_finder_analysis, *args)] = 0.0
         return CVDataPoint
-    fpeak, bpeak = peaks
+    fpeak, bpeak = features['peaks']
     
-    E0 = (V[fpeak] + V[bpeak])/2
+    E0 = features['E0']
     
     pts = matplotlib.lines.Line2D( [V[fpeak], V[bpeak]],
                                    [I[fpeak], I[bpeak]],
@@ -529,19 +804,17 @@ def _peak_integration(CVDataPoint):
         # Previously integrated this datapoint
         return CVDataPoint
     
-    t, V, I = CVDataPoint.data
-    I = savgol_filter(I, 15, 1)  # Do a little filtering
-    peaks = find_redox_peaks(t,V,I)
-    if not peaks:
+    t, V, _ = CVDataPoint.data
+    features = get_CV_features(CVDataPoint)
+    I = features['I_smooth']
+    if not features['peaks']:
         CVDataPoint.analysis[(_peak_integration, 'forward')] = 0.0
         CVDataPoint.analysis[(_peak_integration, 'reverse')] = 0.0
         CVDataPoint.analysis[(_peak_integration, 'ratio')] = 0.0
         return CVDataPoint
     
-    fbounds, rbounds = find_peak_bounds(t, V, I, *peaks)
-    
-    forward_integral = integrate(t, I, *fbounds)
-    reverse_integral = integrate(t, I, *rbounds)
+    fbounds, rbounds = features['bounds']
+    forward_integral, reverse_integral, ratio = features['integrals']
     
     
     fln  = matplotlib.lines.Line2D([V[fbounds[0]], V[fbounds[1]]],
@@ -560,11 +833,145 @@ def _peak_integration(CVDataPoint):
     
     CVDataPoint.analysis[(_peak_integration, 'forward')] = forward_integral
     CVDataPoint.analysis[(_peak_integration, 'reverse')] = reverse_integral
-    CVDataPoint.analysis[(_peak_integration, 'ratio')]   = abs(forward_integral/reverse_integral)
+    CVDataPoint.analysis[(_peak_integration, 'ratio')]   = ratio
     CVDataPoint.artists = [fln, bln, smoothed_data]
     return CVDataPoint
 
 
+#############################################
+########                             ########
+########      EIS ANALYSIS FUNCS     ########
+########                             ########
+#############################################
+
+
+def parse_circuit_arg(arg):
+    '''
+    "model,param" or "param" -> (model, param). Default: Randles, Rct
+    '''
+    args = [a.strip() for a in str(arg).split(',') if a.strip()]
+    if len(args) == 0:
+        return 'Randles', 'Rct'
+    if len(args) == 1:
+        return 'Randles', args[0]
+    return args[0], args[1]
+
+
+def prepare_circuit_fits(DataPoints, arg):
+    '''
+    Fit all spectra of the map together, with warm starts from neighboring
+    pixels (see circuit_fitting.fit_map)
+    '''
+    model, _ = parse_circuit_arg(arg)
+    if model not in get_models():
+        return
+    fit_datapoints([pt for pt in DataPoints if isinstance(pt, EISDataPoint)],
+                   model)
+
+
+def circuit_fit_analysis(EISDataPoint, arg):
+    if not hasattr(EISDataPoint, 'analysis'):
+        EISDataPoint.analysis = {}
+    
+    if 'EISDataPoint' not in EISDataPoint.__repr__():
+        EISDataPoint.analysis[(circuit_fit_analysis, arg)] = 0.0
+        return EISDataPoint
+    
+    if (circuit_fit_analysis, arg) in EISDataPoint.analysis.keys():
+        return EISDataPoint
+    
+    model, param = parse_circuit_arg(arg)
+    try:
+        fit = fit_datapoints([EISDataPoint], model)[0].features[
+                             'circuit_fits'][model]
+        val = fit[param]
+    except Exception as e:
+        print(f'Circuit fit error: {e}')
+        EISDataPoint.analysis[(circuit_fit_analysis, arg)] = 0.0
+        return EISDataPoint
+    
+    # Draw fitted spectrum on Nyquist plot
+    freqs = np.asarray(EISDataPoint.data[0], dtype=float)
+    freqs = np.logspace(np.log10(freqs.min()), np.log10(freqs.max()), 200)
+    Z  = model_Z(model, fit, freqs)
+    ln = matplotlib.lines.Line2D(Z.real, -Z.imag, color='orange')
+    ln.draw_on_type = 'Nyquist'
+    
+    EISDataPoint.analysis[(circuit_fit_analysis, arg)] = val
+    EISDataPoint.artists = [ln]
+    return EISDataPoint
+
+
+def parse_DRT_arg(arg):
+    '''
+    "x" or "x,lambda" -> (x, lambda). Default: tau, DEFAULT_LAMBDA
+    '''
+    args = [a.strip() for a in str(arg).split(',') if a.strip()]
+    quantity = args[0] if args else 'tau'
+    try:
+        lam = str_to_float(args[1])
+    except:
+        lam = DEFAULT_LAMBDA
+    return quantity, lam
+
+
+def prepare_DRT(DataPoints, arg):
+    '''
+    Invert all spectra with the same frequencies together
+    '''
+    _, lam = parse_DRT_arg(arg)
+    drt_datapoints([pt for pt in DataPoints if isinstance(pt, EISDataPoint)],
+                   lam)
+
+
+def DRT_analysis(EISDataPoint, arg):
+    if not hasattr(EISDataPoint, 'analysis'):
+        EISDataPoint.analysis = {}
+    
+    if 'EISDataPoint' not in EISDataPoint.__repr__():
+        EISDataPoint.analysis[(DRT_analysis, arg)] = 0.0
+        return EISDataPoint
+    
+    if (DRT_analysis, arg) in EISDataPoint.analysis.keys():
+        return EISDataPoint
+    
+    quantity, lam = parse_DRT_arg(arg)
+    try:
+        drt = drt_datapoints([EISDataPoint], lam)[0].features['drt'][lam]
+        val = float(drt[quantity])
+    except Exception as e:
+        print(f'DRT error: {e}')
+        EISDataPoint.analysis[(DRT_analysis, arg)] = 0.0
+        return EISDataPoint
+    
+    # Draw spectrum reconstructed from the DRT on Nyquist plot
+    freqs = np.asarray(EISDataPoint.data[0], dtype=float)
+    freqs = np.logspace(np.log10(freqs.min()), np.log10(freqs.max()), 200)
+    Z  = drt_Z(drt, freqs)
+    ln = matplotlib.lines.Line2D(Z.real, -Z.imag, color='orange')
+    ln.draw_on_type = 'Nyquist'
+    
+    EISDataPoint.analysis[(DRT_analysis, arg)] = val
+    EISDataPoint.artists = [ln]
+    return EISDataPoint
+
+
+
+# Batch feature extraction hooks, see prepare_CV_features()
+CV_decay_analysis.prepare                = prepare_CV_features
+threshold_current_analysis.prepare       = _prepare_threshold_features
+threshold_current_decay_analysis.prepare = prepare_CV_features
+E0_finder_analysis.prepare               = prepare_CV_features
+forward_peak_integration.prepare         = prepare_CV_features
+reverse_peak_integration.prepare         = prepare_CV_features
+peak_integration_ratio.prepare           = prepare_CV_features
+circuit_fit_analysis.prepare             = prepare_circuit_fits
+DRT_analysis.prepare                     = prepare_DRT
+
+# Functions that analyze a PointsList's EIS spectrum instead of its CV
+circuit_fit_analysis.point_type = EISDataPoint
+DRT_analysis.point_type         = EISDataPoint
+
 
 
 class AnalysisFunctionSelector():
@@ -582,6 +989,8 @@ class AnalysisFunctionSelector():
         function (if any, default to 1st in list), and write the description
         for that function. Closing window returns the selected function object
         '''
+        from tkinter import Toplevel, StringVar
+        from tkinter.ttk import Frame, Label, Button, OptionMenu
         popup = Toplevel()
         frame = Frame(popup)
         frame = Frame(popup)
@@ -611,7 +1020,110 @@ class AnalysisFunctionSelector():
         
 
 if __name__ == '__main__':
-    file = r'C:/Users/BRoehrich/Desktop/cv_data.csv'
-    t, V, I = np.loadtxt(file, unpack=True, skiprows=1, delimiter='\t')
- 
- 
\ No newline at end of file
+    '''
+    Cross-check find_peak_bounds() against the original O(n^2) stepping
+    search and time both of them.
+    
+    python -m src.analysis.analysis_funcs [file.secmdata | cv_data.csv ...]
+    
+    With no files given, runs on simulated CVs of increasing length.
+    '''
+    import sys
+    import time
+    
+    def find_peak_bounds_stepping(t, V, I, fpeak, bpeak):
+        # Original implementation, kept for comparison
+        half = len(t)//2
+        
+        def find_bounds(I, peak, add = 0):
+            if I[peak] < 0:
+                I = -I + min(-I)
+            lbound = rbound = peak
+            found = None
+            for i in range(1, min(len(I) - peak, peak) ):
+                lbound = peak - i
+                rbound = peak + i
+                if all( I[:peak] - I[lbound] >= 0):
+                    found = 'left'
+                    break
+                if all( I[peak:] - I[rbound] >= 0):
+                    found = 'right'
+                    break
+            x = np.arange(len(I))
+            if found == 'right':
+                x2, y2 = rbound, I[rbound]
+                for lbound in reversed(range(0, peak-i)):
+                    x1, y1 = lbound, I[lbound]
+                    m = (y2 - y1) / (x2 - x1)
+                    b = y1 - m*x1
+                    if min((I - (m*x + b))[lbound:rbound]) < 0:
+                        lbound += 1
+                        break
+            elif found == 'left':
+                x2, y2 = lbound, I[lbound]
+                for rbound in reversed(range(peak+i, len(I))):
+                    x1, y1 = rbound, I[rbound]
+                    m = (y2 - y1) / (x2 - x1)
+                    b = y1 - m*x1
+                    if min((I - (m*x + b))[lbound:rbound]) < 0:
+                        rbound -= 1
+                        break
+            return lbound+add, rbound+add
+        
+        return find_bounds(I[:half], fpeak), find_bounds(I[half:], bpeak-half, add=half)
+    
+    
+    def simulated_CV(n, E0=0.25, noise=2e-13):
+        # One cycle, -0.2 -> 0.7 -> -0.2 V, with a redox couple at E0
+        V = np.concatenate((np.linspace(-0.2, 0.7, n//2), 
+                            np.linspace(0.7, -0.2, n - n//2)))
+        t = np.linspace(0, 2*0.9/0.1, n)
+        f = 38.9
+        ox  =  8e-12/np.cosh(0.5*f*(V[:n//2] - E0 - 0.03))**2
+        red = -8e-12/np.cosh(0.5*f*(V[n//2:] - E0 + 0.03))**2
+        I = np.concatenate((ox, red)) + 3e-12*(V + 0.2)
+        I += noise*np.random.default_rng(n).standard_normal(n)
+        return t, V, I
+    
+    
+    def load_CVs(files):
+        CVs = []
+        for file in files:
+            if file.endswith('.secmdata'):
+                from src.modules.DataStorage import load_from_file
+                expt = load_from_file(file)
+                for pt in expt.data.flatten():
+                    for subpt in getattr(pt, 'data', []) if str(pt) == 'PointsList' else [pt]:
+                        if str(subpt) == 'CVDataPoint':
+                            t, V, I = subpt.data
+                            CVs.append((np.asarray(t), np.asarray(V), np.asarray(I)))
+            else:
+                CVs.append(np.loadtxt(file, unpack=True, skiprows=1, delimiter='\t'))
+        return CVs
+    
+    
+    files = sys.argv[1:]
+    if files:
+        CVs = load_CVs(files)
+    else:
+        CVs = [simulated_CV(n) for n in (1000, 2000, 5000, 10000, 20000)]
+    
+    n_match = n_peaks = 0
+    for t, V, I in CVs:
+        I = savgol_filter(I, 15, 1)
+        peaks = find_redox_peaks(t, V, I)
+        if not peaks:
+            continue
+        n_peaks += 1
+        st = time.perf_counter()
+        old = find_peak_bounds_stepping(t, V, I, *peaks)
+        t_old = time.perf_counter() - st
+        st = time.perf_counter()
+        new = find_peak_bounds(t, V, I, *peaks)
+        t_new = time.perf_counter() - st
+        
+        match = (old == new)
+        n_match += match
+        print(f'{len(t):>7} pts | stepping: {t_old*1000:9.2f} ms | hull: {t_new*1000:7.2f} ms | {old} -> {new} {"" if match else "MISMATCH"}')
+    
+    print(f'{n_match}/{n_peaks} CVs with detected peaks gave identical bounds')
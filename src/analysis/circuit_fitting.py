@@ -0,0 +1,347 @@
+'''
+Equivalent circuit fitting for EIS spectra.
+
+Every model evaluates Z for a whole stack of parameter sets at once, along
+with its analytic derivatives dZ/dp. All spectra of a map are then fit
+together by Levenberg-Marquardt: each iteration is a handful of numpy
+operations over an (n_spectra, n_freqs, n_params) Jacobian, instead of one
+optimizer call per pixel.
+
+Fits start from a guess read off each spectrum. Afterwards, any pixel whose
+neighbor fit much better is refit starting from that neighbor's parameters
+(warm start), so a good fit spreads across the map.
+
+Parameters are fit as log(p), so they stay positive. Residuals are
+(Z_fit - Z)/|Z| (modulus weighting), split into real and imaginary parts.
+'''
+import numpy as np
+
+
+N_NEIGHBORS     = 8   # Neighbors to compare with for warm starts
+N_WARM_ROUNDS   = 3
+MAX_ITERATIONS  = 200
+
+
+
+#############################################
+########                             ########
+########           MODELS            ########
+########                             ########
+#############################################
+
+'''
+Model functions take angular frequencies w (n_freqs,) and parameters p
+(n_spectra, n_params), and return (Z, dZ):
+    Z:  (n_spectra, n_freqs) complex impedance
+    dZ: (n_spectra, n_freqs, n_params) derivatives of Z w.r.t. each parameter
+'''
+
+def _parallel(Zf, Y_other):
+    # Zf in parallel with admittance Y_other. Returns Z, dZ/dZf, dZ/dY_other
+    Zp = 1/(1/Zf + Y_other)
+    return Zp, (Zp/Zf)**2, -Zp**2
+
+
+def randles(w, p):
+    # Rs + Rct || Cdl
+    Rs, Rct, Cdl = (p[:, i, None] for i in range(3))
+    s = 1j*w
+    Zp, dZf, dY = _parallel(Rct + 0j, s*Cdl)
+    dZ = np.stack([np.ones_like(Zp), dZf, dY*s], axis=-1)
+    return Rs + Zp, dZ
+
+
+def randles_CPE(w, p):
+    # Rs + Rct || CPE, Z_CPE = 1/(Q s^phi)
+    Rs, Rct, Q, phi = (p[:, i, None] for i in range(4))
+    s   = 1j*w
+    s_phi = np.exp(phi*np.log(s))
+    Zp, dZf, dY = _parallel(Rct + 0j, Q*s_phi)
+    dZ = np.stack([np.ones_like(Zp), dZf, dY*s_phi,
+                   dY*Q*s_phi*np.log(s)], axis=-1)
+    return Rs + Zp, dZ
+
+
+def randles_Warburg(w, p):
+    # Rs + (Rct + W) || Cdl, semi-infinite Warburg W = sigma/sqrt(s)
+    Rs, Rct, Cdl, sigma = (p[:, i, None] for i in range(4))
+    s  = 1j*w
+    W  = 1/np.sqrt(s)
+    Zp, dZf, dY = _parallel(Rct + sigma*W, s*Cdl)
+    dZ = np.stack([np.ones_like(Zp), dZf, dY*s, dZf*W], axis=-1)
+    return Rs + Zp, dZ
+
+
+def randles_spherical(w, p):
+    '''
+    Rs + (Rct + Z_sph) || Cdl, with finite spherical diffusion (as in
+    plotting/simulate_Z.py): Z_sph = Rd tanh(a)/(a - tanh(a)),
+    a = sqrt(3 Cd Rd s)
+    '''
+    Rs, Rct, Cdl, Rd, Cd = (p[:, i, None] for i in range(5))
+    s  = 1j*w
+    a  = np.sqrt(3*Cd*Rd*s)
+    T  = np.tanh(a)
+    Zsph  = Rd*T/(a - T)
+    dZ_da = Rd*(a*(1 - T**2) - T)/(a - T)**2
+    Zp, dZf, dY = _parallel(Rct + Zsph, s*Cdl)
+    dZ = np.stack([np.ones_like(Zp), dZf, dY*s,
+                   dZf*(Zsph/Rd + dZ_da*a/(2*Rd)),
+                   dZf*dZ_da*a/(2*Cd)], axis=-1)
+    return Rs + Zp, dZ
+
+
+
+def get_models():
+    '''
+    Dictionary of {name: (func, param names, {param: (lower, upper)})}
+    '''
+    return {
+        'Randles':   (randles, ('Rs', 'Rct', 'Cdl'), {}),
+        'CPE':       (randles_CPE, ('Rs', 'Rct', 'Q', 'phi'),
+                      {'phi': (0.3, 1)}),
+        'Warburg':   (randles_Warburg, ('Rs', 'Rct', 'Cdl', 'sigma'), {}),
+        'Spherical': (randles_spherical, ('Rs', 'Rct', 'Cdl', 'Rd', 'Cd'),
+                      {}),
+        }
+
+
+def initial_guess(model, freqs, Z):
+    '''
+    Rough parameters for each spectrum in Z (n_spectra, n_freqs), from the
+    high- and low-frequency real parts and the frequency of the Nyquist
+    semicircle's peak
+    '''
+    freqs = np.asarray(freqs)
+    w     = 2*np.pi*freqs
+    hi, lo = np.argmax(freqs), np.argmin(freqs)
+    scale = np.nanmax(np.abs(Z), axis=1)
+    Rs    = np.maximum(Z[:, hi].real, 1e-3*scale)
+    Rct   = np.maximum(Z[:, lo].real - Rs, 1e-2*scale)
+    w_pk  = w[np.nanargmax(-Z.imag, axis=1)]
+    Cdl   = 1/(w_pk*Rct)
+
+    if model == 'Randles':
+        return np.stack([Rs, Rct, Cdl], axis=1)
+    if model == 'CPE':
+        phi = np.full(len(Z), 0.9)
+        return np.stack([Rs, Rct, Cdl*w_pk**(1 - phi), phi], axis=1)
+    if model == 'Warburg':
+        return np.stack([Rs, Rct, Cdl, 0.1*Rct*np.sqrt(w.min())], axis=1)
+    if model == 'Spherical':
+        return np.stack([Rs, Rct, Cdl, Rct, 10*Cdl], axis=1)
+    raise ValueError(f'Unknown circuit model {model}')
+
+
+
+#############################################
+########                             ########
+########           FITTING           ########
+########                             ########
+#############################################
+
+
+def _residuals(func, w, q, Z, weight):
+    # Residuals (n, 2*n_freqs) and their Jacobian w.r.t. log params q
+    p = np.exp(q)
+    Zfit, dZ = func(w, p)
+    r  = (Zfit - Z)*weight
+    J  = dZ*p[:, None, :]*weight[..., None]
+    return (np.concatenate([r.real, r.imag], axis=1),
+            np.concatenate([J.real, J.imag], axis=1))
+
+
+def fit_spectra(model, freqs, Z, p0=None, max_iter=MAX_ITERATIONS,
+                tol=1e-10):
+    '''
+    Fit all spectra together.
+
+    model: name from get_models()
+    freqs: (n_freqs,) frequencies (Hz)
+    Z: (n_spectra, n_freqs) complex impedance
+    p0: (n_spectra, n_params) starting parameters, or None to guess them
+
+    Returns (params, error): (n_spectra, n_params) fitted parameters, and
+    the relative RMS error of each fit
+    '''
+    func, names, bounds = get_models()[model]
+    w  = 2*np.pi*np.asarray(freqs, dtype=float)
+    Z  = np.atleast_2d(np.asarray(Z, dtype=complex))
+    weight = 1/np.abs(Z)
+
+    if p0 is None:
+        p0 = initial_guess(model, freqs, Z)
+    lower = np.array([np.log(bounds.get(name, (0, 0))[0] or 1e-300)
+                      for name in names])
+    upper = np.array([np.log(bounds[name][1]) if name in bounds else np.inf
+                      for name in names])
+    q = np.clip(np.log(np.asarray(p0, dtype=float)), lower, upper)
+
+    with np.errstate(all='ignore'):
+        r, J  = _residuals(func, w, q, Z, weight)
+        cost  = np.sum(r**2, axis=1)
+        lam   = np.full(len(Z), 1e-3)
+        active = np.isfinite(cost)
+
+        for _ in range(max_iter):
+            idx = np.flatnonzero(active)
+            if len(idx) == 0:
+                break
+            JTJ  = np.einsum('nfp,nfq->npq', J[idx], J[idx])
+            grad = np.einsum('nfp,nf->np', J[idx], r[idx])
+            diag = np.einsum('npp->np', JTJ)
+            A    = JTJ + (lam[idx, None]*diag + 1e-12)[..., None]*np.eye(
+                                                            q.shape[1])
+            step = np.linalg.solve(A, -grad[..., None])[..., 0]
+            # Limit steps to factors of e^2 per iteration
+            step = np.nan_to_num(np.clip(step, -2, 2))
+
+            q_new = np.clip(q[idx] + step, lower, upper)
+            r_new, J_new = _residuals(func, w, q_new, Z[idx], weight[idx])
+            cost_new = np.sum(r_new**2, axis=1)
+
+            better = cost_new < cost[idx]
+            done   = (~better & (lam[idx] > 1e10)) | (
+                      better & (cost[idx] - cost_new <= tol*cost[idx]))
+
+            upd = idx[better]
+            q[upd], r[upd], J[upd], cost[upd] = (
+                q_new[better], r_new[better], J_new[better], cost_new[better])
+            lam[idx] = np.where(better, lam[idx]/3, lam[idx]*4)
+            active[idx[done]] = False
+
+    error = np.sqrt(cost/(2*w.size))
+    return np.exp(q), error
+
+
+def fit_map(model, freqs, Z, locs, n_neighbors=N_NEIGHBORS,
+            rounds=N_WARM_ROUNDS):
+    '''
+    fit_spectra() for the spectra of a map, followed by warm starts: each
+    pixel whose error is more than 2x that of one of its nearest neighbors
+    is refit starting from the best neighbor's parameters, and keeps the
+    new fit if it is better.
+
+    locs: (n_spectra, 2) x, y location of each spectrum
+    '''
+    params, error = fit_spectra(model, freqs, Z)
+    locs = np.asarray(locs, dtype=float)
+    if len(Z) < 2:
+        return params, error
+
+    from scipy.spatial import cKDTree
+    k = min(n_neighbors + 1, len(Z))
+    _, neighbors = cKDTree(locs).query(locs, k=k)
+    neighbors = neighbors[:, 1:]
+
+    for _ in range(rounds):
+        err  = np.where(np.isfinite(error), error, np.inf)
+        best = neighbors[np.arange(len(Z)), np.argmin(err[neighbors], axis=1)]
+        retry = np.flatnonzero(err > 2*err[best])
+        if len(retry) == 0:
+            break
+        new_params, new_error = fit_spectra(model, freqs, Z[retry],
+                                            p0=params[best[retry]])
+        improved = new_error < err[retry]
+        if not improved.any():
+            break
+        params[retry[improved]] = new_params[improved]
+        error[retry[improved]]  = new_error[improved]
+    return params, error
+
+
+def fit_datapoints(EISDataPoints, model='Randles'):
+    '''
+    Fits every EISDataPoint without a fit to this model yet. Results are
+    stored as EISDataPoint.features['circuit_fits'][model] =
+    {param: value, ..., 'error': relative RMS error}. Spectra with
+    different frequencies are fit separately.
+    '''
+    _, names, _ = get_models()[model]
+    groups = {}
+    for pt in EISDataPoints:
+        if model in _get_fits(pt):
+            continue
+        freqs = tuple(np.asarray(pt.data[0], dtype=float))
+        groups.setdefault(freqs, []).append(pt)
+
+    for freqs, pts in groups.items():
+        Z    = np.array([pt.data[3] for pt in pts], dtype=complex)
+        locs = [pt.loc[:2] for pt in pts]
+        valid  = np.all(np.isfinite(Z), axis=1) & np.all(Z != 0, axis=1)
+        params = np.full((len(pts), len(names)), np.nan)
+        error  = np.full(len(pts), np.nan)
+        if valid.any():
+            params[valid], error[valid] = fit_map(
+                model, freqs, Z[valid], np.array(locs)[valid])
+        for pt, p, e in zip(pts, params, error):
+            fit = dict(zip(names, p.tolist()))
+            fit['error'] = float(e)
+            _get_fits(pt)[model] = fit
+    return EISDataPoints
+
+
+def _get_fits(pt):
+    # Emptied if the spectrum changes, see DataPoint.get_features()
+    return pt.get_features().setdefault('circuit_fits', {})
+
+
+def model_Z(model, fit, freqs):
+    '''
+    Impedance of a fitted circuit (dict from fit_datapoints) at freqs
+    '''
+    func, names, _ = get_models()[model]
+    p = np.array([[fit[name] for name in names]])
+    return func(2*np.pi*np.asarray(freqs, dtype=float), p)[0][0]
+
+
+
+if __name__ == '__main__':
+    import time
+    from scipy.optimize import least_squares
+    rng = np.random.default_rng(0)
+
+    # Check analytic Jacobians against finite differences
+    freqs = np.logspace(0, 4, 30)
+    w = 2*np.pi*freqs
+    for name, (func, names, _) in get_models().items():
+        p = initial_guess(name, freqs,
+                          randles(w, np.array([[1e6, 1e8, 1e-11]]))[0])
+        Z, dZ = func(w, p)
+        h  = 1e-6*p
+        fd = np.stack([(func(w, p + h*(np.arange(len(names)) == i))[0] - Z)
+                       / h[:, i, None] for i in range(len(names))], axis=-1)
+        print(f'{name:>10} Jacobian max rel. error: '
+              f'{np.max(np.abs(fd - dZ)/np.abs(dZ).max(axis=1)):0.1e}')
+
+    # Simulated 50x50 map with a "particle" of low Rct
+    n  = 50
+    x, y = np.meshgrid(np.arange(n), np.arange(n))
+    Rct  = 1e8*(1 + 9*(np.hypot(x - 25, y - 25) > 10)).ravel()
+    true = np.stack([np.full(n*n, 2e6), Rct, np.full(n*n, 2e-11),
+                     np.full(n*n, 0.85)], axis=1)
+    Z    = randles_CPE(w, true)[0]
+    Z   *= 1 + 0.01*(rng.standard_normal(Z.shape)
+                     + 1j*rng.standard_normal(Z.shape))
+    locs = np.stack([x.ravel(), y.ravel()], axis=1)
+
+    st = time.perf_counter()
+    params, error = fit_map('CPE', freqs, Z, locs)
+    batch_time = time.perf_counter() - st
+
+    # One least_squares call per pixel, for comparison (on 100 pixels)
+    def resid(q, Zi):
+        r = (randles_CPE(w, np.exp(q)[None])[0][0] - Zi)/np.abs(Zi)
+        return np.concatenate([r.real, r.imag])
+    p0 = initial_guess('CPE', freqs, Z)
+    st = time.perf_counter()
+    for i in range(100):
+        least_squares(resid, np.log(p0[i]), args=(Z[i],))
+    loop_time = (time.perf_counter() - st)*len(Z)/100
+
+    rel = np.abs(params/true - 1)
+    print(f'\n{len(Z)} spectra, {len(freqs)} freqs: fit_map {batch_time:0.2f} s,'
+          f' least_squares loop ~{loop_time:0.1f} s')
+    print('median rel. error of Rs, Rct, Q, phi:',
+          np.round(np.median(rel, axis=0), 4))
+    print(f'fits with Rct off by >10%: {np.sum(rel[:, 1] > 0.1)}')
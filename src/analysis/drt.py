@@ -0,0 +1,209 @@
+'''
+Distribution of relaxation times (DRT) for EIS spectra.
+
+The impedance is modeled as a series resistance plus RC elements with time
+constants spaced evenly in log(tau):
+
+    Z(w) = R_inf + sum_k gamma_k dln(tau) / (1 + j w tau_k)
+
+gamma (ohm, per unit ln(tau)) is found by Tikhonov-regularized least
+squares on the real and imaginary parts, with a second-difference penalty
+for smoothness. For a given set of frequencies, the solution is a fixed
+linear operator applied to the spectrum. It is computed once per waveform
+and reused, so a whole map is inverted with one matrix product.
+
+gamma is not constrained to be positive, and its negative side lobes bias
+the sum of gamma and the fitted R_inf. The reported R_inf and R_pol are
+read from the spectrum instead: Re Z at the highest frequency, and the
+difference between Re Z at the lowest and highest frequencies. R_pol is
+therefore not a DRT quantity. It is only the polarization resistance if
+Re Z has leveled off at the lowest frequency, and underestimates it for
+spectra which haven't (i.e. diffusion, Re Z still rising as f -> 0).
+'''
+import numpy as np
+
+
+DEFAULT_LAMBDA = 1e-3
+TAUS_PER_DECADE = 10
+
+_operators = {}  # {(freqs, lam, taus_per_decade): (taus, operator)}
+
+
+
+def get_taus(freqs, taus_per_decade=TAUS_PER_DECADE):
+    '''
+    Time constants (s) covering 1/(2 pi f) for all freqs, plus one decade
+    on each side
+    '''
+    w = 2*np.pi*np.asarray(freqs, dtype=float)
+    lo = np.floor(np.log10(1/w.max())) - 1
+    hi = np.ceil(np.log10(1/w.min())) + 1
+    return np.logspace(lo, hi, int((hi - lo)*taus_per_decade) + 1)
+
+
+def design_matrix(freqs, taus):
+    '''
+    (2*n_freqs, 1 + n_taus) matrix A: real parts stacked on imaginary parts
+    of Z = A @ [R_inf, gamma*dln(tau)]
+    '''
+    wt  = np.outer(2*np.pi*np.asarray(freqs, dtype=float), taus)
+    A   = np.zeros((2*len(wt), 1 + len(taus)))
+    A[:len(wt), 0]  = 1
+    A[:len(wt), 1:] = 1/(1 + wt**2)
+    A[len(wt):, 1:] = -wt/(1 + wt**2)
+    return A
+
+
+def get_operator(freqs, lam=DEFAULT_LAMBDA, taus_per_decade=TAUS_PER_DECADE):
+    '''
+    Returns (taus, M), with M = (A^T A + lam L^T L)^-1 A^T. Cached per set
+    of frequencies.
+    '''
+    key = (tuple(np.asarray(freqs, dtype=float)), lam, taus_per_decade)
+    if key not in _operators:
+        taus = get_taus(freqs, taus_per_decade)
+        A = design_matrix(freqs, taus)
+        # Second difference of gamma, R_inf is not penalized
+        L = np.zeros((len(taus) - 2, 1 + len(taus)))
+        L[:, 1:] = np.diff(np.eye(len(taus)), n=2, axis=0)
+        M = np.linalg.solve(A.T @ A + lam*L.T @ L, A.T)
+        _operators[key] = (taus, M)
+    return _operators[key]
+
+
+def invert_spectra(freqs, Z, lam=DEFAULT_LAMBDA,
+                   taus_per_decade=TAUS_PER_DECADE):
+    '''
+    DRT of every spectrum in Z (n_spectra, n_freqs).
+
+    Returns (taus, R_inf, gamma): fitted model parameters, gamma is
+    (n_spectra, n_taus). gamma isn't constrained to be positive, so it
+    has negative ripples (clip it for display)
+    '''
+    taus, M = get_operator(freqs, lam, taus_per_decade)
+    Z = np.atleast_2d(np.asarray(Z, dtype=complex))
+    x = np.concatenate([Z.real, Z.imag], axis=1) @ M.T
+    dlntau = np.log(10)/taus_per_decade
+    return taus, x[:, 0], x[:, 1:]/dlntau
+
+
+def find_peaks(taus, gamma):
+    '''
+    Time constant and height of the largest peak of each DRT, refined by
+    fitting a parabola (in log tau) through the maximum and its neighbors
+    '''
+    gamma = np.atleast_2d(gamma)
+    n   = np.arange(len(gamma))
+    idx = np.clip(np.argmax(gamma, axis=1), 1, gamma.shape[1] - 2)
+    y0, y1, y2 = gamma[n, idx - 1], gamma[n, idx], gamma[n, idx + 1]
+    denom = y0 - 2*y1 + y2
+    with np.errstate(all='ignore'):
+        shift = np.where(denom < 0, 0.5*(y0 - y2)/denom, 0)
+    shift  = np.clip(np.nan_to_num(shift), -1, 1)
+    log_tau = np.interp(idx + shift, np.arange(len(taus)), np.log10(taus))
+    height  = y1 - 0.25*(y0 - y2)*shift
+    return 10**log_tau, height
+
+
+def drt_datapoints(EISDataPoints, lam=DEFAULT_LAMBDA):
+    '''
+    Computes the DRT of every EISDataPoint which doesn't have one at this
+    lam yet. Results are stored as
+    EISDataPoint.features['drt'][lam] = {'taus', 'gamma', 'R_inf_fit',
+                                         'tau', 'height', 'R_inf', 'R_pol'}
+    taus, gamma, and R_inf_fit are the fitted model (see drt_Z). R_inf and
+    R_pol are from the measured spectrum.
+    '''
+    groups = {}
+    for pt in EISDataPoints:
+        if lam in _get_drts(pt):
+            continue
+        freqs = tuple(np.asarray(pt.data[0], dtype=float))
+        groups.setdefault(freqs, []).append(pt)
+
+    for freqs, pts in groups.items():
+        Z = np.array([pt.data[3] for pt in pts], dtype=complex)
+        valid = np.all(np.isfinite(Z), axis=1) & np.any(Z != 0, axis=1)
+        taus  = get_taus(freqs)
+        R_inf_fit = np.full(len(pts), np.nan)
+        gamma = np.full((len(pts), len(taus)), np.nan)
+        if valid.any():
+            taus, R_inf_fit[valid], gamma[valid] = invert_spectra(
+                                                freqs, Z[valid], lam)
+        tau, height  = find_peaks(taus, gamma)
+        R_inf, R_pol = data_resistances(freqs, Z)
+        R_inf[~valid] = R_pol[~valid] = np.nan
+        for k, pt in enumerate(pts):
+            _get_drts(pt)[lam] = {'taus': taus, 'gamma': gamma[k],
+                                  'R_inf_fit': R_inf_fit[k],
+                                  'tau': tau[k], 'height': height[k],
+                                  'R_inf': R_inf[k], 'R_pol': R_pol[k]}
+    return EISDataPoints
+
+
+def data_resistances(freqs, Z):
+    '''
+    (R_inf, R_pol) of each spectrum in Z (n_spectra, n_freqs): Re Z at the
+    highest frequency, and Re Z at the lowest minus that
+    '''
+    freqs = np.asarray(freqs)
+    Z     = np.atleast_2d(Z)
+    R_inf = Z[:, np.argmax(freqs)].real
+    return R_inf, Z[:, np.argmin(freqs)].real - R_inf
+
+
+def _get_drts(pt):
+    # Emptied if the spectrum changes, see DataPoint.get_features()
+    return pt.get_features().setdefault('drt', {})
+
+
+def drt_Z(drt, freqs):
+    '''
+    Impedance of a DRT (dict from drt_datapoints) at freqs
+    '''
+    A = design_matrix(freqs, drt['taus'])
+    dlntau = np.log(10)/TAUS_PER_DECADE
+    x = A @ np.concatenate([[drt['R_inf_fit']], drt['gamma']*dlntau])
+    return x[:len(freqs)] + 1j*x[len(freqs):]
+
+
+
+if __name__ == '__main__':
+    import time
+    rng = np.random.default_rng(0)
+
+    # 10k pixel map of R + R||C with a range of time constants
+    n     = 10000
+    freqs = np.logspace(0, 4, 30)
+    w     = 2*np.pi*freqs
+    Rs, Rct = 1e6, 1e8
+    tau   = 10**rng.uniform(-3.5, -1.5, n)
+    Z     = Rs + Rct/(1 + 1j*np.outer(tau, w))
+    Z    *= 1 + 0.005*(rng.standard_normal(Z.shape)
+                       + 1j*rng.standard_normal(Z.shape))
+
+    # Solving the regularized system for each pixel
+    taus = get_taus(freqs)
+    A = design_matrix(freqs, taus)
+    L = np.zeros((len(taus) - 2, 1 + len(taus)))
+    L[:, 1:] = np.diff(np.eye(len(taus)), n=2, axis=0)
+    st = time.perf_counter()
+    for z in Z[:500]:
+        b = np.concatenate([z.real, z.imag])
+        np.linalg.solve(A.T @ A + DEFAULT_LAMBDA*L.T @ L, A.T @ b)
+    loop_time = (time.perf_counter() - st)*n/500
+
+    _operators.clear()
+    st = time.perf_counter()
+    taus, _, gamma = invert_spectra(freqs, Z)
+    peak_tau, height = find_peaks(taus, gamma)
+    batch_time = time.perf_counter() - st
+
+    R_inf, R_pol = data_resistances(freqs, Z)
+    print(f'{n} spectra, {len(freqs)} freqs, {len(taus)} taus')
+    print(f'per-pixel solve: ~{loop_time:0.2f} s, '
+          f'shared operator: {1e3*batch_time:0.1f} ms')
+    print(f'median |log10(peak tau/tau)|: '
+          f'{np.median(np.abs(np.log10(peak_tau/tau))):0.3f}')
+    print(f'median R_pol/Rct: {np.median(R_pol/Rct):0.3f}, '
+          f'R_inf/Rs: {np.median(R_inf/Rs):0.3f}')
@@ -4,6 +4,7 @@ import struct
 import numpy as np
 # from modules.DataStorage import ADCDataPoint
 from .DataStorage import ADCDataPoint
+from ..utils.spectral import StreamingImpedance
 from ..utils.utils import run, Logger
 
 CONST_SER_PORT = 'COM6'   #get the com port from device manger and enter it here
@@ -46,6 +47,7 @@ class ADC(Logger):
         self.pollingcount = 0
         self.pollingdata  = ADCDataPoint(loc=(0,),
                                          data=[ [], [], [] ])
+        self.EIS_freqs    = None  # Set during EIS to estimate Z while polling
         self.set_sample_rate(100)
     
     
@@ -186,6 +188,8 @@ class ADC(Logger):
         
         gain = 1e9 * self.master.GUI.amp_params.get('float_gain', 1e-9)
         self.pollingdata.set_HEKA_gain(gain)
+        if self.EIS_freqs is not None:
+            self.pollingdata.impedance = StreamingImpedance(self.EIS_freqs)
         
         # Start reading ADC
         self.pollingcount += 1
@@ -0,0 +1,411 @@
+'''
+Headless batch rendering of saved experiments.
+
+Renders heatmaps of any display quantity or analysis function, and per-pixel
+echem figures (I vs V, I vs t, V vs t, Nyquist, |Z| Bode, Phase Bode), for
+every .secmdata file in a folder. Work is split into one heatmap task per
+file and chunks of pixels for the echem figures, which run in a process pool
+with the Agg backend. Each worker process keeps one heatmap figure and one
+echem figure and only updates their artists between images.
+
+Run from the command line with batch_export.py, e.g.
+
+    python batch_export.py D:/SECM/Data/campaign -q max "val_at:0.2"
+        "Threshold current:1n" -e "I vs V" Nyquist -j 8
+'''
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.transforms
+from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
+
+from .DataStorage import (load_from_file, ADCDataPoint, CVDataPoint,
+                          EISDataPoint, PointsList, SinglePoint)
+from ..utils.plot_utils import (get_clim, get_plotlim, set_cbar_ticklabels,
+                                unit_label, heatmap_datatypes)
+from ..analysis.analysis_funcs import get_functions
+
+
+IV_views  = ('I vs V', 'I vs t', 'V vs t')
+EIS_views = ('Nyquist', '|Z| Bode', 'Phase Bode')
+
+
+def parse_quantity(quantity):
+    '''
+    Split a quantity string into (name, arg).
+
+    'max', 'avg', 'z'       -> Experiment.get_heatmap_data() datatypes
+    'val_at:0.2'            -> datatype with argument
+    'Threshold current:1n'  -> analysis function name (see get_functions())
+                               with its input string
+    '''
+    name, _, arg = quantity.partition(':')
+    return name.strip(), arg.strip()
+
+
+def get_heatmap_data(expt, quantity):
+    '''
+    Returns 2D float array of the given quantity for each pixel of expt
+    '''
+    name, arg = parse_quantity(quantity)
+    functions = get_functions()
+    if name in functions:
+        pts = expt.do_analysis(functions[name][0], arg)
+    elif name in heatmap_datatypes.values():
+        pts = expt.get_heatmap_data(name, float(arg) if arg else None)
+    else:
+        raise ValueError(f'Unknown heatmap quantity: {name}')
+    return np.array(pts, dtype=float)
+
+
+def safe_name(s):
+    # Make a quantity or view name usable in a file name
+    return re.sub(r'[^\w.\-]+', '_', s).strip('_')
+
+
+
+class HeatmapRenderer():
+    '''
+    Draws heatmaps to file in the same style as Plotter.HeatmapExporter.
+    The figure, image and colorbar are made once and reused.
+    '''
+    def __init__(self, dpi=300, cmap='viridis', n_cbar_ticks=5):
+        self.dpi = dpi
+        self.n_cbar_ticks = n_cbar_ticks
+        self.fig = Figure(figsize=(4,4), dpi=100, constrained_layout=True)
+        FigureCanvasAgg(self.fig)
+        self.ax  = self.fig.add_subplot(111)
+
+        self.image = self.ax.imshow(np.zeros((2,2)), cmap=cmap,
+                                    origin='upper', extent=[0,1,0,1])
+        self.cbar = self.fig.colorbar(self.image, ax=self.ax, shrink=0.5,
+                                pad=0.02, format=lambda val,idx:unit_label(val))
+        self.cbar.ax.tick_params(labelsize=14)
+
+        for sp in ['right', 'top', 'left', 'bottom']:
+            self.ax.spines[sp].set_visible(True)
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+
+        self.scalebar = None
+        self.scale    = None
+
+
+    def render(self, data, path, length=None):
+        '''
+        data: 2D array, as returned by Experiment.get_heatmap_data()
+        path: file to save to
+        length: scan size in um, for the scalebar
+        '''
+        self.image.set_data(data[::-1])
+        valid = data[np.isfinite(data)]
+        clim  = get_clim(valid)
+        # Colorbar would rescale on the half-set clim, update it after
+        with self.image.callbacks.blocked():
+            self.image.set_clim(clim)
+        self.cbar.update_normal(self.image)
+        set_cbar_ticklabels(self.cbar, clim, self.n_cbar_ticks)
+        self.set_scalebar(length)
+        self.fig.savefig(path, dpi=self.dpi)
+
+
+    def set_scalebar(self, length):
+        if length == self.scale:
+            return
+        if self.scalebar is not None:
+            self.scalebar.remove()
+            self.scalebar = None
+        self.scale = length
+        if not length:
+            return
+
+        bar_length = length/4
+        frac  = bar_length/length
+        label = f'{bar_length:.0f}' + r' $\mu$m'
+        self.scalebar = AnchoredSizeBar(self.ax.transData,
+                           frac, label, 'lower right',
+                           pad=0.1,
+                           color='black',
+                           frameon=False,
+                           size_vertical=0.2*frac,
+                           label_top=False,
+                           bbox_to_anchor=matplotlib.transforms.Bbox.from_bounds(0.5,-0.3,0.5,0.3),
+                           bbox_transform=self.ax.transAxes)
+        self.ax.add_artist(self.scalebar)
+
+
+
+class EchemRenderer():
+    '''
+    Draws one DataPoint per image, like Plotter.EchemFig. The figure and
+    line are made once, only the line data, limits and labels change.
+    '''
+    def __init__(self, dpi=100):
+        self.dpi = dpi
+        self.fig = Figure(figsize=(4,4), dpi=100)
+        FigureCanvasAgg(self.fig)
+        self.ax  = self.fig.add_subplot(111)
+        self.fig.subplots_adjust(left=0.22, right=0.95, bottom=0.15, top=0.95)
+        self.ln, = self.ax.plot([], [])
+
+
+    def render(self, DataPoint, view, path):
+        '''
+        Returns False if view doesn't apply to this type of DataPoint
+        '''
+        if isinstance(DataPoint, EISDataPoint):
+            if view not in EIS_views:
+                return False
+            self.plot_EIS(DataPoint, view)
+        elif isinstance(DataPoint, (CVDataPoint, ADCDataPoint)):
+            if view not in IV_views:
+                return False
+            self.plot_IV(DataPoint, view)
+        else:
+            return False
+        self.fig.savefig(path, dpi=self.dpi)
+        return True
+
+
+    def plot_IV(self, DataPoint, view):
+        ylabel, xlabel = view.split(' vs ')
+        if xlabel == 't':
+            t, V, I = DataPoint.get_window(n_pixels=int(self.ax.bbox.width))
+        else:
+            t, V, I = DataPoint.get_data()
+        if isinstance(DataPoint, ADCDataPoint):
+            V = np.array(V)/10
+            I = np.array(I)/DataPoint.gain
+
+        d = {'t':t, 'V':V, 'I':I}
+        xvals, yvals = d[xlabel], d[ylabel]
+        self.ln.set_data(xvals, yvals)
+        self.ln.set_marker('')
+        xlim, ylim = get_plotlim(xvals, yvals)
+        self.ax.set_xscale('linear')
+        self.ax.set_xlim(xlim)
+        self.ax.set_ylim(ylim)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+
+
+    def plot_EIS(self, DataPoint, view):
+        freqs, _, _, Z = DataPoint.data
+        freqs = np.array(freqs, dtype=float)
+        Z = np.array(Z)
+        valid = np.abs(Z) <= 20e9
+        freqs, Z = freqs[valid], Z[valid]
+        self.ln.set_marker('o')
+
+        if view == 'Nyquist':
+            x, y = np.real(Z), -np.imag(Z)
+            self.ln.set_data(x, y)
+            self.ax.set_xscale('linear')
+            xlim, ylim = get_plotlim(x, y)
+            mini = min(0, *xlim, *ylim)
+            maxi = max(*xlim, *ylim)
+            self.ax.set_xlim(mini, maxi)
+            self.ax.set_ylim(mini, maxi)
+            self.ax.set_xlabel(r"Z'/ $\Omega$")
+            self.ax.set_ylabel(r"Z''/ $\Omega$")
+            return
+
+        if view == '|Z| Bode':
+            y = np.abs(Z)
+            ylim = (min(y) - 0.05*abs(min(y)), max(y) + 0.05*abs(max(y)))
+            ylabel = r'|Z|/ $\Omega$'
+        else:
+            y = np.angle(Z, deg=True)
+            ylim = (min(y) - 15, max(y) + 15)
+            ylabel = r'Phase/ $\degree$'
+        self.ln.set_data(freqs, y)
+        self.ax.set_xscale('log')
+        self.ax.set_xlim(min(freqs) - 0.05*min(freqs),
+                         max(freqs) + 0.05*max(freqs))
+        self.ax.set_ylim(ylim)
+        self.ax.set_xlabel('Frequency/ Hz')
+        self.ax.set_ylabel(ylabel)
+
+
+
+########    WORKER PROCESS FUNCTIONS     ########
+
+# Each worker keeps the last experiment it loaded and its renderers, so
+# consecutive tasks from the same file don't unpickle or rebuild figures
+_worker = {}
+
+
+def _load(path):
+    if _worker.get('path') != path:
+        # Traces are mapped from (version 2) files or packed, so quantities
+        # like val_at are computed on all CVs in place (see TraceArena)
+        expt = load_from_file(path, mmap=True)
+        expt.get_arena()
+        _worker['expt'] = expt
+        _worker['path'] = path
+    return _worker['expt']
+
+
+def _get_renderer(cls, *args):
+    key = (cls.__name__, *args)
+    if key not in _worker:
+        _worker[key] = cls(*args)
+    return _worker[key]
+
+
+def _grid_shape(path):
+    return 'shape', _load(path).data.shape
+
+
+def _render_heatmaps(path, out_dir, quantities, dpi, cmap):
+    expt = _load(path)
+    renderer = _get_renderer(HeatmapRenderer, dpi, cmap)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    n = 0
+    for quantity in quantities:
+        try:
+            data = get_heatmap_data(expt, quantity)
+        except Exception as e:
+            print(f'{stem}: could not get {quantity}: {e}')
+            continue
+        fname = os.path.join(out_dir, f'{stem}_{safe_name(quantity)}.png')
+        renderer.render(data, fname, getattr(expt, 'length', None))
+        n += 1
+    return 'images', n
+
+
+def _render_echem(path, out_dir, idxs, views, dpi):
+    expt = _load(path)
+    renderer = _get_renderer(EchemRenderer, dpi)
+    n = 0
+    for i, j in idxs:
+        pt = expt.data[i][j]
+        pts = pt.data if isinstance(pt, PointsList) else [pt]
+        for k, subpt in enumerate(pts):
+            if isinstance(subpt, SinglePoint):
+                continue
+            for view in views:
+                fname = os.path.join(out_dir,
+                         f'{i:02}_{j:02}_{str(subpt)}{k}_{safe_name(view)}.png')
+                try:
+                    n += renderer.render(subpt, view, fname)
+                except Exception as e:
+                    print(f'{fname}: {e}')
+    return 'images', n
+
+
+
+class BatchExporter():
+    '''
+    Renders every .secmdata file in a folder.
+
+    quantities: list of heatmap quantities, see parse_quantity()
+    views: list of per-pixel echem views (IV_views and/or EIS_views)
+    n_workers: number of processes, default os.cpu_count()
+    chunk_size: pixels per echem task
+    '''
+    def __init__(self, quantities=('max',), views=(), dpi=300, echem_dpi=100,
+                 cmap='viridis', n_workers=None, chunk_size=250):
+        for quantity in quantities:
+            name, _ = parse_quantity(quantity)
+            if (name not in get_functions() and 
+                name not in heatmap_datatypes.values()):
+                raise ValueError(f'Unknown heatmap quantity: {name}')
+        self.quantities = list(quantities)
+        self.views      = list(views)
+        self.dpi        = dpi
+        self.echem_dpi  = echem_dpi
+        self.cmap       = cmap
+        self.n_workers  = n_workers
+        self.chunk_size = chunk_size
+
+
+    def export_folder(self, folder, out_dir=None):
+        files = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                       if f.endswith('.secmdata'))
+        return self.export_files(files, out_dir or os.path.join(folder, 'export'))
+
+
+    def export_files(self, files, out_dir):
+        '''
+        Render all quantities and views for each file. Heatmaps go in out_dir,
+        echem figures in out_dir/<file name>/. Returns number of images saved.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        st = time.time()
+        n_images = 0
+        n_tasks  = 0
+        with ProcessPoolExecutor(self.n_workers) as pool:
+            pending = set()
+            for path in files:
+                pending.update(self.submit(pool, path, out_dir))
+            
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, (kind, result) = future.path, future.result()
+                    n_tasks += 1
+                    if kind == 'shape':
+                        # Grid is known, split its pixels into echem tasks
+                        pending.update(self.submit_echem(pool, path, out_dir,
+                                                         result))
+                        continue
+                    n_images += result
+                print(f'{n_tasks} tasks done, {len(pending)} pending, '
+                      f'{n_images} images, {time.time() - st:0.1f} s')
+        return n_images
+
+
+    def submit(self, pool, path, out_dir):
+        futures = []
+        if self.quantities:
+            futures.append(pool.submit(_render_heatmaps, path, out_dir,
+                                       self.quantities, self.dpi, self.cmap))
+        if self.views:
+            futures.append(pool.submit(_grid_shape, path))
+        for future in futures:
+            future.path = path
+        return futures
+
+
+    def submit_echem(self, pool, path, out_dir, shape):
+        idxs = list(np.ndindex(shape))
+        stem = os.path.splitext(os.path.basename(path))[0]
+        pt_dir = os.path.join(out_dir, stem)
+        os.makedirs(pt_dir, exist_ok=True)
+        futures = []
+        for i in range(0, len(idxs), self.chunk_size):
+            future = pool.submit(_render_echem, path, pt_dir,
+                                 idxs[i:i+self.chunk_size], self.views,
+                                 self.echem_dpi)
+            future.path = path
+            futures.append(future)
+        return futures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render heatmaps and echem figures for all .secmdata files in a folder.')
+    parser.add_argument('folder', help='Folder of .secmdata files')
+    parser.add_argument('-o', '--out', default=None,
+                        help='Output folder (default: <folder>/export)')
+    parser.add_argument('-q', '--quantities', nargs='*', default=['max'],
+                        help='Heatmap quantities: max, avg, z, val_at:<V>, '
+                        'val_at_t:<t>, or "<analysis function>:<input>"')
+    parser.add_argument('-e', '--echem', nargs='*', default=[],
+                        choices=IV_views + EIS_views,
+                        help='Per-pixel echem figures to save')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--dpi', type=int, default=300, help='Heatmap dpi')
+    parser.add_argument('--echem-dpi', type=int, default=100)
+    parser.add_argument('--cmap', default='viridis')
+    args = parser.parse_args(argv)
+
+    exporter = BatchExporter(args.quantities, args.echem, args.dpi,
+                             args.echem_dpi, args.cmap, args.workers)
+    exporter.export_folder(args.folder, args.out)
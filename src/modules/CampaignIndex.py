@@ -0,0 +1,271 @@
+'''
+SQLite index of a campaign: all the .secmdata files in one folder, i.e.
+name_001.secmdata, name_002.secmdata, ... from multi hopping mode.
+
+The index is a sidecar file, <folder>/campaign_index.sqlite. For each
+experiment it keeps the file's metadata and settings, and for each pixel its
+location, scalar results (max, avg, z, and every cached analysis result, see
+Experiment.get_pixel_table()), and the file offsets of its raw traces.
+Pixels can then be queried across the whole campaign without unpickling
+every experiment, and single traces read straight from the files.
+
+    index = CampaignIndex('D:/SECM/Data/campaign')
+    index.update(quantities=['E0 finder'])
+    rows  = index.query('E0 finder', 0.2, 0.3)
+    t, V, I = index.get_trace(*rows[0][:3])
+'''
+import json
+import os
+import sqlite3
+import numpy as np
+
+from .DataStorage import (load_from_file, iter_datapoints, read_trace_table,
+                          read_trace)
+
+
+DB_NAME = 'campaign_index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS experiments (
+    id        INTEGER PRIMARY KEY,
+    path      TEXT UNIQUE,
+    mtime     REAL,
+    size      INTEGER,
+    timestamp TEXT,
+    expt_type TEXT,
+    length    REAL,
+    n_rows    INTEGER,
+    n_cols    INTEGER,
+    settings  TEXT
+);
+CREATE TABLE IF NOT EXISTS pixels (
+    expt_id INTEGER, i INTEGER, j INTEGER,
+    x REAL, y REAL, z REAL,
+    PRIMARY KEY (expt_id, i, j)
+);
+CREATE TABLE IF NOT EXISTS results (
+    expt_id INTEGER, i INTEGER, j INTEGER,
+    name TEXT, value REAL
+);
+CREATE TABLE IF NOT EXISTS traces (
+    expt_id INTEGER, i INTEGER, j INTEGER, k INTEGER, row_idx INTEGER,
+    type TEXT, byte_offset INTEGER, length INTEGER, dtype TEXT
+);
+CREATE TABLE IF NOT EXISTS quantities (
+    expt_id INTEGER, name TEXT, quantity TEXT,
+    PRIMARY KEY (expt_id, name)
+);
+CREATE INDEX IF NOT EXISTS results_by_value ON results (name, value);
+CREATE INDEX IF NOT EXISTS traces_by_pixel ON traces (expt_id, i, j, k);
+'''
+
+
+def result_name(quantity):
+    '''
+    Column name used for a heatmap quantity (see BatchExporter.parse_quantity)
+    i.e. 'E0 finder' -> 'E0_finder_analysis()', 'max' -> 'max'
+    '''
+    from .BatchExporter import parse_quantity
+    from ..analysis.analysis_funcs import get_functions
+    name, arg = parse_quantity(quantity)
+    functions = get_functions()
+    if name in functions:
+        return f'{functions[name][0].__name__}({arg})'
+    return name
+
+
+
+class CampaignIndex():
+
+    def __init__(self, folder, db_name=DB_NAME):
+        self.folder = folder
+        self.db = sqlite3.connect(os.path.join(folder, db_name))
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def update(self, quantities=()):
+        '''
+        Index every .secmdata file in the folder which is new, has changed
+        since it was last indexed, or was indexed without one of quantities.
+
+        quantities: analysis functions to run on new files before indexing,
+                    as in BatchExporter, i.e. ['E0 finder', 'CV decay:1']
+        '''
+        names = {result_name(quantity) for quantity in quantities}
+        n = 0
+        for fname in sorted(os.listdir(self.folder)):
+            if not fname.endswith('.secmdata'):
+                continue
+            path = os.path.join(self.folder, fname)
+            stat = os.stat(path)
+            row = self.db.execute(
+                'SELECT id, mtime, size FROM experiments WHERE path = ?',
+                (fname,)).fetchone()
+            if (row is not None and row[1:] == (stat.st_mtime, stat.st_size)
+                and names <= self.get_quantities(row[0])):
+                continue
+            # Keep the quantities it was indexed with before
+            previous = self.get_quantities(row[0], strings=True) if row else []
+            try:
+                self.add_file(path, quantities=sorted(set(quantities) | 
+                                                      set(previous)))
+                n += 1
+            except Exception as e:
+                print(f'Error indexing {fname}: {e}')
+        return n
+
+
+    def add_file(self, path, expt=None, quantities=()):
+        '''
+        (Re)index one file. Pass expt if it is already loaded, i.e. right
+        after saving it.
+        '''
+        from .BatchExporter import get_heatmap_data
+        if expt is None:
+            expt = load_from_file(path, mmap=True)
+        for quantity in quantities:
+            get_heatmap_data(expt, quantity)
+
+        fname = os.path.relpath(path, self.folder)
+        stat  = os.stat(path)
+        with open(path, 'rb') as f:
+            table, _, data_start = read_trace_table(f)
+
+        with self.db:
+            self.remove(fname)
+            settings = getattr(expt, 'settings', None)
+            cur = self.db.execute(
+                '''INSERT INTO experiments (path, mtime, size, timestamp,
+                   expt_type, length, n_rows, n_cols, settings)
+                   VALUES (?,?,?,?,?,?,?,?,?)''',
+                (fname, stat.st_mtime, stat.st_size,
+                 getattr(expt, 'timestamp', None),
+                 getattr(expt, 'expt_type', None),
+                 float(getattr(expt, 'length', 0)), *expt.data.shape,
+                 json.dumps(settings) if settings else None))
+            expt_id = cur.lastrowid
+
+            pixels  = expt.get_pixel_table()
+            i, j    = pixels.pop('i'), pixels.pop('j')
+            x, y, z = pixels.pop('x'), pixels.pop('y'), pixels['z']
+            self.db.executemany('INSERT INTO pixels VALUES (?,?,?,?,?,?)',
+                zip([expt_id]*len(i), i.tolist(), j.tolist(),
+                    x.tolist(), y.tolist(), z.tolist()))
+            # Record what was computed, even if a quantity had no valid
+            # values, so update() doesn't compute it again
+            names = {name: None for name in pixels}
+            names.update({result_name(q): q for q in quantities})
+            self.db.executemany('INSERT INTO quantities VALUES (?,?,?)',
+                                [(expt_id, *item) for item in names.items()])
+            for name, vals in pixels.items():
+                valid = np.isfinite(vals)
+                self.db.executemany('INSERT INTO results VALUES (?,?,?,?,?)',
+                    zip([expt_id]*valid.sum(), i[valid].tolist(),
+                        j[valid].tolist(), [name]*valid.sum(),
+                        vals[valid].tolist()))
+
+            # Version 1 (pickle-only) files have no trace offsets
+            if table is not None:
+                types = {key: str(pt) for key, pt in iter_datapoints(expt)}
+                self.db.executemany(
+                    'INSERT INTO traces VALUES (?,?,?,?,?,?,?,?,?)',
+                    [(expt_id, i, j, k, r, types.get((i, j, k)),
+                      data_start + offset, length, dtype)
+                     for (i, j, k, r), (offset, length, dtype)
+                     in table.items()])
+        return expt_id
+
+
+    def remove(self, fname):
+        row = self.db.execute('SELECT id FROM experiments WHERE path = ?',
+                              (fname,)).fetchone()
+        if row is None:
+            return
+        for table in ('experiments', 'pixels', 'results', 'traces', 
+                      'quantities'):
+            col = 'id' if table == 'experiments' else 'expt_id'
+            self.db.execute(f'DELETE FROM {table} WHERE {col} = ?', row)
+
+
+    def get_quantities(self, expt_id, strings=False):
+        '''
+        Set of result names the experiment was indexed with
+        
+        strings: instead return the quantities that were passed to
+                 add_file, as in BatchExporter, i.e. ['E0 finder']
+        '''
+        if strings:
+            return [q for q, in self.db.execute(
+                '''SELECT quantity FROM quantities 
+                   WHERE expt_id = ? AND quantity IS NOT NULL''', 
+                (expt_id,))]
+        return {name for name, in self.db.execute(
+                    'SELECT name FROM quantities WHERE expt_id = ?', 
+                    (expt_id,))}
+    
+    
+    def query(self, quantity, min_val=None, max_val=None, path=None):
+        '''
+        Returns list of (path, i, j, x, y, z, value) for every pixel in the
+        campaign with min_val <= quantity <= max_val.
+
+        quantity: 'max', 'avg', 'z', or analysis function as in
+                  BatchExporter, i.e. 'E0 finder' or 'CV decay:1'
+        path: only search this file
+        '''
+        sql = '''SELECT e.path, r.i, r.j, p.x, p.y, p.z, r.value
+                 FROM results r
+                 JOIN experiments e ON e.id = r.expt_id
+                 JOIN pixels p ON p.expt_id = r.expt_id
+                                  AND p.i = r.i AND p.j = r.j
+                 WHERE r.name = ?'''
+        args = [result_name(quantity)]
+        if min_val is not None:
+            sql += ' AND r.value >= ?'
+            args.append(min_val)
+        if max_val is not None:
+            sql += ' AND r.value <= ?'
+            args.append(max_val)
+        if path is not None:
+            sql += ' AND e.path = ?'
+            args.append(path)
+        return self.db.execute(sql + ' ORDER BY e.path, r.i, r.j',
+                               args).fetchall()
+
+
+    def get_experiments(self):
+        '''
+        Returns list of dicts of the indexed experiments' metadata
+        '''
+        cur  = self.db.execute('SELECT * FROM experiments ORDER BY path')
+        cols = [c[0] for c in cur.description]
+        rows = [dict(zip(cols, row)) for row in cur.fetchall()]
+        for row in rows:
+            if row['settings']:
+                row['settings'] = json.loads(row['settings'])
+        return rows
+
+
+    def get_trace(self, path, i, j, k=0):
+        '''
+        Returns data (i.e. [t, V, I]) of the DataPoint at (i, j), k-th
+        point of a PointsList, read from its offsets in the file
+        '''
+        rows = self.db.execute(
+            '''SELECT t.row_idx, t.byte_offset, t.length, t.dtype
+               FROM traces t JOIN experiments e ON e.id = t.expt_id
+               WHERE e.path = ? AND t.i = ? AND t.j = ? AND t.k = ?
+               ORDER BY t.row_idx''', (path, i, j, k)).fetchall()
+        if len(rows) == 0:
+            # No offsets (version 1 file), load the whole file
+            expt = load_from_file(os.path.join(self.folder, path))
+            pts  = dict(iter_datapoints(expt))
+            return pts[(i, j, k)].data
+        table = {(i, j, k, r): (offset, length, dtype)
+                 for r, offset, length, dtype in rows}
+        with open(os.path.join(self.folder, path), 'rb') as f:
+            return read_trace(f, table, 0, (i, j, k))
@@ -1,16 +1,122 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from io import StringIO
+from io import BytesIO, StringIO
+import csv
 import os
 import pickle
+import threading
 import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+from ..utils.decimation import MinMaxDecimator, TracePyramid
+from ..utils.spectral import bin_indices, rfft_bins
+
+
+# Guards Experiment.changed, which is filled by the measurement thread
+# and emptied by the GUI thread
+_changed_lock = threading.Lock()
+
+# Keeps ADCDataPoint.data and its decimator in step between the ADC
+# polling thread and the GUI thread
+_ADC_lock = threading.Lock()
+
+# (class name, attribute) of saved attributes DataPoint.__setstate__ has 
+# dropped, so each is only reported once
+_dropped_attrs = set()
 
 
 def nearest(arr, val):
-    diff = abs(np.array(arr) - val)
-    idx = np.where(diff == min(diff))[0][0]
+    # First index of the element of arr closest to val
+    idx = np.abs(np.asarray(arr) - val).argmin()
     return idx, arr[idx]
 
 
+def first_crossing(x, y, level, negative=False):
+    '''
+    Returns x at the first sample where y reaches level (y <= level if
+    negative, else y >= level), linearly interpolated from the previous sample.
+    
+    x, y can be 2D arrays of shape (n_traces, n_samples), then each row is
+    evaluated independently. level and negative can be given per row.
+    
+    Returns (x_cross, found). If y never reaches level, x_cross is the last
+    x of that row and found is False.
+    '''
+    x        = np.asarray(x, dtype=float)
+    y        = np.asarray(y, dtype=float)
+    level    = np.asarray(level, dtype=float)[..., None]
+    negative = np.asarray(negative)[..., None]
+    
+    mask  = np.where(negative, y <= level, y >= level)
+    idx   = np.argmax(mask, axis=-1)[..., None]
+    found = np.take_along_axis(mask, idx, axis=-1)
+    idx   = np.where(found, idx, y.shape[-1] - 1)
+    prev  = np.maximum(idx - 1, 0)
+    
+    x0, x1 = [np.take_along_axis(x, i, axis=-1) for i in (prev, idx)]
+    y0, y1 = [np.take_along_axis(y, i, axis=-1) for i in (prev, idx)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = (level - y0)/(y1 - y0)
+    frac = np.where(found & (idx > 0) & np.isfinite(frac), frac, 1.0)
+    
+    x_cross = x0 + frac*(x1 - x0)
+    return x_cross[..., 0], found[..., 0]
+
+
+def current_at_potential(V, I, V0):
+    '''
+    Returns I where V first passes through V0 (i.e. in the first sweep),
+    interpolated between samples. If V never reaches V0, returns I at the
+    V closest to V0. V, I can be 2D arrays of shape (n_traces, n_samples).
+    '''
+    V = np.asarray(V, dtype=float)
+    I = np.asarray(I, dtype=float)
+    I_cross, found = first_crossing(I, V, V0, negative=(V[..., 0] > V0))
+    if not np.all(found):
+        closest = np.argmin(np.abs(V - V0), axis=-1)[..., None]
+        I_near  = np.take_along_axis(I, closest, axis=-1)[..., 0]
+        I_cross = np.where(found, I_cross, I_near)
+    return I_cross
+
+
+def write_table(path, columns, header=None, delimiter=',', mode='a'):
+    '''
+    Write columns of numbers as delimited text. Numbers are formatted by
+    numpy for the whole array at once (same output as str(float)) and
+    written with a single call, instead of one f-string per row.
+    '''
+    columns = [np.asarray(col).astype(str).tolist() for col in columns]
+    with open(path, mode) as f:
+        if header:
+            f.write(header + '\n')
+        if len(columns) > 0 and len(columns[0]) > 0:
+            f.write('\n'.join(map(delimiter.join, zip(*columns))))
+            f.write('\n')
+
+
+def _write_points(tasks):
+    # Worker process for Experiment.save_to_folder. 
+    # tasks: list of (path, loc, table) with table from DataPoint.get_table()
+    for path, loc, table in tasks:
+        write_loc_header(path, loc)
+        write_table(path, *table)
+    return len(tasks)
+
+
+def write_loc_header(path, loc):
+    with open(path, 'w') as f:
+        x, y, z = loc
+        f.write(f'xyz (um):\n')
+        f.write(f'{x:0.3f}\t{y:0.3f}\t{z:0.3f}\n')
+
+
 def get_xy_coords(length, n_pts):
         # Generate ordered list of xy coordinates for a scan
         # ----->
@@ -52,6 +158,15 @@ class Experiment:
     what type of electrochemical data that point represents. 
     '''
     
+    # Incremented by set_datapoint(). Class default covers old pickles
+    version = 0
+    
+    # dtype CV data is compacted to when it is set, see set_compact()
+    compact_dtype = None
+    
+    # .secmdata format written by save(), see FILE FORMAT below. 1 is read
+    # by every version of this program, 2 is opt-in (GUI Settings menu)
+    file_version = 1
     
     def __init__(self, points:list=list(), order:list=list(),                 
                  expt_type='', path='D:/SECM/temp/temp.secmdata'):
@@ -72,6 +187,17 @@ class Experiment:
         return self.saved
     
     
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_trace_store', None)
+        state.pop('_arena', None)
+        state.pop('_mapped', None)
+        state.pop('_mapped_path', None)
+        # Pixels waiting for a heatmap redraw belong to this session only
+        state.pop('changed', None)
+        return state
+    
+    
     def save(self, path=None):
         if not path:
             path = self.path
@@ -79,9 +205,30 @@ class Experiment:
         if not path.endswith('.secmdata'):
             path += '.secmdata'
                 
-        with open(path, 'wb') as f:
-            # json.dump(d, f)
-            pickle.dump(self, f)
+        # Memory-mapped data has to be copied out of the file before it 
+        # can be replaced
+        mapped_path = getattr(self, '_mapped_path', None)
+        if (mapped_path is not None and 
+            os.path.abspath(mapped_path) == os.path.abspath(path)):
+            self.unmap_traces()
+        
+        # Lazily loaded traces can only be read back from a version 2 file
+        store = getattr(self, '_trace_store', None)
+        same_file = (store is not None and 
+                     os.path.abspath(store.path) == os.path.abspath(path))
+        if same_file and self.file_version < 2:
+            self.load_traces()
+        
+        # Write to a temporary file first, lazily loaded traces may still
+        # be read from the file being overwritten
+        with open(path + '.tmp', 'wb') as f:
+            if self.file_version >= 2:
+                write_secmdata(self, f)
+            else:
+                pickle.dump(self, f)
+        os.replace(path + '.tmp', path)
+        if same_file and self.file_version >= 2:
+            store.reload()
         if not path.endswith('temp.secmdata'):
             print(f'Saved as {path}')
             self.saved = True
@@ -91,6 +238,20 @@ class Experiment:
         self.settings = settings
     
     
+    def load_traces(self):
+        '''
+        Read the data of every lazily loaded DataPoint (see 
+        load_from_file(lazy=True)) into memory
+        '''
+        if getattr(self, '_trace_store', None) is None:
+            return
+        for _, pt in iter_datapoints(self):
+            if getattr(pt, '_store', None) is not None:
+                pt.data   = pt.data
+                pt._store = None
+        self._trace_store = None
+    
+    
     def setup_blank(self, points, order):
         if len(points) == 0:
             points, order = get_xy_coords(length=10, n_pts=10)
@@ -133,7 +294,37 @@ class Experiment:
     def set_datapoint(self, grid_ids, point):
         i, j = grid_ids[0], grid_ids[1]
         self.data[j][i] = point  # TODO: heatmap axes are messed up?
+        if self.compact_dtype is not None:
+            pts = point.data if isinstance(point, PointsList) else [point]
+            for pt in pts:
+                if isinstance(pt, CVDataPoint):
+                    pt.compact(self.compact_dtype)
         self.saved = False
+        self._arena = None
+        self.mark_changed((j, i))
+    
+    
+    def mark_changed(self, idx):
+        '''
+        Record that the DataPoint at self.data[idx] was replaced so the
+        heatmap only has to redraw that pixel
+        '''
+        with _changed_lock:
+            if getattr(self, 'changed', None) is None:
+                self.changed = set()
+            self.changed.add(idx)
+            self.version += 1
+    
+    
+    def pop_changed(self):
+        '''
+        Returns set of (row, col) indices into self.data which changed since
+        the last call, and clears it
+        '''
+        with _changed_lock:
+            changed = getattr(self, 'changed', None) or set()
+            self.changed = set()
+        return changed
         
         
     def get_data(self):
@@ -149,12 +340,94 @@ class Experiment:
         datatype: string, specifies what data to return
         arg: string or float to accompany datatype
         '''
+        if datatype == 'val_at':
+            return self._get_val_at(arg)
+        if datatype == 'Z_at':
+            freqs, Z = self.get_Z_tensor()
+            if len(freqs) == 0:
+                return np.zeros(self.data.shape)
+            idx, _ = nearest(freqs, arg)
+            return np.nan_to_num(np.abs(Z[:, :, 0, idx]))
         gridpts = np.array([
             [d.get_val(datatype, arg) for d in row]
             for row in self.data]         
             )
         return gridpts
     
+    def get_Z_tensor(self):
+        '''
+        Returns (freqs, Z), with the impedance of every EIS spectrum in the
+        map in one complex array of shape (rows, cols, repeats, freqs). 
+        Repeats are the EISDataPoints in a pixel's PointsList. Pixels with 
+        fewer spectra, or spectra at other frequencies, are NaN.
+        
+        Kept as self.Z_tensor (saved with the file) until a point changes.
+        '''
+        cached = getattr(self, 'Z_tensor', None)
+        if cached is not None and cached[0] == self.version:
+            return cached[1:]
+        
+        spectra = {}
+        for (i, j, _), pt in iter_datapoints(self):
+            if isinstance(pt, EISDataPoint):
+                spectra.setdefault((i, j), []).append(pt.data)
+        
+        freqs = np.zeros(0)
+        if spectra:
+            freqs = np.asarray(next(iter(spectra.values()))[0][0])
+        n_repeats = max([len(s) for s in spectra.values()], default=0)
+        Z = np.full((*self.data.shape, n_repeats, len(freqs)), np.nan, 
+                    dtype=complex)
+        for (i, j), pts in spectra.items():
+            for k, (f, _, _, Zk) in enumerate(pts):
+                if len(f) == len(freqs) and np.allclose(f, freqs):
+                    Z[i, j, k] = Zk
+        
+        self.Z_tensor = (self.version, freqs, Z)
+        return freqs, Z
+    
+    
+    def _get_val_at(self, V0):
+        '''
+        Same as get_heatmap_data('val_at', V0), but evaluates all CVs with
+        the same number of points together as one 2D array. CVs in the
+        TraceArena (see pack_traces()) are used in place, without copying.
+        '''
+        if not V0:
+            V0 = 0
+        vals = np.zeros(self.data.shape, dtype=object)
+        done = set()
+        arena = getattr(self, '_arena', None)
+        if arena is not None:
+            keys, V = arena.get_rows('CVDataPoint', 1)
+            _,    I = arena.get_rows('CVDataPoint', 2)
+            if isinstance(V, np.ndarray) and isinstance(I, np.ndarray):
+                # Only the first point of a PointsList is shown
+                rows = [n for n, key in enumerate(keys) if key[2] == 0]
+                if len(rows) < len(keys):
+                    V, I = V[rows], I[rows]
+                for n, val in zip(rows, current_at_potential(V, I, V0)):
+                    vals[keys[n][:2]] = val
+                    done.add(keys[n][:2])
+        
+        by_length = {}
+        for (i, j), d in np.ndenumerate(self.data):
+            if (i, j) in done:
+                continue
+            pt = d[0] if isinstance(d, PointsList) else d
+            if not isinstance(pt, CVDataPoint):
+                vals[i,j] = d.get_val('val_at', V0)
+                continue
+            by_length.setdefault(len(pt.data[1]), []).append(((i,j), pt))
+        
+        for length, pts in by_length.items():
+            idxs, pts = zip(*pts)
+            V = np.array([pt.data[1] for pt in pts], dtype=float)
+            I = np.array([pt.data[2] for pt in pts], dtype=float)
+            for idx, val in zip(idxs, current_at_potential(V, I, V0)):
+                vals[idx] = val
+        return np.array(vals.tolist())
+    
     def get_loc_data(self):
         gridpts = np.array([
             [(float(d.loc[0]), float(d.loc[1])) for d in row]
@@ -201,29 +474,57 @@ class Experiment:
         
         analysis_func: function to apply to each point
         args: arguments to pass to analysis_func
+        
+        If analysis_func has an attribute analysis_func.prepare, it is first
+        called as prepare(DataPoints, *args) with every point to be analyzed,
+        so any shared work can be done in one batch.
+        
+        For PointsLists, the first point of type analysis_func.point_type
+        (default CVDataPoint) is analyzed.
         '''
-        for i, row in enumerate(self.data):
-            for j, pt in enumerate(row):
+        point_type = getattr(analysis_func, 'point_type', CVDataPoint)
+        if hasattr(analysis_func, 'prepare'):
+            targets = []
+            for pt in self.data.flatten():
                 if isinstance(pt, PointsList):
-                    for k, subpt in enumerate(pt.data):
-                        if isinstance(subpt, CVDataPoint):
-                            pt.data[k] = analysis_func(subpt, *args)
-                            break
-                    if not hasattr(pt, 'analysis'):
-                        pt.analysis = {}
-                    pt.analysis[(analysis_func, *args)] = pt.data[k].analysis[(analysis_func, *args)]
-                    self.data[i][j] = pt
-                else:
-                    self.data[i][j] = analysis_func(pt, *args)
-                    
+                    pt = next((subpt for subpt in pt.data 
+                               if isinstance(subpt, point_type)), None)
+                if pt is not None:
+                    targets.append(pt)
+            analysis_func.prepare(targets, *args)
+        
         gridpts = np.array([
-            [pt.analysis[(analysis_func, *args)] for pt in row]
-            for row in self.data]         
+            [self.analyze_point((i, j), analysis_func, *args) 
+             for j in range(len(row))]
+            for i, row in enumerate(self.data)]         
             )
         
         return gridpts
     
     
+    def analyze_point(self, idx, analysis_func, *args):
+        '''
+        Runs analysis_func on the DataPoint at self.data[idx] and returns
+        the result. For a PointsList, analyzes its first point of type
+        analysis_func.point_type (default CVDataPoint).
+        '''
+        i, j = idx
+        pt = self.data[i][j]
+        point_type = getattr(analysis_func, 'point_type', CVDataPoint)
+        if isinstance(pt, PointsList):
+            for k, subpt in enumerate(pt.data):
+                if isinstance(subpt, point_type):
+                    pt.data[k] = analysis_func(subpt, *args)
+                    break
+            if not hasattr(pt, 'analysis'):
+                pt.analysis = {}
+            pt.analysis[(analysis_func, *args)] = pt.data[k].analysis[(analysis_func, *args)]
+            self.data[i][j] = pt
+        else:
+            self.data[i][j] = analysis_func(pt, *args)
+        return self.data[i][j].analysis[(analysis_func, *args)]
+    
+    
     def max_points_per_loc(self):
         '''
         Checks all DataPoints in this experiment. Returns the length of
@@ -238,29 +539,352 @@ class Experiment:
         return longest
     
     
-    def save_to_folder(self, path):
+    def get_pixel_table(self, extra=None):
+        '''
+        Returns dict of {column name: 1D array} with one row per pixel: grid
+        indices, x/y/z location, max and avg current, and every analysis 
+        result cached on the DataPoints, named <function name>(<args>).
+        Pixels without a given analysis result are NaN.
+        
+        extra: dict of {column name: 2D grid} to add, i.e. the heatmap 
+               currently displayed
+        '''
+        i, j = np.indices(self.data.shape)
+        points = self.data.flatten()
+        locs = np.array([pt.loc[:2] for pt in points], dtype=float)
+        table = {
+            'i': i.flatten(),
+            'j': j.flatten(),
+            'x': locs[:,0],
+            'y': locs[:,1],
+            'z': np.array(self.get_heatmap_data('z'), dtype=float).flatten(),
+            'max': np.array(self.get_heatmap_data('max'), dtype=float).flatten(),
+            'avg': np.array(self.get_heatmap_data('avg'), dtype=float).flatten(),
+            }
+        
+        for name, grid in (extra or {}).items():
+            if np.shape(grid) == self.data.shape:
+                table[name] = np.array(grid, dtype=float).flatten()
+        
+        for n, pt in enumerate(points):
+            for (func, *args), val in getattr(pt, 'analysis', {}).items():
+                name = f'{func.__name__}({",".join(str(a) for a in args)})'
+                if name not in table:
+                    table[name] = np.full(len(points), np.nan)
+                try:
+                    table[name][n] = val
+                except (TypeError, ValueError):
+                    pass
+        return table
+    
+    
+    def export_pixel_table(self, path, extra=None):
+        '''
+        Save get_pixel_table() as .csv, .npz, or .parquet (needs pandas
+        and pyarrow), chosen by the file extension
+        '''
+        table = self.get_pixel_table(extra)
+        if path.endswith('.npz'):
+            np.savez(path, **table)
+        elif path.endswith('.parquet'):
+            if pd is None:
+                print('Error: pandas is required to save .parquet files')
+                return
+            pd.DataFrame(table).to_parquet(path)
+        else:
+            # Names like func(a,b) contain commas, so quote the header
+            header = StringIO()
+            csv.writer(header, lineterminator='').writerow(table.keys())
+            write_table(path, list(table.values()), header.getvalue(),
+                        mode='w')
+        print(f'Saved as {path}')
+    
+    
+    def save_to_folder(self, path, fmt='asc', n_workers=None):
         '''
         Export all data to the specified path
+        
+        fmt: 'asc': one text file per DataPoint, <i>_<j>_<type><k>.asc. Files
+                    are formatted and written in parallel worker processes
+             'npz': all DataPoints in one file, <path>/<folder name>.npz
+             'h5':  same as 'npz' but HDF5, if h5py is installed
+        n_workers: number of processes for 'asc', default os.cpu_count()
         '''
         os.makedirs(path, exist_ok = True)
+        points = self.get_export_points()
+        
+        if fmt in ('npz', 'h5'):
+            name = os.path.basename(os.path.normpath(path))
+            return self.save_consolidated(os.path.join(path, f'{name}.{fmt}'),
+                                          points)
+        
+        tasks = [(os.path.join(path, f'{name}.asc'), pt.loc, pt.get_table())
+                 for name, pt in points]
+        tasks = [task for task in tasks if task[2] is not None]
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        
+        # Starting processes takes ~1 s, not worth it for a few points
+        if n_workers == 1 or len(tasks) < 50:
+            return _write_points(tasks)
+        
+        chunk = max(1, min(100, len(tasks)//(4*n_workers)))
+        with ProcessPoolExecutor(n_workers) as pool:
+            n = sum(pool.map(_write_points, 
+                             [tasks[i:i+chunk] 
+                              for i in range(0, len(tasks), chunk)]))
+        return n
+    
+    
+    def set_compact(self, dtype=np.float32):
+        '''
+        Compact every CV now and each one set from now on (see compact()).
+        dtype = None stops compacting new CVs, compacted ones are kept.
+        '''
+        self.compact_dtype = dtype
+        if dtype is not None:
+            self.compact(dtype)
+    
+    
+    def compact(self, dtype=np.float32, implicit_t=True):
+        '''
+        Store every CV's data as a CompactTrace to reduce memory use. 
+        Lazily loaded CVs are skipped. Returns number of bytes saved.
+        '''
+        saved = 0
+        for _, pt in iter_datapoints(self):
+            if isinstance(pt, CVDataPoint) and hasattr(pt, '_data'):
+                saved += pt.compact(dtype, implicit_t)
+        self._arena = None
+        return saved
+    
+    
+    def pack_traces(self):
+        '''
+        Move all DataPoint data into a TraceArena, one contiguous buffer per
+        DataPoint type and row. Returns the arena, also kept as self._arena
+        until a DataPoint is replaced.
+        '''
+        self._arena = TraceArena.pack(self)
+        return self._arena
+    
+    
+    def unmap_traces(self):
+        '''
+        Copy all data still memory-mapped from the file this Experiment was
+        loaded from (load_from_file(mmap=True)) into memory, i.e. so the 
+        file can be replaced. Includes points replaced since loading, and
+        ADC data, which TraceArena.pack() leaves alone.
+        '''
+        mapped = getattr(self, '_mapped', None)
+        if mapped is None:
+            return
+        
+        def copy(arr):
+            if (isinstance(arr, np.ndarray) and 
+                np.may_share_memory(arr, mapped)):
+                return np.array(arr)
+            return arr
+        
+        for _, pt in iter_datapoints(self):
+            data = getattr(pt, '_data', None)
+            if isinstance(data, CompactTrace):
+                data.rows = copy(data.rows)
+                data.t    = copy(data.t)
+            elif isinstance(data, (list, tuple)):
+                pt.data = [copy(row) for row in data]
+        
+        arena = getattr(self, '_arena', None)
+        if arena is not None and arena.path is not None:
+            self._arena = None
+        self._mapped      = None
+        self._mapped_path = None
+    
+    
+    def get_arena(self):
+        # TraceArena of this Experiment, packed if it doesn't have one
+        if getattr(self, '_arena', None) is None:
+            return self.pack_traces()
+        return self._arena
+    
+    
+    def get_export_points(self):
+        '''
+        Returns list of (name, DataPoint) for every DataPoint with data.
+        PointsLists are expanded, name is <i>_<j>_<type><k>
+        '''
+        points = []
         for j, row in enumerate(self.data):
             for i, pt in enumerate(row):
-                if isinstance(pt, SinglePoint): 
-                    continue
-                if isinstance(pt, PointsList):
-                    for point in pt.points:
-                        fname = os.path.join(path, 
-                                             f'{i:02}_{j:02}_{str(pt)}.asc')
-                        pt.save(path=fname)
-                    continue
-                fname = os.path.join(path, f'{i:02}_{j:02}_{str(pt)}.asc')
-                pt.save(path=fname)
+                pts = pt.data if isinstance(pt, PointsList) else [pt]
+                for k, point in enumerate(pts):
+                    if isinstance(point, SinglePoint):
+                        continue
+                    points.append((f'{i:02}_{j:02}_{str(point)}{k}', point))
+        return points
+    
+    
+    def save_consolidated(self, path, points=None):
+        '''
+        Save every DataPoint's table to one .npz or .h5 file. Each point
+        is stored as <name> (2D array, one column per table column) and 
+        <name>_loc. Column names are stored as <name>_columns.
+        '''
+        if points is None:
+            points = self.get_export_points()
+        
+        if path.endswith('.h5') and h5py is None:
+            print('h5py is not installed, saving as .npz instead')
+            path = path[:-3] + '.npz'
+        
+        arrays = {'length': np.array(self.length)}
+        for name, pt in points:
+            table = pt.get_table()
+            if table is None:
+                continue
+            columns, header, delimiter = table
+            arrays[name] = np.column_stack([np.asarray(col, dtype=float) 
+                                            for col in columns])
+            arrays[f'{name}_loc'] = np.array(pt.loc, dtype=float)
+            arrays[f'{name}_columns'] = np.array(header.split(delimiter))
+        
+        if path.endswith('.h5'):
+            with h5py.File(path, 'w') as f:
+                for key, arr in arrays.items():
+                    if arr.dtype.kind == 'U':
+                        arr = arr.astype('S')
+                    f.create_dataset(key, data=arr)
+        else:
+            np.savez(path, **arrays)
+        print(f'Saved as {path}')
+        return len(points)
     
   
     
+def _nbytes(data):
+    # Approximate memory used by DataPoint.data
+    if isinstance(data, CompactTrace):
+        return data.nbytes
+    try:
+        # Lists of Python floats: 8 byte pointer + 24 byte float object each
+        return sum(row.nbytes if isinstance(row, np.ndarray) else 32*len(row)
+                   for row in data)
+    except TypeError:
+        return 0
+
+
+
+class CompactTrace():
+    '''
+    [t, V, I] data stored as one contiguous (2, n) array of V and I with a 
+    smaller dtype. Evenly spaced t is not stored, it is regenerated from 
+    t0 + dt*i when needed.
+    
+    Indexes and unpacks like the [t, V, I] list it replaces:
+        t, V, I = trace
+        I = trace[2]
+    '''
+    __slots__ = ('rows', 't', 't0', 'dt')
+    
+    def __init__(self, rows, t=None, t0=0.0, dt=0.0):
+        self.rows = rows  # (2, n) array of V, I
+        self.t    = t     # float64 array, or None for implicit t
+        self.t0   = t0
+        self.dt   = dt
+    
+    
+    @classmethod
+    def from_data(cls, data, dtype=np.float32, implicit_t=True):
+        # Returns None if data is not [t, V, I] of equal lengths
+        try:
+            t, V, I = (np.asarray(row) for row in data)
+            rows = np.array([V, I], dtype=dtype)
+        except ValueError:
+            return None
+        if rows.ndim != 2 or len(t) != rows.shape[1]:
+            return None
+        
+        t = t.astype(float)
+        n = len(t)
+        if implicit_t and n > 1:
+            t0 = float(t[0])
+            dt = float(t[-1] - t[0])/(n - 1)
+            if np.allclose(t, t0 + dt*np.arange(n), rtol=0, 
+                           atol=abs(dt)*1e-3):
+                return cls(rows, t0=t0, dt=dt)
+        return cls(rows, t=t)
+    
+    
+    def __len__(self):
+        return 3
+    
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(3)[i]]
+        if i in (0, -3):
+            if self.t is not None:
+                return self.t
+            return self.t0 + self.dt*np.arange(self.rows.shape[1])
+        if i in (1, 2, -2, -1):
+            return self.rows[i if i < 0 else i - 1]
+        raise IndexError('CompactTrace index out of range')
+    
+    
+    def __iter__(self):
+        return (self[i] for i in range(3))
+    
+    
+    def index_of(self, time):
+        '''
+        Index of the first sample at or after time, without building the
+        full t array for implicit t (see TracePyramid.get_window)
+        '''
+        n = self.rows.shape[1]
+        if self.t is not None:
+            return int(np.searchsorted(self.t, time))
+        if self.dt <= 0:
+            return 0 if time <= self.t0 else n
+        # Tolerance so a time on a sample doesn't round up past it
+        i = np.ceil((time - self.t0)/self.dt - 1e-6)
+        return int(np.clip(i, 0, n))
+    
+    
+    def get_slice(self, i0, i1):
+        # [t, V, I] of samples i0 to i1
+        if self.t is not None:
+            t = self.t[i0:i1]
+        else:
+            t = self.t0 + self.dt*np.arange(*slice(i0, i1).indices(
+                                                    self.rows.shape[1]))
+        return [t, self.rows[0, i0:i1], self.rows[1, i0:i1]]
+    
+    
+    def __reduce__(self):
+        return (CompactTrace, (self.rows, self.t, self.t0, self.dt))
+    
+    
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + (self.t.nbytes if self.t is not None else 0)
+    
+    
+  
 # Base DataPoint class
 class DataPoint:
     # Data from a single SECM pixel
+    
+    # No per-instance __dict__, a map can hold 10^4+ of these. Attributes
+    # set by analysis functions (analysis, artists, features) need a slot.
+    __slots__ = ('loc', '_data', 'gain', 'version', 'analysis', 'artists',
+                 'features', 'decimator', 'pyramid', '_compact', 
+                 '_store', '_key', '_scalars')
+    
+    # Values of unset slots, i.e. for old pickles. version is incremented
+    # whenever self.data changes, so plots can check for new data without
+    # scanning it.
+    _defaults = {'version': 0, 'gain': 1}
+    
     def __init__(self, loc: tuple, data):
         self.loc      = loc
         # self.data accepted types:
@@ -278,6 +902,69 @@ class DataPoint:
     def __str__(self):
         return 'DataPoint'
     
+    
+    @property
+    def data(self):
+        try:
+            return self._data
+        except AttributeError:
+            # Points from load_from_file(lazy=True) read their data from 
+            # the file on demand
+            return self._store.get(self._key)
+    
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+    
+    
+    @data.deleter
+    def data(self):
+        del self._data
+    
+    
+    def __getattr__(self, name):
+        # Only called for attributes not set on the instance
+        if name in self._defaults:
+            return self._defaults[name]
+        raise AttributeError(name)
+    
+    
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                try:
+                    state[attr] = object.__getattribute__(self, attr)
+                except AttributeError:
+                    pass
+        # Don't pickle derived data (i.e. CV features), it gets recomputed
+        for attr in ('features', 'decimator', 'pyramid', 'impedance', 
+                     '_store', '_key', '_scalars'):
+            state.pop(attr, None)
+        # Saved as 'data', as before slots
+        state['data'] = state.pop('_data') if '_data' in state else self.data
+        return state
+    
+    
+    def __setstate__(self, state):
+        state = dict(state)
+        if 'data' in state:
+            state['_data'] = state.pop('data')
+        for attr, val in state.items():
+            try:
+                setattr(self, attr, val)
+            except AttributeError:
+                # Attribute of an older version without a slot
+                key = (type(self).__name__, attr)
+                if key not in _dropped_attrs:
+                    _dropped_attrs.add(key)
+                    print(f'Warning: {key[0]}.{attr} in file is not used '
+                          f'anymore, it was not loaded')
+        compact = state.get('_compact')
+        if compact is not None and isinstance(state.get('_data'), list):
+            self.compact(*compact)
+    
         
     def get_val(self, datatype='max', arg=None):
         # Return requested value (for heatmap display)
@@ -290,40 +977,87 @@ class DataPoint:
         # Return all data
         return self.data  
     
+    def get_features(self):
+        # Dict of data derived by analysis functions (i.e. CV features).
+        # Emptied when self.data changes (version is incremented)
+        version  = getattr(self, 'version', 0)
+        features = getattr(self, 'features', None)
+        if features is None or features.get('version') != version:
+            self.features = features = {'version': version}
+        return features
+    
+    def get_pyramid(self):
+        # Multi-resolution summary of [t, V, I] data. Built on first use,
+        # then only extended with samples appended since (ADCDataPoints).
+        # Not pickled, it is rebuilt from the data after loading.
+        pyramid = getattr(self, 'pyramid', None)
+        n = min(len(l) for l in self.data)
+        if pyramid is None or pyramid.n_samples > n:
+            pyramid = TracePyramid()
+            self.pyramid = pyramid
+        if pyramid.n_samples < n:
+            i0 = pyramid.n_samples
+            pyramid.append(*[l[i0:n] for l in self.data])
+        return pyramid
+    
+    def get_window(self, t_start=None, t_end=None, n_pixels=1000):
+        '''
+        Returns [t, V, I] to draw between t_start and t_end (default: all
+        data) at n_pixels resolution, from the pyramid level which matches it
+        '''
+        return self.get_pyramid().get_window(self.data, t_start, t_end,
+                                             n_pixels)
+    
     def save(self, path):
         # Write contents of self to given path
-        with open(path, 'w') as f:
-            x, y, z = self.loc
-            f.write(f'xyz (um):\n')
-            f.write(f'{x:0.3f}\t{y:0.3f}\t{z:0.3f}\n')
+        write_loc_header(path, self.loc)
         self._save(path)
     
     def _save(self, path):
+        table = self.get_table()
+        if table is not None:
+            write_table(path, *table)
+    
+    def get_table(self):
+        # Data to export as (columns, header, delimiter), or None
         # Overwrite in subclasses
-        pass
+        return None
             
 
 
 class ADCDataPoint(DataPoint):
     
+    # impedance: spectral.StreamingImpedance, set by ADC.polling() while
+    # an EIS measurement is running
+    __slots__ = ('impedance',)
+    
     def __str__(self):
         return 'ADCDataPoint'
     
     def append_data(self, t, V, I):
-        try:
-            self.data[0].extend(t)
-            self.data[1].extend(V)
-            self.data[2].extend(I)
-        except TypeError: #passed floats instead of lists
-            self.data[0].append(t)
-            self.data[1].append(V)
-            self.data[2].append(I)
+        with _ADC_lock:
+            if not all(isinstance(l, list) for l in self.data):
+                # Traces loaded from a file are arrays, CompactTraces, or 
+                # views of the file. Copy them back into lists to append to
+                self.data = [np.asarray(l).tolist() for l in self.data]
+                self._compact = None
+            try:
+                self.data[0].extend(t)
+                self.data[1].extend(V)
+                self.data[2].extend(I)
+            except TypeError: #passed floats instead of lists
+                self.data[0].append(t)
+                self.data[1].append(V)
+                self.data[2].append(I)
+            if getattr(self, 'decimator', None) is not None:
+                self.decimator.append(t, V, I)
+            if getattr(self, 'impedance', None) is not None:
+                self.impedance.append(t, V, I)
+            self.version += 1
         return     
     
-    def _save(self, path):
-        with open(path, 'w') as f:
-            for t, V, I in zip(self.data[0], self.data[1], self.data[2]):
-                f.write(f'{t},{V},{I}\n')
+    def get_table(self):
+        return self.data, 't/s,V/V,I/V', ','
 
     def get_data(self, n=None, downsample=False, downsample_freq = 100):
         '''
@@ -335,6 +1069,38 @@ class ADCDataPoint(DataPoint):
             return self.downsample(downsample_freq)
         return self.data
 
+    def get_decimated(self, n_pixels=1000):
+        '''
+        Returns [t, V, I] reduced to their min/max envelope over n_pixels
+        columns. The envelope is kept up to date by append_data() after
+        the first call, so this doesn't depend on the recording length
+        '''
+        n_pixels = max(int(n_pixels), 1)
+        with _ADC_lock:
+            decimator = getattr(self, 'decimator', None)
+            if decimator is None or decimator.n_buckets != n_pixels:
+                decimator = MinMaxDecimator(n_pixels)
+                n = min(len(l) for l in self.data)
+                decimator.append(*[l[:n] for l in self.data])
+                self.decimator = decimator
+        return decimator.get_data()
+    
+    def get_window(self, *args, **kwargs):
+        with _ADC_lock:
+            return super().get_window(*args, **kwargs)
+    
+    def get_impedance(self):
+        '''
+        Returns (freqs, Z) of the EIS measurement being recorded, from the 
+        fundamental periods completed so far. None if there is none. 
+        Z is in units of the ADC channels (see Plotter.scale_ADC)
+        '''
+        with _ADC_lock:
+            impedance = getattr(self, 'impedance', None)
+            if impedance is None:
+                return None
+            return impedance.get_Z()
+
     def set_HEKA_gain(self, gain):
         self.gain = gain
         
@@ -349,6 +1115,9 @@ class ADCDataPoint(DataPoint):
                                         len(self.data[1])
                                         )
                             )
+        self.decimator = None
+        self.pyramid   = None
+        self.version += 1
     
     def downsample(self, downsample_freq):
         t, V, I = self.data.copy()
@@ -377,6 +1146,8 @@ class ADCDataPoint(DataPoint):
 
 class SinglePoint(DataPoint):
     
+    __slots__ = ()
+    
     def __str__(self):
         return 'SinglePoint'
     
@@ -388,18 +1159,65 @@ class SinglePoint(DataPoint):
     def get_data(self, *args, **kwargs):
         return [],[],[]
     
-    def _save(self, path):
+    def get_table(self):
         # Don't save data of this type 
         # (used as placeholder in scanning grid)
-        pass
+        return None
 
 
 
 class CVDataPoint(DataPoint):   
+    
+    __slots__ = ('CV_params',)
+    
+    # CV_params default for CVs saved before this was recorded
+    _defaults = {**DataPoint._defaults, 'CV_params': None}
+    
+    def __init__(self, loc: tuple, data, CV_params=None):
+        super().__init__(loc, data)
+        # Values from HekaIO.generate_CV_params(), indexed 0-7 (its dict,
+        # or a list in the same order)
+        self.CV_params = CV_params
           
     def __str__(self):
         return 'CVDataPoint'  
     
+    def compact(self, dtype=np.float32, implicit_t=True):
+        '''
+        Store data as a CompactTrace: V and I as dtype, and t as t0 + dt*i 
+        if implicit_t and it is evenly spaced. get_data() and get_val() 
+        work the same. Kept when saved and loaded again. 
+        Returns number of bytes saved.
+        '''
+        if isinstance(self._data, CompactTrace):
+            return 0
+        trace = CompactTrace.from_data(self._data, dtype, implicit_t)
+        if trace is None:
+            return 0
+        saved = _nbytes(self._data) - trace.nbytes
+        self._data    = trace
+        self._compact = (np.dtype(dtype).str, implicit_t)
+        self.version += 1
+        return saved
+    
+    def __getstate__(self):
+        state = super().__getstate__()
+        # Saved so the heatmap can be drawn from a lazily loaded file
+        # without reading every trace
+        state['_scalars'] = self._get_scalars()
+        return state
+    
+    def _get_scalars(self):
+        # Max and avg I, computed once per version of the data
+        scalars = getattr(self, '_scalars', None)
+        if scalars is None or scalars.get('version') != self.version:
+            I = np.asarray(self.data[2], dtype=float)
+            scalars = {'version': self.version,
+                       'max': float(np.max(I)) if I.size else 0.0,
+                       'avg': float(np.mean(I)) if I.size else 0.0}
+            self._scalars = scalars
+        return scalars
+    
     def get_val(self, datatype='max', arg=None):
         '''
         valtype: str, defines what to return
@@ -413,34 +1231,16 @@ class CVDataPoint(DataPoint):
             if type(self.loc[2]) == tuple:
                 return self.loc[2][0]
             return self.loc[2]
-        if datatype=='max':
-            return max(self.data[2])
+        if datatype in ('max', 'avg'):
+            # Lazily loaded points use the values saved with the file
+            return self._get_scalars()[datatype]
         if datatype=='loc':
             return self.loc[0] + self.loc[1]
-        if datatype == 'avg':
-            return np.mean(self.data[2])
         if datatype == 'val_at':
             # Return value from first, forward sweep
-            
-            idx    = 0
-            delta  = 1e6
-            deltas = []
-            # TODO: make this faster?
             if not arg:
                 arg = 0
-            for i, v in enumerate(self.data[1]):
-                deltas.append(abs(v - arg))
-                if abs(v - arg) < delta:
-                    # Getting closer
-                    idx = i
-                    delta = abs(v - arg)
-                    continue
-                if len(deltas) < 5:
-                    continue
-                if all([deltas[-1] > deltas[j] for j in [-2,-3,-4,-5,-6]]):
-                    # Getting farther away from value. Return what we have
-                    return self.data[2][idx]
-            return self.data[2][idx]
+            return float(current_at_potential(self.data[1], self.data[2], arg))
         if datatype == 'val_at_t':
             idx, _ = nearest(self.data[0], arg)
             return self.data[2][idx]
@@ -448,22 +1248,26 @@ class CVDataPoint(DataPoint):
     def get_data(self, *args, **kwargs):
         return self.data
     
-    def _save(self, path):
-        with open(path, 'a') as f:
-            f.write('t/s,E/V,I/A\n')
-            for t, V, I in zip(self.data[0], self.data[1], self.data[2]):
-                f.write(f'{t},{V},{I}\n')
+    def get_table(self):
+        return self.data, 't/s,E/V,I/A', ','
     
 
     
 class EISDataPoint(DataPoint):    
+    
+    __slots__ = ('applied_freqs', 'corrections')
+    
     def __init__(self, loc: tuple, data:list, applied_freqs:list,
-                 corrections: list=None, input_FT_data=False):
+                 corrections: list=None, input_FT_data=False, transform=True):
+        '''
+        transform: False to keep data as [t, V, I], i.e. to transform 
+                   several points at once with batch_FT()
+        '''
         self.loc      = loc
         self.data     = data
         self.applied_freqs = applied_freqs     # Recorded by HekaWriter
         self.corrections   = corrections       # Recorded by HekaWriter
-        if not input_FT_data:
+        if transform and not input_FT_data:
             self.FT() # do the Fourier transform
         
     def __str__(self):
@@ -471,26 +1275,11 @@ class EISDataPoint(DataPoint):
     
         
     def FT(self):
-        t, V, I = self.data
-        srate = 1/np.mean(np.diff(t))
-        
-        # Fourier transform
-        freqs = srate*np.fft.rfftfreq(len(V))[1:]
-        ft_V  = np.fft.rfft(V)[1:]
-        ft_I  = np.fft.rfft(I)[1:]
-        
-        if self.applied_freqs is not None:
-            idxs = []
-            for f in self.applied_freqs:
-                idx, _ = nearest(freqs, f)
-                idxs.append(idx)
-        else:
-            idxs = [i for i, v in enumerate(abs(ft_V)) if v > 0.5]
-        
-        # Remove all frequencies not in perturbation signal
-        freqs = freqs[idxs]
-        ft_V  = ft_V[idxs]
-        ft_I  = ft_I[idxs]
+        batch_FT([self])
+    
+    
+    def set_spectrum(self, freqs, ft_V, ft_I):
+        # Called by batch_FT() with the transformed data
         Z = ft_V/ft_I
         
         if self.corrections is not None:
@@ -509,6 +1298,7 @@ class EISDataPoint(DataPoint):
         
         # Re-save as self.data
         self.data = [freqs, ft_V, ft_I, Z]
+        self.version += 1
         
     def get_val(self, datatype='max', arg=None):
         if datatype == 'z':
@@ -516,16 +1306,60 @@ class EISDataPoint(DataPoint):
         if datatype == 'val_at':
             idx, _ = nearest(self.data[0], arg)
             return abs(self.data[1][idx])
+        if datatype == 'Z_at':
+            idx, _ = nearest(self.data[0], arg)
+            return abs(self.data[3][idx])
         else:
             return 0
         
     
         
-    def _save(self, path):
-        with open(path, 'a') as f:
-            f.write("<Frequency>\t<Re(Z)>\t<Im(Z)>\n")
-            for freq, Z in zip(self.data[0], self.data[3]):
-                f.write(f'{freq}\t{np.real(Z)}\t{np.imag(Z)}\n')
+    def get_table(self):
+        freqs, Z = self.data[0], self.data[3]
+        return ([freqs, np.real(Z), np.imag(Z)], 
+                '<Frequency>\t<Re(Z)>\t<Im(Z)>', '\t')
+        
+
+
+def batch_FT(points):
+    '''
+    Fourier transform the [t, V, I] data of EISDataPoints. Records with the
+    same length and frequency bins (i.e. the repeats of a 'CV then 5x EIS' 
+    pixel, or a whole map) are stacked and go through one rFFT, with V and 
+    I together.
+    '''
+    groups = {}
+    for pt in points:
+        t, V, I = pt.data
+        srate = 1/np.mean(np.diff(t))
+        n     = len(V)
+        if pt.applied_freqs is not None:
+            idxs = bin_indices(pt.applied_freqs, n, srate)
+            key  = (n, idxs.tobytes())
+        else:
+            idxs = None
+            key  = (n, None)
+        groups.setdefault(key, []).append((pt, srate, idxs))
+    
+    for (n, _), group in groups.items():
+        pts, srates, idxs = zip(*group)
+        x = np.array([[pt.data[1], pt.data[2]] for pt in pts], dtype=float)
+        
+        if idxs[0] is not None:
+            # Applied frequencies fall on known bins, only transform those
+            ft = rfft_bins(x, idxs[0])
+            for pt, srate, (ft_V, ft_I) in zip(pts, srates, ft):
+                pt.set_spectrum(idxs[0]*srate/n, ft_V, ft_I)
+            continue
+        
+        # Fourier transform
+        ft = np.fft.rfft(x)[..., 1:]
+        for pt, srate, (ft_V, ft_I) in zip(pts, srates, ft):
+            freqs = srate*np.fft.rfftfreq(n)[1:]
+            
+            # Remove all frequencies not in perturbation signal
+            keep = np.abs(ft_V) > 0.5
+            pt.set_spectrum(freqs[keep], ft_V[keep], ft_I[keep])
         
 
 class PointsList():
@@ -536,6 +1370,8 @@ class PointsList():
     object. By default, returns the appropriate value from the first DataPoint
     in the PointsList.
     '''
+    version = 0
+    
     def __init__(self, loc:tuple, data:list):
         '''
         data: list of DataPoint type objects
@@ -547,7 +1383,7 @@ class PointsList():
         try:
             return self.data[i]
         except IndexError:
-            print(f'Invalid index: no {i}-th point. This spot has {len(self.points)} data points')
+            print(f'Invalid index: no {i}-th point. This spot has {len(self.data)} data points')
         except:
             print(f'Invalid index: {i}')
         return self.data[0]
@@ -557,10 +1393,17 @@ class PointsList():
         
     def add_point(self, DataPoint):
         self.data.append(DataPoint)
+        self.version += 1
         
     
     ### DataPoint method overwrites ###
     def get_val(self, datatype='max', arg=None, idx=0):
+        if datatype == 'Z_at':
+            # First EIS spectrum, the first point is usually a CV
+            for pt in self.data:
+                if isinstance(pt, EISDataPoint):
+                    return pt.get_val(datatype, arg)
+            return 0
         return self[idx].get_val(datatype, arg)
     
     def get_data(self, idx=0,  *args, **kwargs):
@@ -575,10 +1418,367 @@ class PointsList():
 
 
 
-def load_from_file(path):
+########      .secmdata FILE FORMAT      ########
+#
+# Version 1 files are just a pickled Experiment. This is still the 
+# default (Experiment.file_version), so files can be opened by older
+# versions of this program. Version 2 files are
+#   SECMDATA_MAGIC
+#   format version, 4 byte little-endian unsigned int
+#   header length, 8 byte little-endian unsigned int
+#   header: pickled trace table {(i, j, k, row): (offset, length, dtype)}
+#           then the pickled Experiment, with the data of its DataPoints
+#           stored as references into the trace table
+#   trace arrays as raw bytes. Offsets count from the end of the header,
+#   which is padded so the arrays start at a multiple of 64 bytes. Arrays
+#   are grouped by (DataPoint type, row, dtype), each group is one 
+#   contiguous block (see TraceArena).
+# Single traces can be read from the offsets without unpickling anything
+# but the table (see read_trace_table, read_trace).
+#
+# Migrating: load_from_file() reads both versions. Files are converted
+# when they are saved again, to whichever version file_version is set to.
+# Older versions of this program can only open version 1 files, and
+# load_from_file() refuses versions newer than SECMDATA_VERSION.
+
+SECMDATA_MAGIC   = b'SECMDATA'
+SECMDATA_VERSION = 2
+
+
+def iter_datapoints(expt):
+    '''
+    Yields ((i, j, k), DataPoint) for every DataPoint in expt.data. 
+    k is the index in a PointsList, 0 otherwise.
+    '''
+    for (i, j), pt in np.ndenumerate(expt.data):
+        pts = pt.data if isinstance(pt, PointsList) else [pt]
+        for k, point in enumerate(pts):
+            yield (i, j, k), point
+
+
+def _trace_rows(data):
+    # DataPoint.data as a list of 1D numeric arrays, or None if it isn't
+    # a list of numeric sequences (i.e. SinglePoint's float)
+    if isinstance(data, CompactTrace):
+        data = list(data)
+    if not isinstance(data, (list, tuple)) or len(data) == 0:
+        return None
+    rows = []
+    for row in data:
+        if row is None:
+            return None
+        arr = np.asarray(row)
+        if arr.ndim != 1 or arr.dtype.kind not in 'biufc':
+            return None
+        rows.append(np.ascontiguousarray(arr))
+    return rows
+
+
+class _TracePickler(pickle.Pickler):
+    # Stores DataPoint.data lists by reference to the trace table
+    def __init__(self, file, keys):
+        super().__init__(file)
+        self.keys = keys  # {id(DataPoint.data): (i, j, k)}
+    
+    def persistent_id(self, obj):
+        return self.keys.get(id(obj))
+
+
+class _TraceUnpickler(pickle.Unpickler):
+    def __init__(self, file, load_trace):
+        super().__init__(file)
+        self.load_trace = load_trace
+    
+    def persistent_load(self, key):
+        return self.load_trace(key)
+
+
+def write_secmdata(expt, f):
+    '''
+    Write expt to open binary file f in the format described above
+    '''
+    table, groups, keys = {}, {}, {}
+    keep = []  # Lazily loaded data may be read again while pickling. Keep
+               # these alive so their ids can't be reused by other objects
+    for key, pt in iter_datapoints(expt):
+        data = getattr(pt, 'data', None)
+        rows = _trace_rows(data)
+        if rows is None:
+            continue
+        keep.append(data)
+        keys[id(data)] = key
+        for r, arr in enumerate(rows):
+            group = (str(pt), r, arr.dtype.str)
+            groups.setdefault(group, []).append(((*key, r), arr))
+    
+    arrays = []
+    offset = 0
+    for group, items in groups.items():
+        pad = -offset % 16
+        arrays.append(bytes(pad))
+        offset += pad
+        for key, arr in items:
+            table[key] = (offset, len(arr), arr.dtype.str)
+            arrays.append(arr)
+            offset += arr.nbytes
+    
+    header = BytesIO()
+    pickle.dump(table, header)
+    _TracePickler(header, keys).dump(expt)
+    header = header.getvalue()
+    header += bytes(-(len(SECMDATA_MAGIC) + 12 + len(header)) % 64)
+    
+    f.write(SECMDATA_MAGIC)
+    f.write(SECMDATA_VERSION.to_bytes(4, 'little'))
+    f.write(len(header).to_bytes(8, 'little'))
+    f.write(header)
+    for arr in arrays:
+        f.write(arr)
+
+
+def read_trace_table(f):
+    '''
+    Returns (table, header_start, data_start) for an open .secmdata file, 
+    or (None, 0, 0) if it is a version 1 (pickle-only) file
+    '''
+    f.seek(0)
+    if f.read(len(SECMDATA_MAGIC)) != SECMDATA_MAGIC:
+        return None, 0, 0
+    version = int.from_bytes(f.read(4), 'little')
+    if version > SECMDATA_VERSION:
+        raise ValueError(f'{getattr(f, "name", "File")} is a version '
+                         f'{version} .secmdata file, this program reads up '
+                         f'to version {SECMDATA_VERSION}')
+    n = int.from_bytes(f.read(8), 'little')
+    header_start = f.tell()
+    table = pickle.load(f)
+    return table, header_start, header_start + n
+
+
+def read_trace(f, table, data_start, key):
+    '''
+    Returns DataPoint.data at key = (i, j, k) as a list of arrays
+    '''
+    rows = []
+    r = 0
+    while (*key, r) in table:
+        offset, length, dtype = table[(*key, r)]
+        f.seek(data_start + offset)
+        rows.append(np.fromfile(f, dtype=np.dtype(dtype), count=length))
+        r += 1
+    return rows
+
+
+def _map_trace(mapped, table, key):
+    # DataPoint.data at key = (i, j, k) as views into the memory-mapped 
+    # data section of a file
+    rows = []
+    r = 0
+    while (*key, r) in table:
+        offset, length, dtype = table[(*key, r)]
+        dtype = np.dtype(dtype)
+        rows.append(mapped[offset:offset + length*dtype.itemsize].view(dtype))
+        r += 1
+    return rows
+
+
+
+class TraceArena():
+    '''
+    DataPoint data packed into one contiguous 1D buffer per (DataPoint type,
+    row, dtype), i.e. the currents of every CV in one array. The 
+    DataPoints' data are views into these buffers, so all traces of a type
+    can be analyzed together without copying (see get_rows()).
+    
+    Made by Experiment.pack_traces() from data in memory, or by 
+    load_from_file(path, mmap=True), which maps the buffers from the file.
+    Views stay valid until the DataPoint's data is replaced.
+    '''
+    def __init__(self, path=None):
+        self.path    = path  # File the buffers are mapped from, or None
+        self.buffers = {}    # {(type, row, dtype): 1D array}
+        self.index   = {}    # {(type, row, dtype): [((i, j, k), start, length)]}
+    
+    
+    @classmethod
+    def pack(cls, expt):
+        # Copies the data of every DataPoint in expt into new buffers
+        arena  = cls()
+        groups = {}
+        points = []
+        for key, pt in iter_datapoints(expt):
+            # ADC data is appended to while recording, CompactTraces are 
+            # already packed
+            if (isinstance(pt, ADCDataPoint) or 
+                isinstance(getattr(pt, '_data', None), CompactTrace)):
+                continue
+            rows = _trace_rows(getattr(pt, 'data', None))
+            if rows is None:
+                continue
+            points.append((key, pt, len(rows)))
+            for r, arr in enumerate(rows):
+                groups.setdefault((str(pt), r, arr.dtype.str), []).append(
+                    (key, arr))
+        
+        views = {}
+        for group, items in groups.items():
+            buffer  = np.concatenate([arr for _, arr in items])
+            entries = []
+            start   = 0
+            for key, arr in items:
+                entries.append((key, start, len(arr)))
+                views[(*key, group[1])] = buffer[start:start + len(arr)]
+                start += len(arr)
+            arena.buffers[group] = buffer
+            arena.index[group]   = entries
+        
+        for key, pt, n_rows in points:
+            pt.data = [views[(*key, r)] for r in range(n_rows)]
+        return arena
+    
+    
+    @classmethod
+    def from_map(cls, path, expt, mapped, table):
+        # Arena of a file's memory-mapped data section. write_secmdata()
+        # writes each group as one contiguous block
+        types  = {key: str(pt) for key, pt in iter_datapoints(expt)}
+        groups = {}
+        for (i, j, k, r), (offset, length, dtype) in table.items():
+            group = (types.get((i, j, k)), r, dtype)
+            groups.setdefault(group, []).append(((i, j, k), offset, length))
+        
+        arena = cls(path)
+        for group, items in groups.items():
+            items.sort(key=lambda item: item[1])
+            itemsize = np.dtype(group[2]).itemsize
+            start = items[0][1]
+            end   = items[-1][1] + items[-1][2]*itemsize
+            arena.buffers[group] = mapped[start:end].view(group[2])
+            arena.index[group]   = [(key, (offset - start)//itemsize, length)
+                                    for key, offset, length in items]
+        return arena
+    
+    
+    def get_rows(self, pt_type='CVDataPoint', row=2):
+        '''
+        Returns (keys, rows) for every trace of this DataPoint type in the
+        arena. keys are (i, j, k) as in iter_datapoints(). rows is a 2D
+        view of the buffer, (n_traces, length), if all traces have the same
+        length, otherwise a list of 1D views.
+        '''
+        for (t, r, dtype), buffer in self.buffers.items():
+            if (t, r) != (pt_type, row):
+                continue
+            entries = self.index[(t, r, dtype)]
+            keys    = [key for key, _, _ in entries]
+            if len({length for _, _, length in entries}) == 1:
+                return keys, buffer.reshape(len(entries), -1)
+            return keys, [buffer[start:start + length] 
+                          for _, start, length in entries]
+        return [], []
+    
+    
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+
+
+class TraceStore():
+    '''
+    Reads DataPoint data from a .secmdata file on demand, for points loaded 
+    with load_from_file(lazy=True). Recently used data is kept in an LRU 
+    cache of at most max_bytes.
+    '''
+    def __init__(self, path, max_bytes=1e9):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.cache     = OrderedDict()  # {(i, j, k): data}
+        self.nbytes    = 0
+        self._lock     = threading.Lock()
+        self.reload()
+    
+    
+    def reload(self):
+        # Re-read the trace table, i.e. after the file was saved again. 
+        # Cached data is still valid, only the offsets change
+        with self._lock, open(self.path, 'rb') as f:
+            self.table, _, self.data_start = read_trace_table(f)
+    
+    
+    def get(self, key):
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            
+            # Not opened for longer than needed, so the file can be replaced
+            with open(self.path, 'rb') as f:
+                data = read_trace(f, self.table, self.data_start, key)
+            self.cache[key] = data
+            self.nbytes += sum(row.nbytes for row in data)
+            while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.nbytes -= sum(row.nbytes for row in old)
+            return data
+
+
+
+class _LazyTrace():
+    # Placeholder for DataPoint.data while unpickling a lazy Experiment
+    def __init__(self, key):
+        self.key = key
+
+
+def load_from_file(path, lazy=False, max_bytes=1e9, mmap=False):
+    '''
+    Load an Experiment from a .secmdata file.
+    
+    lazy: only load the grid, locations, and cached values (max, avg, 
+          analysis results). Each DataPoint's data is read from the file 
+          when it is first used, and kept in an LRU cache of at most 
+          max_bytes. 
+    mmap: memory-map the file's data section instead of reading it. Each
+          DataPoint's data is a (copy-on-write) view into the mapping, and
+          expt.get_arena() returns a TraceArena over it.
+    Version 1 (pickle-only) files are always loaded completely.
+    '''
     with open(path, 'rb') as f:
-        expt = pickle.load(f)
-        return expt
+        table, header_start, data_start = read_trace_table(f)
+        if table is None:
+            f.seek(0)
+            expt = pickle.load(f)
+            return expt
+        # Unpickle the header from memory so traces can be read from f
+        f.seek(header_start)
+        header = BytesIO(f.read(data_start - header_start))
+        pickle.load(header)  # Trace table, already read
+        mapped = None
+        if mmap and os.path.getsize(path) > data_start:
+            mapped = np.memmap(path, np.uint8, 'c', offset=data_start)
+            load = lambda key: _map_trace(mapped, table, key)
+        elif lazy:
+            load = _LazyTrace
+        else:
+            load = lambda key: read_trace(f, table, data_start, key)
+        expt = _TraceUnpickler(header, load).load()
+    
+    if mapped is not None:
+        expt._arena = TraceArena.from_map(path, expt, mapped, table)
+        # Kept separately from the arena, which is dropped when a point 
+        # changes. See Experiment.unmap_traces()
+        expt._mapped      = mapped
+        expt._mapped_path = path
+    elif lazy:
+        store = TraceStore(path, max_bytes)
+        for _, pt in iter_datapoints(expt):
+            trace = getattr(pt, '_data', None)
+            if isinstance(trace, _LazyTrace):
+                del pt.data
+                pt._store = store
+                pt._key   = trace.key
+        expt._trace_store = store
+    return expt
     #     d = json.load(f)
     # return Experiment(data=d['data'], length=d['length'])
 
@@ -7,7 +7,7 @@ import datetime
 from functools import partial
 from ..utils.utils import run, Logger
 from .DataStorage import (Experiment, CVDataPoint, EISDataPoint,
-                                 PointsList)
+                                 PointsList, batch_FT)
 from ..analysis.analysis_funcs import E0_finder_analysis
 
 
@@ -424,7 +424,6 @@ class FeedbackController(Logger):
                 # Fake data if in test mode
                 data = CVDataPoint(loc=(x,y,80), data=([0,1],[0,1],[0,1]))
                 expt.set_datapoint( (order[i]), data)
-                self.master.Plotter.update_heatmap()
                 expt.save()
                 continue
             
@@ -467,11 +466,9 @@ class FeedbackController(Logger):
             
             # Save data
             grid_i, grid_j = order[i]  
+            # Plotter.update_figs() draws the new pixel on its next tick
             expt.set_datapoint( (grid_i, grid_j), data)
             
-            # Send data for plotting
-            self.master.Plotter.update_heatmap()
-            
             expt.save()
             time.sleep(0.01)
             
@@ -549,7 +546,8 @@ class FeedbackController(Logger):
                 return 'failed'
             if type(t) == int:
                 return None
-            data = CVDataPoint(loc = loc, data = [t, voltage, current])
+            data = CVDataPoint(loc = loc, data = [t, voltage, current],
+                               CV_params = self.HekaWriter.CV_params)
         
         
         if expt_type == 'EIS':
@@ -584,7 +582,8 @@ class FeedbackController(Logger):
                 return 'failed'
             if type(t) == int:
                 return None
-            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current])
+            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current],
+                                 CV_params=self.HekaWriter.CV_params)
             
             # Check for peak detection
             CVdata = E0_finder_analysis(CVdata, '')
@@ -630,7 +629,8 @@ class FeedbackController(Logger):
                 return 'failed'
             if type(t) == int:
                 return None
-            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current])
+            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current],
+                                 CV_params=self.HekaWriter.CV_params)
             
             # Check for peak detection
             CVdata = E0_finder_analysis(CVdata, '')
@@ -644,8 +644,13 @@ class FeedbackController(Logger):
             self.master.GUI.params['EIS']['E0'].delete('1.0', 'end')
             self.master.GUI.params['EIS']['E0'].insert('1.0', f'{E0*1000:0.1f}')
             EIS_POINTS = []
+            amps = [10.0, 20.0, 50.0, 100.0, 200.0]
+            # Waveforms are cached, so this only synthesizes at the 1st pixel
+            _, f0, f1, n_pts, n_cycles, _ = self.master.GUI.get_EIS_params()
+            self.HekaWriter.pregenerate_EIS_waveforms(f0, f1, n_pts, 
+                                                      n_cycles, amps)
             # Run 5 EIS spectra with varying Vpp
-            for mVpp in [10, 20, 50, 100, 200]:
+            for mVpp in amps:
                 self.log(f'Running EIS with amplitude = {mVpp} mV')
                 self.master.GUI.params['EIS']['amp'].delete('1.0', 'end')
                 self.master.GUI.params['EIS']['amp'].insert('1.0', f'{mVpp}')
@@ -662,7 +667,8 @@ class FeedbackController(Logger):
                     return None
                 EISdata = EISDataPoint(loc = loc, data = [t, voltage, current],
                                    applied_freqs = self.HekaWriter.EIS_applied_freqs,
-                                   corrections = self.HekaWriter.EIS_corrections)
+                                   corrections = self.HekaWriter.EIS_corrections,
+                                   transform = False)
                 EIS_POINTS.append(EISdata)
                 
             self.HekaWriter.reset_amplifier()
@@ -672,6 +678,8 @@ class FeedbackController(Logger):
             self.HekaWriter.send_command(f'Set E Vhold {start_V}')
             time.sleep(2)
             
+            # Transform all spectra together
+            batch_FT(EIS_POINTS)
             data = PointsList(loc=loc, data = [CVdata, *EIS_POINTS])
         
             
@@ -685,7 +693,8 @@ class FeedbackController(Logger):
                 return 'failed'
             if type(t) == int:
                 return None
-            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current])
+            CVdata = CVDataPoint(loc=loc, data=[t,voltage,current],
+                                 CV_params=self.HekaWriter.CV_params)
             
             # Check for peak detection
             CVdata = E0_finder_analysis(CVdata, '')
@@ -717,7 +726,8 @@ class FeedbackController(Logger):
                     return None
                 EISdata = EISDataPoint(loc = loc, data = [t, voltage, current],
                                    applied_freqs = self.HekaWriter.EIS_applied_freqs,
-                                   corrections = self.HekaWriter.EIS_corrections)
+                                   corrections = self.HekaWriter.EIS_corrections,
+                                   transform = False)
                 EIS_POINTS.append(EISdata)
                 self.potentiostat_setup('EIS')
                 time.sleep(10)
@@ -729,6 +739,8 @@ class FeedbackController(Logger):
             self.HekaWriter.send_command(f'Set E Vhold {start_V}')
             time.sleep(2)
             
+            # Transform all spectra together
+            batch_FT(EIS_POINTS)
             data = PointsList(loc=loc, data = [CVdata, *EIS_POINTS])
     
         return data
@@ -769,9 +781,14 @@ class FeedbackController(Logger):
         
         if save_path.endswith('.secmdata'):
             save_path = save_path.replace('.secmdata', '')
-            
-        path = self.master.HekaWriter.run_measurement_loop(
-            'EIS', save_path = save_path, name=name)
+        
+        # Show impedance from the ADC data while the spectrum is recorded
+        self.master.ADC.EIS_freqs = self.master.HekaWriter.EIS_applied_freqs
+        try:
+            path = self.master.HekaWriter.run_measurement_loop(
+                'EIS', save_path = save_path, name=name)
+        finally:
+            self.master.ADC.EIS_freqs = None
         
         t, v, i = read_heka_data(path)
         return t, v, i
@@ -2,13 +2,14 @@ import time
 import os
 import psutil
 import shutil
-import json
 import numpy as np
 from tkinter import messagebox
 from .FeedbackController import read_heka_data
 from .DataStorage import EISDataPoint
 from ..utils.utils import run, Logger
-from ..utils.EIS_util import generate_tpl, get_EIS_sample_rate
+from ..utils.EIS_util import WaveformCache, get_EIS_sample_rate
+from ..utils.EIS_corrections import (get_store, settings_key, 
+                                     OLD_CORRECTIONS_FILE)
 from functools import partial
 
 
@@ -17,6 +18,8 @@ output_file = r'C:/ProgramData/HEKA/com/E9Batch.Out'
 
 DEFAULT_SAVE_PATH = r'D:/SECM/Data'
 
+EIS_GAIN = 14  # 50 mV/pA
+
 gl_st = time.time()
      
 
@@ -150,6 +153,7 @@ class HekaWriter(Logger):
         self.EIS_params = None
         self.EIS_WF_params = None
         self.EIS_corrections = None
+        self.waveform_cache = WaveformCache()
         
     
         
@@ -408,12 +412,21 @@ class HekaWriter(Logger):
         
         self.running()
         
-        cmds = get_filters(max(f0, f1))         # Set filters based on max frequency
+        EIS_WF_params = {'E0':E0, 'f0':f0, 'f1':f1, 'n_pts':n_pts, 
+                         'n_cycles': n_cycles, 'amp':amp}
+        new_waveform  = ((EIS_WF_params != self.EIS_WF_params) or 
+                         force_waveform_rewrite)
+        if new_waveform:
+            self.EIS_applied_freqs = self.make_EIS_waveform(E0, f0, f1, n_pts, n_cycles, amp,
+                                                            force=force_waveform_rewrite)
+        
+        # Set filters based on max applied frequency
+        cmds = get_filters(max(self.EIS_applied_freqs))
         cmds.append('Set E StimFilter 0')       # Set stim filter to 2 us
         cmds.append('Set E TestDacToStim1 2')   # Turn on external input for Stim-1
         cmds.append('Set E ExtScale 1')         # Set external scale to 1
         cmds.append('Set E Mode 3')
-        cmds.append('Set E Gain 14')            # Switch to 50mV/pA gain
+        cmds.append(f'Set E Gain {EIS_GAIN}')   # Switch to 50mV/pA gain
         self.send_multiple_cmds(cmds)
         time.sleep(0.1)
         
@@ -425,11 +438,7 @@ class HekaWriter(Logger):
         self.EIS_params   = values
         self.EIS_duration = duration
         
-        EIS_WF_params = {'E0':E0, 'f0':f0, 'f1':f1, 'n_pts':n_pts, 
-                         'n_cycles': n_cycles, 'amp':amp}
-        
-        if (EIS_WF_params != self.EIS_WF_params) or force_waveform_rewrite:
-            self.EIS_applied_freqs = self.make_EIS_waveform(E0, f0, f1, n_pts, n_cycles, amp)
+        if new_waveform:
             self.check_EIS_corrections(EIS_WF_params, forced=force_waveform_rewrite)
         
         self.EIS_WF_params = EIS_WF_params
@@ -438,47 +447,48 @@ class HekaWriter(Logger):
         return
     
     
-    def make_EIS_waveform(self, E0, f0, f1, n_pts, n_cycles, amp):
-        sample_rate = get_EIS_sample_rate(max(f0, f1))
+    def make_EIS_waveform(self, E0, f0, f1, n_pts, n_cycles, amp, force=False):
+        # Waveform doesn't depend on E0, so only generate it if it's new
+        path, applied_freqs = self.waveform_cache.get(f0, f1, n_pts, 
+                                                      n_cycles, amp, force)
+        sample_rate = get_EIS_sample_rate(max(applied_freqs))
         file = f'D:/SECM/_auto_eis-{sample_rate//1000}kHz_1.tpl'
-        applied_freqs = generate_tpl(f0, f1, n_pts, n_cycles, 
-                                     amp, file)
-        self.log(f'Wrote new EIS waveform to {file}')
+        if self.waveform_cache.install(path, file):
+            self.log(f'Wrote EIS waveform to {file}', quiet=True)
         return applied_freqs
     
     
+    def pregenerate_EIS_waveforms(self, f0, f1, n_pts, n_cycles, amps):
+        '''
+        Make sure waveforms for all of amps are in the cache, so switching
+        between them doesn't have to wait for synthesis
+        '''
+        self.waveform_cache.pregenerate(f0, f1, n_pts, n_cycles, amps)
+    
+    
     def check_EIS_corrections(self, EIS_WF_params, forced=False):
         '''
-        Checks if the current waveform is in the stored corrections file.
+        Checks if the stored corrections cover the current waveform.
         
-        If it is, take its correction factors from the file.
+        If they do, interpolate its correction factors from the stored 
+        transfer function for the current gain, filters, and sample rate.
         If forced == True, re-record correction factors
         
         Otherwise, prompt user to plug in the model circuit to record
-        a reference waveform
-        
-        Corrections file is a json which stores a dictionary. Dictionary keys
-        are defined by the waveform parameters: amplitude, number of points,
-        and all the applied frequencies.
-        
-        d = {
-            (amp, n_pts, *applied_frequencies) = [(f, Z_corr, phase_corr) for
-                                                  f in applied frequencies]            
-            }
-                
+        a reference waveform. Its corrections are added to the stored 
+        transfer function. See utils/EIS_corrections.py
         '''
-        amp   = EIS_WF_params['amp']
-        n_pts = EIS_WF_params['n_pts']
-        key   = (amp, n_pts, *self.EIS_applied_freqs)
-        key   = str(key)
-        file  = 'src/utils/EIS_waveforms.json'
-        if os.path.exists(file):
-            d = json.load(open(file, 'r'))
-            if (key in d) and not forced:
-                self.EIS_corrections = d[key]
+        key   = EIS_settings_key(self.EIS_applied_freqs)
+        store = get_store()
+        if not store.curves and os.path.exists(OLD_CORRECTIONS_FILE):
+            # Corrections recorded before they were stored per setting
+            store.import_json(OLD_CORRECTIONS_FILE, EIS_settings_key)
+        
+        if not forced:
+            corrections = store.get(key, self.EIS_applied_freqs)
+            if corrections is not None:
+                self.EIS_corrections = corrections
                 return
-        else:
-            d = {}
                 
         # Prompt for model circuit
         connected = messagebox.askokcancel('Waveform corrections', 
@@ -539,8 +549,7 @@ class HekaWriter(Logger):
         self.EIS_corrections = list(zip(freq, Z_corrections, phase_corrections))
         
         # Save corrections to file
-        d[key] = self.EIS_corrections
-        json.dump(d, open(file, 'w'))
+        store.add(key, freq, Z_corrections, phase_corrections)
         
         messagebox.askokcancel('Waveform corrections',
                                message='Correction factors recorded.')
@@ -552,8 +561,7 @@ class HekaWriter(Logger):
         '''
         Send command to run single EIS scan
         '''
-        fmax = max(self.EIS_WF_params['f0'], self.EIS_WF_params['f1'])
-        sample_rate = get_EIS_sample_rate(fmax)
+        sample_rate = get_EIS_sample_rate(max(self.EIS_applied_freqs))
         # Possible sampling rates are 10k, 20k, 40k, 100k, 200k
         cmd = f'_auto_eis-{sample_rate//1000}kHz'
         self.send_command(f'ExecuteSequence {cmd}')
@@ -711,6 +719,14 @@ def generate_EIS_params(E_DC, duration):
     return values, duration
 
 
+def EIS_settings_key(applied_freqs):
+    # Key of the stored EIS corrections for the settings setup_EIS uses
+    # with this waveform: filters and sample rate follow its max. frequency
+    max_freq = max(applied_freqs)
+    return settings_key(EIS_GAIN, get_filters(max_freq), 
+                        get_EIS_sample_rate(max_freq))
+
+
 def get_filters(max_freq):
     '''
     Return appropriate setting for filter1 and filter2 based on the 
@@ -8,6 +8,9 @@ from tkinter import *
 from tkinter.ttk import *
 from tkinter import filedialog
 from ..utils.utils import Logger, nearest
+from ..utils.plot_utils import (heatmap_datatypes, get_plotlim, get_clim,
+                                set_cbar_ticklabels, unit_label,
+                                inv_unit_label)
 from .DataStorage import (ADCDataPoint, CVDataPoint, 
                                  SinglePoint, EISDataPoint, PointsList)
 
@@ -19,147 +22,52 @@ from ..analysis.analysis_funcs import AnalysisFunctionSelector
 # For time domain plotting
 x_maxes = [5, 10, 30, 60] + [120*i for i in range(1, 60)]
 
-def checksum(data):
-    # TODO: make this simpler
-    
-    if isinstance(data, ADCDataPoint):
-        return sum(data.data[0])
-    
-    if isinstance(data, CVDataPoint):
-        try:
-            return sum(data.data[0])
-        except:
-            return data.data[0]
-    
-    if isinstance(data, EISDataPoint):
-        return sum(data.data[1])
-    
-    if type(data) == np.ndarray:
-        # Heatmap type data
-        try:
-            return data.flatten().sum()
-        except:
-            return 0
-    if type(data) == list:
-        # CV curve type data
-        # From polling ADC, of form [ [idxs], [times], [*data] ]
-        data = [l for l in data if 
-                len(np.array(l)) != 0]
-        return np.array(data).flatten().sum()
-    if type(data) in (float, int):
-        return data
-    
-    return 0
-
-
-def get_plotlim(xdata, ydata):
-    if len(xdata) == 0 or len(xdata) == 1:
-        return ((0,0.1), (0,0.1))
-    lim = (
-     (min(xdata) - 0.05*abs(min(xdata)),
-      max(xdata) + 0.05*abs(max(xdata))
-      ),
-     (min(ydata) - 0.05*abs(min(ydata)),
-      max(ydata) + 0.05*abs(max(ydata))
-      )
-     )
-    return lim
-
-
-def get_clim(arr):
-    # Return minimum and maximum values of array 
-    # (plus some padding) which will be used to define
-    # min and max values on the heatmap color scale.
-    arr = [val for val in np.array(arr).flatten()
-           if val != 0]
-    if len(arr) == 0:
-        return -1, 1
-    avg = np.average(arr)
-    std = np.std(arr)
-    
-    if abs(std/avg) < 0.1:
-        std = 0.1*abs(avg)
-    
-    minval = avg - 2*std
-    maxval = avg + 2*std
-    
-    return minval, maxval
-
-
-def set_cbar_ticklabels(cbar, clim, n_ticks=5):
-    # m0=int(np.floor(arr.min()))            # colorbar min value
-    # m1=int(np.ceil(arr.max()))             # colorbar max value
-    m0 = min(clim)
-    m1 = max(clim)
-    ticks = np.linspace(m0, m1, n_ticks)
-    cbar.set_ticks(ticks)
-    cbar.set_ticklabels([unit_label(t) for t in ticks])
-
-
-def unit_label(d:float,dec=0):
+class ClimTracker():
     '''
-    Returns value as string with SI unit prefix
-    
-    e.g. unit_label(1e-9) --> '1 n'
-         unit_label(7.7e-10): --> '770 p'
+    Running count, sum and sum of squares of the nonzero heatmap values.
+    Gives the same color limits as get_clim() but can be updated one pixel
+    at a time. Sums are taken relative to the first value seen to keep
+    precision for small currents.
     '''
-    inc_prefixes = ['k', 'M', 'G', 'T', 'P', 'E']
-    dec_prefixes = ['m', 'µ', 'n', 'p', 'f', 'a']
-
-    if d == 0:
-        return f'0.0'
-
-    degree = int(np.floor(np.log10(np.fabs(d)) / 3))
-
-    prefix = ''
-
-    if abs(degree) > 1:
-        sign = degree / np.fabs(degree)
-        if sign == 1:
-            if degree - 1 < len(inc_prefixes):
-                prefix = inc_prefixes[degree - 1]
-            else:
-                prefix = inc_prefixes[-1]
-                degree = len(inc_prefixes)
-
-        elif sign == -1:
-            if -degree - 1 < len(dec_prefixes):
-                prefix = dec_prefixes[-degree - 1]
-            else:
-                prefix = dec_prefixes[-1]
-                degree = -len(dec_prefixes)
-
-        scaled = float(d * pow(1000, -degree))
-
-        s = f"{scaled:0.{dec}f}".rjust(4, ' ') + f" {prefix}"
-
-    else:
-        s = f"{d:0.2f}".rjust(4, ' ')
-    return s
+    def __init__(self, arr=()):
+        self.reset(arr)
+    
+    def reset(self, arr):
+        vals = np.asarray(arr, dtype=float).flatten()
+        vals = vals[(vals != 0) & np.isfinite(vals)]
+        self.ref = vals[0] if len(vals) > 0 else None
+        self.n   = len(vals)
+        diff     = vals - self.ref if len(vals) > 0 else vals
+        self.s   = diff.sum()
+        self.ss  = (diff**2).sum()
+    
+    def replace(self, old, new):
+        self._add(old, -1)
+        self._add(new, 1)
+    
+    def _add(self, val, sign):
+        if val == 0 or not np.isfinite(val):
+            return
+        if self.ref is None:
+            self.ref = val
+        diff = val - self.ref
+        self.n  += sign
+        self.s  += sign*diff
+        self.ss += sign*diff**2
+    
+    def get_clim(self):
+        if self.n <= 0:
+            return -1, 1
+        mean_diff = self.s/self.n
+        avg = self.ref + mean_diff
+        std = np.sqrt(max(self.ss/self.n - mean_diff**2, 0))
+        
+        if avg != 0 and abs(std/avg) < 0.1:
+            std = 0.1*abs(avg)
+        
+        return avg - 2*std, avg + 2*std
 
 
-def inv_unit_label(s:str):
-    '''
-    Return string as float
-    '''
-    if type(s) != str:
-        return s
-    prefixes = {'k':1e3, 
-                'M':1e6, 
-                'G':1e9, 
-                'm':1e-3, 
-                'u':1e-6, 
-                'n':1e-9, 
-                'p':1e-12, 
-                'f':1e-15}
-    
-    if not s[-1] in prefixes:
-        return float(s)
-    
-    val = float(s[:-1])*prefixes[s[-1]]
-    return val
-    
-
 def square_axes(ax):
     mini = min(0, *ax.get_xlim(), *ax.get_ylim())
     maxi = max(*ax.get_xlim(), *ax.get_ylim())
@@ -176,9 +84,12 @@ class Heatmap():
         self.fig = fig
         self.ax  = fig.gca()
         
-        # Data array to display and its checksum
+        # Data array to display and running stats for its color limits
         self.data = np.array([0,])
-        self.last_checksum = checksum(self.data)
+        self.clim_tracker = ClimTracker()
+        self.cbar_labels  = []
+        self.needs_full_update = True
+        self.last_version = None   # Experiment.version last drawn
         
         # Rectangle drawn around selected point
         self.rect = matplotlib.patches.Rectangle((0,0), 0, 0, fill=0,
@@ -226,6 +137,7 @@ class Heatmap():
         self.data = expt.get_heatmap_data()
         self.ax.set_xlim(0, expt.length)
         self.ax.set_ylim(0, expt.length)
+        self.needs_full_update = True
         
     
     def get_datapoint_on_click(self, event, pt_idx):
@@ -292,33 +204,129 @@ class Heatmap():
     def update(self, force=False):
         '''
         Called periodically by Tk root (via Plotter.update_figs).
-        Check if new points are appended to the experiment and plot them if so
+        Check if new points are appended to the experiment and plot them if so.
+        
+        Only pixels the Experiment reports as changed are recalculated and
+        blitted. force=True recalculates and redraws everything, i.e. when
+        the display options change.
         '''
-                
-        if ((checksum(self.data) == self.last_checksum) and not force):
+        if self.expt is None:
             return
         
+        if not (force or self.needs_full_update):
+            if self.expt.version == self.last_version:
+                return
+            self.last_version = self.expt.version
+            changed = self.expt.pop_changed()
+            if len(changed) == 0:
+                return
+            if np.shape(self.data) == self.expt.data.shape:
+                self.update_pixels(changed)
+                return
+        
+        self.needs_full_update = False
+        self.last_version = self.expt.version
+        self.expt.pop_changed()
         self.update_data()
+        self.clim_tracker.reset(self.data)
         
         self.image.set_data(self.data[::-1])
+        self.set_clim()
+        
+        left, right = self.ax.get_xlim()
+        bottom, top = self.ax.get_ylim()
+        self.image.set_extent((left, right, bottom, top))
+        self.ax.draw_artist(self.image)
+        self.fig.canvas.draw_idle()
+        plt.pause(0.001)
+    
+    
+    def update_pixels(self, changed):
+        '''
+        Recalculate values at the given (row, col) indices of the Experiment
+        and blit the updated image
+        '''
+        option, value = self.get_display_option()
+        if option == 'Analysis func.' and not self.analysis_function:
+            return
+        for idx in changed:
+            try:
+                val = float(self.get_pixel_value(idx, option, value))
+            except Exception as e:
+                print(f'Error updating heatmap pixel {idx}: {e}')
+                continue
+            self.clim_tracker.replace(self.data[idx], val)
+            self.data[idx] = val
         
+        self.image.set_data(self.data[::-1])
+        if self.set_clim():
+            # Color bar ticks changed, redraw the whole figure
+            self.fig.canvas.draw_idle()
+            return
+        self.blit()
+    
+    
+    def set_clim(self):
+        '''
+        Apply color limits from the GUI fields or from the data.
+        Returns True if the color bar labels changed
+        '''
         if self.force_minmax:
             minval = inv_unit_label(self.GUI.heatmap_min_val.get())
             maxval = inv_unit_label(self.GUI.heatmap_max_val.get())
         else:
-            minval, maxval = get_clim(self.data)
+            minval, maxval = self.clim_tracker.get_clim()
             self.update_minmaxval_fields()
-            
-        self.image.set(clim=( minval, maxval) )
-        set_cbar_ticklabels(self.image.colorbar, [minval, maxval])
         
-        left, right = self.ax.get_xlim()
-        bottom, top = self.ax.get_ylim()
-        self.image.set_extent((left, right, bottom, top))
+        # Rebuilding the color bar is slow, only do it if the labels change
+        with self.image.callbacks.blocked():
+            self.image.set(clim=( minval, maxval) )
+        labels = [unit_label(t) for t in np.linspace(minval, maxval, 5)]
+        if labels == self.cbar_labels:
+            return False
+        self.image.colorbar.update_normal(self.image)
+        set_cbar_ticklabels(self.image.colorbar, [minval, maxval])
+        self.cbar_labels = labels
+        return True
+    
+    
+    def blit(self):
+        '''
+        Redraw only the heatmap axes. Image covers the whole axes, so no
+        background needs to be restored first
+        '''
+        canvas = self.fig.canvas
+        if not canvas.supports_blit:
+            canvas.draw_idle()
+            return
         self.ax.draw_artist(self.image)
-        self.fig.canvas.draw_idle()
-        self.last_checksum = checksum(self.data)
-        plt.pause(0.001)
+        for spine in self.ax.spines.values():
+            self.ax.draw_artist(spine)
+        self.ax.draw_artist(self.rect)
+        canvas.blit(self.ax.bbox)
+    
+    
+    def get_display_option(self):
+        '''
+        Returns (option, value) selected in the GUI for the heatmap display
+        '''
+        option = self.GUI.heatmapselection.get()
+        value  = self.GUI.HeatMapDisplayParam.get()
+        
+        if option == 'Analysis func.':
+            value = value.replace('\n', '')
+        else:
+            value = float(value.replace('\n', '')) if value else None
+        return option, value
+    
+    
+    def get_pixel_value(self, idx, option, value):
+        '''
+        Returns value to display for the DataPoint at self.expt.data[idx]
+        '''
+        if option == 'Analysis func.':
+            return self.expt.analyze_point(idx, self.analysis_function, value)
+        return self.expt.data[idx].get_val(heatmap_datatypes[option], value)
     
         
     def update_data(self):
@@ -328,29 +336,19 @@ class Heatmap():
         
         Plot will be updated next time self.update() is called
         '''
-        option = self.GUI.heatmapselection.get()
-        value  = self.GUI.HeatMapDisplayParam.get()
+        option, value = self.get_display_option()
         
         if option == 'Analysis func.':
-            value = value.replace('\n', '')
             if not self.analysis_function:
                 print('Error: no analysis function selected.')
                 return
             pts = self.expt.do_analysis(self.analysis_function, value)
         
         else:
-            # Keys to pass to Experiment
-            d = {'Max. current': 'max',
-                 'Current @ ... (V)': 'val_at',
-                 'Current @ ... (t)': 'val_at_t',
-                 'Z height': 'z',
-                 'Avg. current': 'avg'}
-            
-            value = float(value.replace('\n', '')) if value else None
-            pts = self.expt.get_heatmap_data(d[option], value)
+            pts = self.expt.get_heatmap_data(heatmap_datatypes[option], value)
         
         if len(pts) > 0:
-            self.data = pts
+            self.data = np.array(pts, dtype=float)
         return
     
     
@@ -376,7 +374,7 @@ class Heatmap():
         
     ### Colormap updating functions
     def update_minmaxval_fields(self):
-        minval, maxval = get_clim(self.data[::-1])
+        minval, maxval = self.clim_tracker.get_clim()
         self.GUI.heatmap_min_val.set(f'{minval:0.3g}')
         self.GUI.heatmap_max_val.set(f'{maxval:0.3g}') 
     
@@ -459,9 +457,10 @@ class EchemFig():
         
         # Keep track of what is currently being plotted
         self.DataPoint = None
-        self.last_checksum = checksum(self.DataPoint)
+        self.last_version = None   # DataPoint.version last drawn
         self.artists = []
         self._forced = False
+        self._setting_lims = False  # Ignore xlim changes made by plot_IV
         
         self.initialize()
         
@@ -473,6 +472,8 @@ class EchemFig():
         self._forced = False
         self.ax.cla()
         self.ln, = self.ax.plot([],[])
+        # cla() drops callbacks, reconnect zoom/pan handler
+        self.ax.callbacks.connect('xlim_changed', self.on_xlim_changed)
         self.clear_artists()
         self.fig.tight_layout()
         self.fig.canvas.draw()
@@ -492,7 +493,7 @@ class EchemFig():
     
     def update(self, ADCDataPoint):
         '''
-        Called by Plotter.update_figs every 100 ms. Check if new data exists
+        Called by Plotter.update_figs every frame. Check if new data exists
         in the ADCDataPoint to be plotted. Reset the figure if a new ADCDataPoint
         is passed.
 
@@ -507,7 +508,7 @@ class EchemFig():
         
         # Trying to display the same ADC data point. Update with new points.
         if id(ADCDataPoint) == id(self.DataPoint):
-            if checksum(self.DataPoint) != self.last_checksum:
+            if getattr(self.DataPoint, 'version', 0) != self.last_version:
                 return self.update_plot()
         
         # Trying to display a new data point. Refresh plot            
@@ -555,9 +556,15 @@ class EchemFig():
         pt_selection = self.GUI.fig2ptselection.get()
         
         DataPoint = self.DataPoint[pt_selection]
-        self.last_checksum = checksum(self.DataPoint)
+        self.last_version = getattr(self.DataPoint, 'version', 0)
         if isinstance(DataPoint, EISDataPoint):
             self.plot_EIS(DataPoint, EIS_selection)
+        elif (isinstance(DataPoint, ADCDataPoint) and 
+              DataPoint.get_impedance() is not None):
+            # EIS measurement running, show its impedance as it builds up
+            _, Z = DataPoint.get_impedance()
+            V, I = self.scale_ADC(DataPoint, 1, 1)
+            self.plot_Nyquist(DataPoint, Z*V/I)
         else:
             self.plot_IV(DataPoint, IV_selection)
         
@@ -575,27 +582,28 @@ class EchemFig():
         -------
         None.
         '''
-        t, V, I = DataPoint.get_data(downsample=True) #Only passes downsampled arg to ADCDataPoint type
-        
+        ylabel, xlabel = IV_selection.split(' vs ')
+        n_pixels = int(self.ax.bbox.width)
         if isinstance(DataPoint, ADCDataPoint):
-            # ADCDataPoints take 'gain' argument from GUI (set in HEKA), need to
-            # convert output voltage -> current
-            try:
-                V = np.array(V)/10
-                I = np.array(I)/DataPoint.gain
-            except:
-                pass
+            # Min/max envelope, at most a few points per pixel column
+            t, V, I = DataPoint.get_decimated(n_pixels)
+        elif isinstance(DataPoint, CVDataPoint) and xlabel == 't':
+            t, V, I = DataPoint.get_window(n_pixels=n_pixels)
+        else:
+            t, V, I = DataPoint.get_data()
         
+        V, I = self.scale_ADC(DataPoint, V, I)
         d = {'t':t, 'V':V, 'I':I}
         
-        ylabel, xlabel = IV_selection.split(' vs ')
         yvals, xvals = d[ylabel], d[xlabel]
         self.ln.set_data(xvals, yvals[:len(xvals)])
         self.ln.set_marker('')
         xlim, ylim = get_plotlim(xvals, yvals)
+        self._setting_lims = True
         self.ax.set_xscale('linear')
         self.ax.set_xlim(xlim)
         self.ax.set_ylim(ylim)
+        self._setting_lims = False
         self.ax.set_xlabel(xlabel)
         self.ax.set_ylabel(ylabel)
         
@@ -603,6 +611,42 @@ class EchemFig():
         self.draw_artists()
         
         
+    def scale_ADC(self, DataPoint, V, I):
+        '''
+        ADCDataPoints take 'gain' argument from GUI (set in HEKA), need to
+        convert output voltage -> current
+        '''
+        if isinstance(DataPoint, ADCDataPoint):
+            try:
+                V = np.array(V)/10
+                I = np.array(I)/DataPoint.gain
+            except:
+                pass
+        return V, I
+    
+    
+    def on_xlim_changed(self, ax):
+        '''
+        Called when zooming or panning. Redraw time-domain traces from
+        the DataPoint's pyramid level that matches the new x range, so
+        long recordings are never reprocessed in full.
+        '''
+        if self._setting_lims or self.DataPoint is None:
+            return
+        ylabel, xlabel = self.GUI.fig2selection.get().split(' vs ')
+        DataPoint = self.DataPoint[self.GUI.fig2ptselection.get()]
+        if (xlabel != 't' or 
+            not isinstance(DataPoint, (ADCDataPoint, CVDataPoint))):
+            return
+        
+        t_start, t_end = ax.get_xlim()
+        t, V, I = DataPoint.get_window(t_start, t_end, int(ax.bbox.width))
+        V, I = self.scale_ADC(DataPoint, V, I)
+        d = {'t':t, 'V':V, 'I':I}
+        self.ln.set_data(d[xlabel], d[ylabel])
+        self.fig.canvas.draw_idle()
+        
+    
     def plot_EIS(self, DataPoint, EIS_selection):
         if EIS_selection == 'Nyquist':
             self.plot_Nyquist(DataPoint)
@@ -612,19 +656,21 @@ class EchemFig():
             self.plot_Bode(DataPoint, 'Phase')
     
     
-    def plot_Nyquist(self, DataPoint):
+    def plot_Nyquist(self, DataPoint, Z=None):
         '''
         Display a Nyquist plot.
 
         Parameters
         ----------
         DataPoint : DataStorage.EISDataPoint
+        Z : optional, impedance to plot instead of DataPoint's
 
         Returns
         -------
         None.
         '''
-        freqs, _,_,Z = DataPoint.data
+        if Z is None:
+            freqs, _,_,Z = DataPoint.data
         
         valid_idxs = [i for i, z in enumerate(Z) if np.abs(z) <= 20e9]
         Z = [z for i, z in enumerate(Z) if i in valid_idxs]
@@ -770,6 +816,10 @@ class EchemFig():
 
 class Plotter(Logger):
     
+    # Max. redraws per second. Figures are only redrawn when the version
+    # counter of the Experiment or the ADC buffer has changed.
+    FRAME_RATE = 10
+    
     def __init__(self, master, fig1, fig2):
         self.master = master
         self.master.register(self)
@@ -818,9 +868,9 @@ class Plotter(Logger):
         return 
     
     
-    # Called every 100 ms by TK mainloop.
-    # Check if data has updated. If so, plot it to
-    # the appropriate figure.
+    # Called every 1/FRAME_RATE s by TK mainloop.
+    # Check if data has updated (by version counter). If so, 
+    # plot it to the appropriate figure.
     def update_figs(self, **kwargs):
         
         if self.master.expt != self.Heatmap.expt:
@@ -828,7 +878,7 @@ class Plotter(Logger):
         self.Heatmap.update()
         self.EchemFig.update(self.master.ADC.pollingdata)
                 
-        self.master.GUI.root.after(100, self.update_figs)
+        self.master.GUI.root.after(int(1000/self.FRAME_RATE), self.update_figs)
         return
     
 
@@ -0,0 +1,121 @@
+'''
+Stored EIS correction factors (filter and amplifier transfer function).
+
+Corrections are measured on the 10 MOhm model circuit (see
+HekaWriter.check_EIS_corrections) and depend only on the amplifier gain,
+filter settings, and sample rate, not on the waveform. Each of those
+settings has one transfer function curve: every frequency it was ever
+measured at, sorted. Waveforms whose frequencies fall inside a stored curve
+get their corrections by interpolation, without a new measurement.
+
+Curves are kept in a binary .npz file which is read once and cached in
+memory.
+'''
+import json
+import os
+import numpy as np
+
+
+CORRECTIONS_FILE = 'src/utils/EIS_corrections.npz'
+OLD_CORRECTIONS_FILE = 'src/utils/EIS_waveforms.json'
+
+_stores = {}  # {path: CorrectionStore}, so each file is only read once
+
+
+def get_store(path=CORRECTIONS_FILE):
+    if path not in _stores:
+        _stores[path] = CorrectionStore(path)
+    return _stores[path]
+
+
+def settings_key(gain, filters, sample_rate):
+    '''
+    gain: amplifier gain setting
+    filters: list of filter commands, from HekaIO.get_filters()
+    sample_rate: EIS sample rate (Hz)
+    '''
+    return json.dumps([str(gain), list(filters), int(sample_rate)])
+
+
+
+class CorrectionStore():
+    '''
+    {settings_key: (3, n) array of freqs, |Z| corrections, phase
+     corrections}
+
+        Corrected |Z| = |Z| / Z_corrections
+        Corrected  p  =  p  - phase_corrections
+    '''
+
+    def __init__(self, path=CORRECTIONS_FILE):
+        self.path   = path
+        self.curves = {}
+        if os.path.exists(path):
+            with np.load(path) as f:
+                for i, key in enumerate(f['keys']):
+                    self.curves[str(key)] = f[f'curve_{i}']
+
+
+    def save(self):
+        # Write to a temporary file first so a crash can't corrupt the store
+        arrays = {f'curve_{i}': curve
+                  for i, curve in enumerate(self.curves.values())}
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, keys=np.array(list(self.curves), dtype=str),
+                     **arrays)
+        os.replace(self.path + '.tmp', self.path)
+
+
+    def get(self, key, freqs):
+        '''
+        Returns list of (f, Z_correction, phase_correction) for each of
+        freqs, interpolated from the stored curve (linear in log f). None
+        if there is no curve for these settings or a frequency is outside
+        the measured range.
+        '''
+        curve = self.curves.get(key)
+        if curve is None:
+            return None
+        freqs = np.asarray(freqs, dtype=float)
+        f, Z_corr, phase_corr = curve
+        if freqs.min() < f[0] or freqs.max() > f[-1]:
+            return None
+        logf = np.log(freqs)
+        Z_corr     = np.exp(np.interp(logf, np.log(f), np.log(Z_corr)))
+        phase_corr = np.interp(logf, np.log(f), phase_corr)
+        return list(zip(freqs.tolist(), Z_corr.tolist(),
+                        phase_corr.tolist()))
+
+
+    def add(self, key, freqs, Z_corrections, phase_corrections, save=True):
+        '''
+        Merge newly measured corrections into the curve for these settings.
+        New values replace old ones at the same frequency.
+        '''
+        new = np.array([freqs, Z_corrections, phase_corrections],
+                       dtype=float)
+        if key in self.curves:
+            old  = self.curves[key]
+            keep = ~np.isin(old[0], new[0])
+            new  = np.concatenate([old[:, keep], new], axis=1)
+        self.curves[key] = new[:, np.argsort(new[0])]
+        if save:
+            self.save()
+
+
+    def import_json(self, path, get_key):
+        '''
+        Add corrections from the old per-waveform json file,
+        {str((amp, n_pts, *applied_freqs)): [(f, Z_corr, phase_corr), ...]}
+
+        get_key: function of the applied frequencies which returns the
+                 settings key the waveform was measured with. Use the same
+                 function for lookups so both sides agree on the key
+        '''
+        with open(path, 'r') as f:
+            d = json.load(f)
+        for corrections in d.values():
+            freqs, Z_corr, phase_corr = zip(*corrections)
+            self.add(get_key(freqs), freqs, Z_corr, phase_corr,
+                     save=False)
+        self.save()
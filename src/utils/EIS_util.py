@@ -1,6 +1,12 @@
-import struct
+import hashlib
+import json
+import os
+import shutil
+from itertools import chain
 import numpy as np
 import matplotlib.pyplot as plt
+from . import tpl_io
+from .spectral import bin_indices, rfft_bins
 
 '''
 Functions for generating multi-sin EIS waveforms and saving
@@ -8,13 +14,20 @@ them in HEKA-compatible format.
 '''
 
 
+# Crest factor minimization iterations for new waveforms
+CREST_FACTOR_ITERATIONS = 20
+
+# Pre-generated waveforms, see WaveformCache
+WAVEFORM_CACHE_DIR = r'D:/SECM/waveforms'
+
+
 def nearest(value, array):
     array = np.asarray(array)
     idx = (np.abs(array - value)).argmin()
     return idx, array[idx]
 
 
-def generate_tpl(f0, f1, n_pts, n_cycles, mVpp, fname, Z=None):
+def generate_tpl(f0, f1, n_pts, n_cycles, mVpp, fname, Z=None, force=False):
     '''
     Wraps generate_waveform, make_time_domain, and write_tpl_file
     
@@ -26,9 +39,11 @@ def generate_tpl(f0, f1, n_pts, n_cycles, mVpp, fname, Z=None):
         mVpp: float, (freq dependent) peak-peak amplitude
         fname: file path to write to
         Z: (optional) array. If given, used to "optimize" waveform
+        force: rewrite fname even if it already holds this waveform
         
     Outputs:
-        None. Writes waveform to fname
+        freqs: applied frequencies. Writes waveform to fname, unless 
+        fname's sidecar (see tpl_io) shows it is already identical
     '''
     # Validate inputs
     assert(f1 > f0 > 0),    'EIS input error: must have f1 > f0 > 0.'
@@ -41,12 +56,25 @@ def generate_tpl(f0, f1, n_pts, n_cycles, mVpp, fname, Z=None):
     mVpp /= 2    # Make it peak-to-peak instead of amplitude
     
     freqs, phases, mVpp = generate_waveform(f0, f1, n_pts, mVpp)
+    amp_factor = 1/np.sqrt(freqs)
+    params = {'freqs': freqs, 
+              'amps': mVpp*amp_factor/max(amp_factor),
+              'phases': 'schroeder',
+              'n_cycles': n_cycles,
+              'sample_rate': get_EIS_sample_rate(max(freqs)),
+              'crest_factor_iterations': CREST_FACTOR_ITERATIONS}
+    if not force and tpl_io.is_current(fname, params):
+        return freqs
     
     # if Z is None:
     #     v = make_time_domain(freqs, phases, mVpp)
     # else:
     v = optimize_waveform_default(freqs, phases, n_cycles, mVpp)  
-    write_tpl_file(v, fname)
+    
+    # Record the phases the waveform actually has (sine phase, radians)
+    bins = bin_indices(freqs, len(v), params['sample_rate'])
+    params['applied_phases'] = np.angle(1j*rfft_bins(v, bins))
+    write_tpl_file(v, fname, meta=params)
     # print(f'Wrote waveform to {fname}')
     return freqs
 
@@ -58,69 +86,214 @@ def generate_waveform(f0, f1, n_pts, mVpp):
     n_pts: int, number of frequencies to measure
     mVpp: float, peak-peak amplitude
     '''
+    freqs  = plan_frequencies(f0, f1, n_pts)
+    phases = None  # Schroeder phases for the final amplitudes
+        
+    return freqs, phases, mVpp
+
+
+def intermod_products(h, chosen, order=3):
+    '''
+    Harmonic numbers of the intermodulation products of h with the chosen 
+    harmonics, up to 2nd or 3rd order: 2h, h +- a (2nd order), 3h, 2h +- a,
+    h +- 2a, h +- a +- b (3rd order)
+    '''
+    a = np.asarray(chosen, dtype=np.int64)
+    products = [[2*h], h + a, np.abs(h - a)]
+    if order >= 3:
+        i, j = np.triu_indices(len(a), k=1)
+        s = a[i] + a[j]
+        d = np.abs(a[i] - a[j])
+        products += [[3*h], 2*h + a, np.abs(2*h - a), h + 2*a, 
+                     np.abs(h - 2*a), h + s, np.abs(h - s), h + d, 
+                     np.abs(h - d)]
+    return np.concatenate(products)
+
+
+def plan_frequencies(f0, f1, n_pts, mains=60, order=2, report=False):
+    '''
+    Choose n_pts roughly log-spaced frequencies between f0 and f1 for a
+    multisine. All are integer multiples of f0, so the waveform repeats
+    every 1/f0.
     
-    # Generate array of frequencies
-    freqs = np.logspace(np.log10(f0), np.log10(f1), n_pts)
+    Each log-spaced frequency is moved up to the next multiple of f0 (or
+    down, if there is none above it in its decade) which is not
+        - already chosen ('duplicate')
+        - a harmonic of the mains frequency ('mains')
+        - an intermodulation product (up to order, 2 or 3) of chosen 
+          frequencies, or making one with them ('intermodulation')
+    If no frequency in the target's decade passes, intermodulation is 
+    allowed for that point, so the low decades (where there are only a few
+    multiples of f0) keep their share of the points. 3rd order exclusion 
+    blocks most of those multiples, so the default is 2nd order.
     
-    # All frequencies must be interger multiples of the lowest frequency,
-    # and should not be 2nd harmonics of each other
-    # Avoid harmonics of 60 Hz as well (US mains power frequencies)
+    Works on harmonic numbers f/f0 with sieves of the mains harmonics and
+    of the products of chosen frequencies, so most candidates are rejected
+    in O(1), and fine grids (i.e. f0 = 0.1 Hz, f1 = 100 kHz) don't need a
+    list of every multiple.
     
-    base_freq = f0
-    valid_freqs = [n*base_freq for n in range(1, 1 + int(f1//base_freq))]
+    report: also return {freq: reason} of every rejected candidate
+    '''
+    n_max   = int(f1//f0)
+    targets = np.rint(np.logspace(np.log10(f0), np.log10(f1), n_pts)/f0)
+    targets = np.clip(targets.astype(np.int64), 1, n_max)
     
+    # Sieves over harmonic numbers 0 ... n_max
+    h = np.arange(n_max + 1)
+    ratio   = h*f0/mains
+    is_mains = (h > 0) & np.isclose(ratio, np.rint(ratio), rtol=0, atol=1e-9)
+    chosen   = np.zeros(n_max + 1, dtype=bool)
+    blocked  = np.zeros(n_max + 1, dtype=bool)  # products of chosen
     
-    for i in range(n_pts):
-        f = freqs[i]
-        idx, f = nearest(f, valid_freqs) # Find closest interger multiple
-        
-        while ( (f in freqs[:i]) 
-               or (f%60 == 0)                       # 60 Hz harmonics
-               or any([f/set_freq == 2 for set_freq in freqs[:i]]) # 2nd harmonic of lower freq
-              ):
-            idx += 1
-            try:
-                f = valid_freqs[idx]
-            except:
-                break   
-        freqs[i] = f
+    def reason(c, strict):
+        # Why harmonic c can't be used, or None
+        if chosen[c]:
+            return 'duplicate'
+        if is_mains[c]:
+            return 'mains'
+        if strict and (blocked[c] or (picked and np.isin(
+                intermod_products(c, picked, order), picked).any())):
+            return 'intermodulation'
+        return None
     
-    phases = [np.random.randint(-180, 180) for _ in freqs]
+    picked   = []
+    rejected = {}
+    for target in targets:
+        # Closest allowed harmonic above the target, else below it. Without
+        # intermodulation products only in the target's decade.
+        decade = 10**np.floor(np.log10(target*f0))
+        lo = max(int(np.ceil(decade/f0)), 1)
+        hi = min(int(np.ceil(10*decade/f0)) - 1, n_max)
+        c = None
+        for strict in (True, False):
+            up, down = (hi, lo) if strict else (n_max, 1)
+            for c in chain(range(target, up + 1), range(target - 1, down - 1, -1)):
+                why = reason(c, strict)
+                if why is None:
+                    break
+                rejected.setdefault(c*f0, why)
+            else:
+                c = None
+            if c is not None:
+                break
+        if c is None:
+            break  # No room left
         
-    return freqs, phases, mVpp
+        if picked:
+            products = intermod_products(c, picked, order)
+            blocked[products[products <= n_max]] = True
+        else:
+            blocked[[k*c for k in range(2, order + 1) if k*c <= n_max]] = True
+        chosen[c] = True
+        picked.append(c)
+    
+    freqs = f0*np.sort(picked).astype(float)
+    if report:
+        return freqs, rejected
+    return freqs
         
 
-def make_time_domain(freqs, phases, n_cycles, mVpp):
+def make_time_domain(freqs, phases, n_cycles, mVpp, n_iter=0):
     '''
     Total measurement duration is n_cycles * 1/min(freqs): 
     n cycle at the lowest requested frequency.
     
-    Number of points needd it duration*sample rate. For now, sample rate is 
-    fixed at 50 kHz. In the future the sample rate will be chosen based
-    on the maximum requested frequency (srate >= 10* max(freqs) )
+    Number of points needd it duration*sample rate. Sample rate is 
+    chosen based on the maximum requested frequency (see 
+    get_EIS_sample_rate)
+    
+    phases: radians, or None for Schroeder phases
+    n_iter: number of crest factor minimization iterations, see
+            minimize_crest_factor()
     '''
 
     if type(mVpp) not in (list, np.ndarray):
         mVpp = [mVpp for _ in freqs]
+    if phases is None:
+        phases = schroeder_phases(mVpp)
     
-    sample_rate = 50000 # TODO: set this dynamically, choose between i.e. 10, 25, 100kHz
     sample_rate = get_EIS_sample_rate(max(freqs))
     
     N = (1/min(freqs)) * sample_rate * n_cycles
     N = int(np.ceil(N)) # collect 1 extra point if N is not an integer
-    v = np.zeros(N)
-    t = np.linspace(0, n_cycles * 1/min(freqs), N)
-    for freq, phase, amp in zip(freqs, phases, mVpp):
-        v += amp*np.sin(2*np.pi*freq*t + phase)
+    
+    # The waveform repeats every 1/min(freqs). Make (and optimize) one 
+    # period and repeat it, if that fits the sample rate
+    period = sample_rate/min(freqs)
+    if float(period).is_integer() and N == int(period)*n_cycles:
+        n, repeats = int(period), n_cycles
+    else:
+        n, repeats = N, 1
+    
+    X, bins = multisine_spectrum(freqs, mVpp, phases, sample_rate, n)
+    if n_iter:
+        X = minimize_crest_factor(X, bins, n, n_iter)
+    v = np.tile(np.fft.irfft(X, n), repeats)
     
     v *= max(mVpp)/max(v) # rescale to set max Vpp
         
     return v
+
+
+def multisine_spectrum(freqs, amps, phases, sample_rate, n):
+    '''
+    Returns (X, bins): rFFT spectrum of an n point multisine, 
+    sum(amp*sin(2 pi f t + phase)), and the bins of freqs. Frequencies are 
+    placed on the nearest bin, so the waveform is periodic in n points.
+    The waveform is np.fft.irfft(X, n).
+    '''
+    bins = np.rint(np.asarray(freqs)*n/sample_rate).astype(int)
+    X = np.zeros(n//2 + 1, dtype=complex)
+    X[bins] = 0.5*n*np.asarray(amps)*np.exp(1j*(np.asarray(phases) - np.pi/2))
+    return X, bins
+
+
+def crest_factor(v):
+    # Peak/ RMS. Lower means more amplitude fits within a Vpp limit
+    v = np.asarray(v)
+    return np.abs(v).max()/np.sqrt(np.mean(v**2))
+
+
+def schroeder_phases(amps):
+    '''
+    Schroeder phases (radians) for a multisine with these amplitudes, in
+    order of increasing frequency. Gives a low crest factor without any 
+    iterations:
+        phase_k = -2 pi sum_{j<k} (k - j) p_j,   p_j = amp_j^2/ sum(amp^2)
+    '''
+    p = np.asarray(amps, dtype=float)**2
+    p /= p.sum()
+    k = np.arange(len(p))
+    phases = np.zeros(len(p))
+    phases[1:] = -2*np.pi*(k[1:]*np.cumsum(p)[:-1] - np.cumsum(k*p)[:-1])
+    return phases
+
+
+def minimize_crest_factor(X, bins, n, n_iter=20, clip=0.9):
+    '''
+    Iterative clipping: clip the waveform's peaks to clip*peak, transform
+    back, and keep the new phases at the applied frequencies but their 
+    original amplitudes. Returns the spectrum (as multisine_spectrum) of 
+    the lowest crest factor waveform found.
+    '''
+    amps    = np.abs(X[bins])
+    best_X  = X
+    best_cf = np.inf
+    for _ in range(n_iter + 1):
+        v  = np.fft.irfft(X, n)
+        cf = crest_factor(v)
+        if cf < best_cf:
+            best_X, best_cf = X, cf
+        peak = clip*np.abs(v).max()
+        Y = np.fft.rfft(np.clip(v, -peak, peak))
+        X = np.zeros_like(X)
+        X[bins] = amps*np.exp(1j*np.angle(Y[bins]))
+    return best_X
         
 
 
 
-def optimize_waveform(freqs, phases, mVpp, Z):
+def optimize_waveform(freqs, phases, n_cycles, mVpp, Z):
     '''
     Use previously recorded Z to adjust the amplitude for each sine wave.
     
@@ -129,7 +302,8 @@ def optimize_waveform(freqs, phases, mVpp, Z):
     Z = np.asarray(Z)
     amp_factor = 1/np.absolute(Z)
     mVpp = mVpp * (amp_factor/max(amp_factor))
-    return make_time_domain(freqs, phases, mVpp)
+    return make_time_domain(freqs, phases, n_cycles, mVpp, 
+                            n_iter=CREST_FACTOR_ITERATIONS)
 
 
 def optimize_waveform_default(freqs, phases, n_cycles, mVpp):
@@ -138,7 +312,8 @@ def optimize_waveform_default(freqs, phases, n_cycles, mVpp):
     '''
     amp_factor = 1/np.sqrt(freqs)
     mVpp = mVpp * amp_factor/max(amp_factor)
-    return make_time_domain(freqs, phases, n_cycles, mVpp)
+    return make_time_domain(freqs, phases, n_cycles, mVpp, 
+                            n_iter=CREST_FACTOR_ITERATIONS)
 
 
 def get_EIS_sample_rate(fmax):
@@ -171,24 +346,123 @@ def plot_freqs(freqs, amps):
     plt.ylabel('Amplitude/ a.u.')
     
 
-def write_tpl_file(voltages, fname):
+def write_tpl_file(voltages, fname, meta=None):
     '''
     voltages: list or array of time-domain voltages
     fname: file to write to
+    meta: (optional) dict of waveform parameters for the sidecar file
+    '''
+    tpl_io.write_tpl(fname, voltages, meta)
+
+
+
+class WaveformCache():
+    '''
+    Folder of generated .tpl waveforms, named by a hash of the parameters
+    they were made with. A waveform is only synthesized the first time its
+    parameters are requested, then install() copies it to the file 
+    PATCHMASTER's EIS sequence reads.
+    
+    Applied frequencies are read from each waveform's sidecar (see tpl_io)
+    and kept in memory.
     '''
-    # write list of short floats to .tpl file
-    buff = struct.pack('f'*len(voltages), *voltages)
-    with open(fname, 'wb') as f:
-        f.write(buff)
+    def __init__(self, folder=WAVEFORM_CACHE_DIR):
+        self.folder = folder
+        self.freqs  = {}    # {path: applied freqs}
+    
+    
+    def get_path(self, f0, f1, n_pts, n_cycles, amp):
+        # Normalize types so i.e. amp = 10 and amp = 10.0 share a waveform
+        params = [float(f0), float(f1), int(n_pts), int(n_cycles), float(amp),
+                  get_EIS_sample_rate(max(f0, f1)), CREST_FACTOR_ITERATIONS]
+        key = hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]
+        return os.path.join(self.folder, f'{key}.tpl')
+    
+    
+    def get(self, f0, f1, n_pts, n_cycles, amp, force=False):
+        '''
+        Returns (path, applied freqs) of this waveform, generating it 
+        if it's not in the cache (or if force == True)
+        '''
+        path = self.get_path(f0, f1, n_pts, n_cycles, amp)
+        if not force:
+            if path in self.freqs:
+                return path, self.freqs[path]
+            meta = tpl_io.read_meta(path)
+            if meta is not None and tpl_io.is_current(path, {}):
+                self.freqs[path] = np.array(meta['freqs'])
+                return path, self.freqs[path]
+        
+        os.makedirs(self.folder, exist_ok=True)
+        self.freqs[path] = generate_tpl(f0, f1, n_pts, n_cycles, amp, path,
+                                        force=True)
+        return path, self.freqs[path]
+    
+    
+    def pregenerate(self, f0, f1, n_pts, n_cycles, amps):
+        for amp in amps:
+            self.get(f0, f1, n_pts, n_cycles, amp)
+    
+    
+    def install(self, path, target):
+        '''
+        Copy cached waveform (and its sidecar) to target. Returns False if
+        target already was this waveform.
+        '''
+        if (os.path.exists(target) and 
+            tpl_io.read_meta(target) == tpl_io.read_meta(path)):
+            return False
+        # No sidecar until the new waveform is completely copied
+        if os.path.exists(tpl_io.meta_path(target)):
+            os.remove(tpl_io.meta_path(target))
+        shutil.copyfile(path, target + '.tmp')
+        os.replace(target + '.tmp', target)
+        shutil.copyfile(tpl_io.meta_path(path), tpl_io.meta_path(target))
+        return True
         
         
         
         
 if __name__ == '__main__':        
-    freqs, phases, mVpp = generate_waveform(1, 1000, 18, 20)
+    # Time to generate 1e6+ point waveforms, and their crest factors
+    import time
+    
+    def sum_of_sines(freqs, phases, n_cycles, mVpp):
+        # Previous make_time_domain, for comparison
+        sample_rate = get_EIS_sample_rate(max(freqs))
+        N = int(np.ceil((1/min(freqs)) * sample_rate * n_cycles))
+        v = np.zeros(N)
+        t = np.linspace(0, n_cycles * 1/min(freqs), N)
+        for freq, phase, amp in zip(freqs, phases, mVpp):
+            v += amp*np.sin(2*np.pi*freq*t + phase)
+        return v*max(mVpp)/max(v)
     
-    # v = make_time_domain(freqs, phases, mVpp)
-    v = optimize_waveform_default(freqs, phases, mVpp)
+    for f0, f1, n_pts, n_cycles in [(1, 20000, 30, 10), (0.1, 1000, 40, 10),
+                                    (1, 40000, 50, 20)]:
+        freqs, _, _ = generate_waveform(f0, f1, n_pts, 1)
+        amps = 1/np.sqrt(freqs)
+        amps /= amps.max()
+        random = np.random.uniform(-np.pi, np.pi, len(freqs))
+        
+        st = time.perf_counter()
+        v_old = sum_of_sines(freqs, random, n_cycles, amps)
+        old_time = time.perf_counter() - st
+        
+        times, cfs = [], []
+        for phases, n_iter in [(random, 0), (None, 0), 
+                               (None, CREST_FACTOR_ITERATIONS)]:
+            st = time.perf_counter()
+            v = make_time_domain(freqs, phases, n_cycles, amps, n_iter)
+            times.append(time.perf_counter() - st)
+            cfs.append(crest_factor(v))
+        
+        print(f'{len(v)} points, {len(freqs)} frequencies')
+        print(f'  sum of sines: {old_time:0.2f} s, crest factor '
+              f'{crest_factor(v_old):0.2f}')
+        print(f'  irfft, random phases: {times[0]:0.3f} s, {cfs[0]:0.2f}')
+        print(f'  Schroeder phases: {times[1]:0.3f} s, {cfs[1]:0.2f}')
+        print(f'  + {CREST_FACTOR_ITERATIONS} clipping iterations: '
+              f'{times[2]:0.3f} s, {cfs[2]:0.2f}')
     
     # Hz = 50000 #sampling rate
     # A = -0.514   #amplitude
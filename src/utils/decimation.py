@@ -0,0 +1,322 @@
+import threading
+import numpy as np
+
+
+class MinMaxDecimator():
+    '''
+    Incremental min/max envelope of a (t, V, I) trace for plotting.
+
+    Samples are grouped into consecutive buckets. Each bucket keeps the
+    samples with its min and max V and its min and max I, so spikes and the
+    overall envelope look the same at any level of decimation. When there
+    are more than 2*n_buckets buckets, neighboring pairs are merged and new
+    buckets are made twice as long. Memory use and the number of points
+    returned stay bounded no matter how long the recording runs.
+
+    n_buckets: int, typically the width of the plot in pixels. At least 1
+    '''
+
+    # Which (t, V, I) column each of the 4 kept extremes looks at, and
+    # whether it is a min (+1) or a max (-1)
+    _channels = np.array([1, 1, 2, 2])
+    _signs    = np.array([1, -1, 1, -1])
+
+    def __init__(self, n_buckets=1000):
+        self.n_buckets   = max(int(n_buckets), 1)
+        self.bucket_size = 1
+        self.n_samples   = 0
+
+        self.idx  = np.zeros((0, 4), dtype=np.int64) # sample index of extremes
+        self.vals = np.zeros((0, 4, 3))              # (t, V, I) of extremes
+        self.tail = np.zeros((0, 3))                 # samples not in a full bucket
+        self._lock = threading.Lock()
+
+
+    def append(self, t, V, I):
+        '''
+        Add a block of samples. Accepts floats or array-likes
+        '''
+        new = np.column_stack([np.atleast_1d(np.asarray(x, dtype=float))
+                               for x in (t, V, I)])
+        with self._lock:
+            first = self.n_samples - len(self.tail)  # Sample index of data[0]
+            data  = np.concatenate((self.tail, new))
+            self.n_samples += len(new)
+
+            while (len(self.idx) + len(data)//self.bucket_size
+                   > 2*self.n_buckets):
+                self._merge_pairs()
+                self.bucket_size *= 2
+
+            n_full = len(data)//self.bucket_size
+            if n_full > 0:
+                blocks = data[:n_full*self.bucket_size].reshape(
+                                            n_full, self.bucket_size, 3)
+                self._add_buckets(blocks, first)
+            self.tail = data[n_full*self.bucket_size:]
+
+
+    def get_data(self):
+        '''
+        Returns [t, V, I] arrays of the kept samples in time order
+        '''
+        with self._lock:
+            idx  = self.idx
+            vals = self.vals
+            if len(self.tail) > 0:
+                first = self.n_samples - len(self.tail)
+                tail_idx, tail_vals = self._extremes(self.tail[None])
+                idx  = np.concatenate((idx, first + tail_idx))
+                vals = np.concatenate((vals, tail_vals))
+
+        idx  = idx.flatten()
+        vals = vals.reshape(-1, 3)
+        order = np.argsort(idx, kind='stable')
+        idx, vals = idx[order], vals[order]
+        keep = np.concatenate(([True], np.diff(idx) != 0))[:len(idx)]
+        vals = vals[keep]
+        return [vals[:,0], vals[:,1], vals[:,2]]
+
+
+    def _extremes(self, blocks):
+        # blocks: (n_blocks, block_length, 3). Returns local indices and
+        # values of the min/max V and I in each block
+        cols = blocks[:, :, self._channels]*self._signs  # (n, length, 4)
+        local = np.argmin(cols, axis=1)                  # (n, 4)
+        vals  = np.take_along_axis(blocks, local[:, :, None], axis=1)
+        return local, vals
+
+
+    def _add_buckets(self, blocks, first):
+        local, vals = self._extremes(blocks)
+        starts = first + np.arange(len(blocks))[:, None]*blocks.shape[1]
+        self.idx  = np.concatenate((self.idx, starts + local))
+        self.vals = np.concatenate((self.vals, vals))
+
+
+    def _merge_pairs(self):
+        # Merge buckets (0,1), (2,3), ... An odd last bucket is kept as is
+        m = 2*(len(self.idx)//2)
+        if m < 2:
+            return
+        idx  = self.idx[:m].reshape(-1, 2, 4)
+        vals = self.vals[:m].reshape(-1, 2, 4, 3)
+
+        cols = np.arange(4)
+        a = vals[:, 0, cols, self._channels]*self._signs
+        b = vals[:, 1, cols, self._channels]*self._signs
+        pick = (b < a).astype(int)[:, None, :]          # (n_pairs, 1, 4)
+
+        merged_idx  = np.take_along_axis(idx, pick, axis=1)[:, 0]
+        merged_vals = np.take_along_axis(vals, pick[..., None], axis=1)[:, 0]
+        self.idx  = np.concatenate((merged_idx, self.idx[m:]))
+        self.vals = np.concatenate((merged_vals, self.vals[m:]))
+
+
+
+
+class TracePyramid():
+    '''
+    Multi-resolution min/max/mean summary of a (t, V, I) trace.
+
+    Level 0 summarizes blocks of `base` samples. Each level above merges
+    pairs of blocks from the level below. Any time window can then be drawn
+    from the coarsest level which still gives about one block per pixel,
+    in O(n_pixels) no matter how long the trace is. Can be built at once
+    or appended to as data is acquired.
+
+    Rows of each level: t0, t1 (first and last sample time), Vmin, Vmax,
+    Vmean, Imin, Imax, Imean.
+    '''
+
+    columns = ('t0', 't1', 'Vmin', 'Vmax', 'Vmean', 'Imin', 'Imax', 'Imean')
+
+    def __init__(self, base=64):
+        self.base      = base
+        self.levels    = []   # Row arrays, allocated with spare capacity
+        self.counts    = []   # Number of valid rows in each level
+        self.tail      = np.zeros((0, 3)) # Samples not in a full block
+        self.n_samples = 0
+
+
+    def append(self, t, V, I):
+        '''
+        Add a block of samples. Accepts floats or array-likes
+        '''
+        new = np.column_stack([np.atleast_1d(np.asarray(x, dtype=float))
+                               for x in (t, V, I)])
+        data = np.concatenate((self.tail, new))
+        self.n_samples += len(new)
+
+        n_full = len(data)//self.base
+        if n_full > 0:
+            blocks = data[:n_full*self.base].reshape(n_full, self.base, 3)
+            self._append_rows(0, self._summarize(blocks))
+        self.tail = data[n_full*self.base:]
+
+        # Merge any new complete pairs up through the levels
+        level = 0
+        while level < len(self.levels):
+            merged = 2*self.counts[level+1] if level+1 < len(self.levels) else 0
+            rows   = self.get_level(level)[merged:]
+            n_pairs = len(rows)//2
+            if n_pairs == 0:
+                break
+            self._append_rows(level+1, self._merge(rows[:2*n_pairs]))
+            level += 1
+
+
+    def get_level(self, level):
+        return self.levels[level][:self.counts[level]]
+
+
+    def get_window(self, data, t_start=None, t_end=None, n_pixels=1000,
+                   stat='minmax'):
+        '''
+        Returns [t, V, I] arrays to draw the part of the trace between 
+        t_start and t_end, with about n_pixels points (or pairs of points).
+        
+        data: [t, V, I] raw data this pyramid was built from. Used when
+              the window is zoomed in far enough to show all samples.
+        stat: 'minmax' for the min/max envelope of each block (2 points per
+              block), or 'mean' for the block averages
+        
+        If data has index_of(time) and get_slice(i0, i1) methods (i.e. a
+        DataStorage.CompactTrace with implicit t), they are used instead of
+        data[0], so t is never built for the whole trace.
+        '''
+        i0 = 0 if t_start is None else self._sample_index(data, t_start)
+        i1 = (self.n_samples if t_end is None else 
+              self._sample_index(data, t_end) + 1)
+        i1 = min(i1, self.n_samples)
+
+        if i1 - i0 <= 2*n_pixels or len(self.levels) == 0:
+            if hasattr(data, 'get_slice'):
+                return [np.asarray(l, dtype=float) 
+                        for l in data.get_slice(i0, i1)]
+            return [np.asarray(l[i0:i1], dtype=float) for l in data]
+
+        # Coarsest level with at least n_pixels blocks in the window
+        level = 0
+        while (level + 1 < len(self.levels) and
+               (i1 - i0)/(self.base*2**(level+1)) >= n_pixels):
+            level += 1
+
+        rows = []
+        covered = i0 - i0 % (self.base*2**level)
+        for lvl in range(level, -1, -1):
+            # Lower levels fill in the end not covered by a full block above
+            size  = self.base*2**lvl
+            first = covered//size
+            last  = min(self.counts[lvl], -(-i1//size))
+            if last > first:
+                rows.append(self.get_level(lvl)[first:last])
+                covered = last*size
+        if covered < i1 and len(self.tail) > 0:
+            rows.append(self._summarize(self.tail[None]))
+        rows = np.concatenate(rows)
+
+        t = (rows[:,0] + rows[:,1])/2
+        if stat == 'mean':
+            return [t, rows[:,4], rows[:,7]]
+        return [np.repeat(t, 2),
+                rows[:,2:4].flatten(),
+                rows[:,5:7].flatten()]
+
+
+    def _sample_index(self, data, time):
+        # Index of the first sample at or after time. Locates the level 0
+        # block by its start time, then searches inside that block
+        if hasattr(data, 'index_of'):
+            return data.index_of(time)
+        t  = data[0]
+        lo = 0
+        if len(self.levels) > 0:
+            block = np.searchsorted(self.get_level(0)[:,0], time, 'right') - 1
+            lo = max(block, 0)*self.base
+        hi = min(lo + self.base, self.n_samples)
+        return lo + int(np.searchsorted(np.asarray(t[lo:hi], dtype=float), time))
+
+
+    def _append_rows(self, level, rows):
+        if level == len(self.levels):
+            self.levels.append(np.zeros((max(16, len(rows)), 8)))
+            self.counts.append(0)
+        n = self.counts[level]
+        if n + len(rows) > len(self.levels[level]):
+            grown = np.zeros((2*(n + len(rows)), 8))
+            grown[:n] = self.levels[level][:n]
+            self.levels[level] = grown
+        self.levels[level][n:n+len(rows)] = rows
+        self.counts[level] = n + len(rows)
+
+
+    @staticmethod
+    def _summarize(blocks):
+        # blocks: (n_blocks, block_length, 3) -> (n_blocks, 8) rows
+        V, I = blocks[:,:,1], blocks[:,:,2]
+        return np.column_stack((blocks[:,0,0], blocks[:,-1,0],
+                                V.min(1), V.max(1), V.mean(1),
+                                I.min(1), I.max(1), I.mean(1)))
+
+
+    @staticmethod
+    def _merge(rows):
+        # Merge rows (0,1), (2,3), ... of one level into the next level
+        a, b = rows[0::2], rows[1::2]
+        return np.column_stack((a[:,0], b[:,1],
+                                np.minimum(a[:,2], b[:,2]),
+                                np.maximum(a[:,3], b[:,3]),
+                                (a[:,4] + b[:,4])/2,
+                                np.minimum(a[:,5], b[:,5]),
+                                np.maximum(a[:,6], b[:,6]),
+                                (a[:,7] + b[:,7])/2))
+
+if __name__ == '__main__':
+    # Check min/max are preserved and time appending ADC-sized blocks
+    import time
+
+    rng = np.random.default_rng(0)
+    n_total, block = 3_600_000, 1000
+    t = np.arange(n_total)/1000
+    V = np.sin(t/50)
+    I = 1e-9*np.cos(t/7) + 1e-11*rng.standard_normal(n_total)
+    I[1234567] = 5e-9   # spike
+
+    dec = MinMaxDecimator(n_buckets=1500)
+    st = time.perf_counter()
+    for i in range(0, n_total, block):
+        dec.append(t[i:i+block], V[i:i+block], I[i:i+block])
+    append_time = time.perf_counter() - st
+
+    st = time.perf_counter()
+    td, Vd, Id = dec.get_data()
+    get_time = time.perf_counter() - st
+
+    print(f'{n_total} samples -> {len(td)} points')
+    print(f'append: {1e6*append_time/(n_total/block):0.1f} us/block, '
+          f'get_data: {1e3*get_time:0.2f} ms')
+    print(f'min/max I preserved: {Id.min() == I.min() and Id.max() == I.max()}')
+    print(f'min/max V preserved: {Vd.min() == V.min() and Vd.max() == V.max()}')
+    print(f'time ordered: {np.all(np.diff(td) > 0)}')
+
+    # Build a pyramid from the same blocks and query zoom windows
+    pyr = TracePyramid()
+    st = time.perf_counter()
+    for i in range(0, n_total, block):
+        pyr.append(t[i:i+block], V[i:i+block], I[i:i+block])
+    append_time = time.perf_counter() - st
+    print(f'\npyramid: {len(pyr.levels)} levels, '
+          f'append: {1e6*append_time/(n_total/block):0.1f} us/block')
+
+    data = [t, V, I]
+    for t_start, t_end in [(None, None), (1000, 2000), (1234, 1235), 
+                           (3599.9, 3600)]:
+        st = time.perf_counter()
+        tw, Vw, Iw = pyr.get_window(data, t_start, t_end, n_pixels=1500)
+        dt = time.perf_counter() - st
+        lo = 0 if t_start is None else np.searchsorted(t, t_start)
+        hi = n_total if t_end is None else np.searchsorted(t, t_end, 'right')
+        ok = (Iw.max() >= I[lo:hi].max()) and (Iw.min() <= I[lo:hi].min())
+        print(f'window {t_start}-{t_end} s: {len(tw)} points in '
+              f'{1e3*dt:0.2f} ms, envelope covers data: {ok}')
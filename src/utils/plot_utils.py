@@ -0,0 +1,121 @@
+'''
+Plotting helpers without a GUI dependency, shared by Plotter and the
+headless BatchExporter.
+'''
+import numpy as np
+
+
+# Heatmap display options -> Experiment.get_heatmap_data() datatypes
+heatmap_datatypes = {'Max. current': 'max',
+                     'Current @ ... (V)': 'val_at',
+                     'Current @ ... (t)': 'val_at_t',
+                     'Z height': 'z',
+                     'Avg. current': 'avg',
+                     '|Z| @ ... (Hz)': 'Z_at'}
+
+def get_plotlim(xdata, ydata):
+    if len(xdata) == 0 or len(xdata) == 1:
+        return ((0,0.1), (0,0.1))
+    lim = (
+     (min(xdata) - 0.05*abs(min(xdata)),
+      max(xdata) + 0.05*abs(max(xdata))
+      ),
+     (min(ydata) - 0.05*abs(min(ydata)),
+      max(ydata) + 0.05*abs(max(ydata))
+      )
+     )
+    return lim
+
+
+def get_clim(arr):
+    # Return minimum and maximum values of array 
+    # (plus some padding) which will be used to define
+    # min and max values on the heatmap color scale.
+    arr = [val for val in np.array(arr).flatten()
+           if val != 0]
+    if len(arr) == 0:
+        return -1, 1
+    avg = np.average(arr)
+    std = np.std(arr)
+    
+    if abs(std/avg) < 0.1:
+        std = 0.1*abs(avg)
+    
+    minval = avg - 2*std
+    maxval = avg + 2*std
+    
+    return minval, maxval
+
+
+def set_cbar_ticklabels(cbar, clim, n_ticks=5):
+    # m0=int(np.floor(arr.min()))            # colorbar min value
+    # m1=int(np.ceil(arr.max()))             # colorbar max value
+    m0 = min(clim)
+    m1 = max(clim)
+    ticks = np.linspace(m0, m1, n_ticks)
+    cbar.set_ticks(ticks)
+    cbar.set_ticklabels([unit_label(t) for t in ticks])
+
+
+def unit_label(d:float,dec=0):
+    '''
+    Returns value as string with SI unit prefix
+    
+    e.g. unit_label(1e-9) --> '1 n'
+         unit_label(7.7e-10): --> '770 p'
+    '''
+    inc_prefixes = ['k', 'M', 'G', 'T', 'P', 'E']
+    dec_prefixes = ['m', 'µ', 'n', 'p', 'f', 'a']
+
+    if d == 0:
+        return f'0.0'
+
+    degree = int(np.floor(np.log10(np.fabs(d)) / 3))
+
+    prefix = ''
+
+    if abs(degree) > 1:
+        sign = degree / np.fabs(degree)
+        if sign == 1:
+            if degree - 1 < len(inc_prefixes):
+                prefix = inc_prefixes[degree - 1]
+            else:
+                prefix = inc_prefixes[-1]
+                degree = len(inc_prefixes)
+
+        elif sign == -1:
+            if -degree - 1 < len(dec_prefixes):
+                prefix = dec_prefixes[-degree - 1]
+            else:
+                prefix = dec_prefixes[-1]
+                degree = -len(dec_prefixes)
+
+        scaled = float(d * pow(1000, -degree))
+
+        s = f"{scaled:0.{dec}f}".rjust(4, ' ') + f" {prefix}"
+
+    else:
+        s = f"{d:0.2f}".rjust(4, ' ')
+    return s
+
+
+def inv_unit_label(s:str):
+    '''
+    Return string as float
+    '''
+    if type(s) != str:
+        return s
+    prefixes = {'k':1e3, 
+                'M':1e6, 
+                'G':1e9, 
+                'm':1e-3, 
+                'u':1e-6, 
+                'n':1e-9, 
+                'p':1e-12, 
+                'f':1e-15}
+    
+    if not s[-1] in prefixes:
+        return float(s)
+    
+    val = float(s[:-1])*prefixes[s[-1]]
+    return val
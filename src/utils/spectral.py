@@ -0,0 +1,207 @@
+'''
+Fourier transform helpers for FFT-EIS.
+
+Applied frequencies are integer multiples of the lowest frequency f0, and
+recordings are a whole number of f0 cycles long. So every applied
+frequency falls exactly on an rFFT bin, which can be computed directly
+instead of searched for, and only those bins have to be transformed.
+'''
+from collections import deque
+import numpy as np
+
+
+def bin_indices(freqs, n, srate):
+    '''
+    Returns rFFT bin index nearest to each frequency in freqs, for a record
+    of n points sampled at srate. Bin 0 (DC) is never returned.
+    '''
+    idxs = np.rint(np.asarray(freqs, dtype=float)*n/srate).astype(int)
+    return np.clip(idxs, 1, n//2)
+
+
+def nearest_sorted(arr, vals):
+    '''
+    Returns index of the nearest element of ascending array arr to each of
+    vals. Same as nearest() for every val, without an O(len(arr)) search
+    per value.
+    '''
+    arr  = np.asarray(arr)
+    vals = np.asarray(vals)
+    idxs = np.clip(np.searchsorted(arr, vals), 1, len(arr) - 1)
+    # Pick the left neighbor when it is as close or closer
+    left = (vals - arr[idxs-1]) <= (arr[idxs] - vals)
+    idxs = idxs - left
+    if len(arr) == 1:
+        idxs = np.zeros_like(idxs)
+    return idxs
+
+
+def rfft_bins(x, bins):
+    '''
+    Returns np.fft.rfft(x)[..., bins], transforming along the last axis.
+
+    If every bin is a multiple of g and g divides the record length, the
+    record is g repeats of the lowest frequency's period. Summing the g
+    segments first leaves a record g times shorter, whose bins k/g are
+    exactly bins k of the full record.
+    '''
+    x    = np.asarray(x)
+    bins = np.asarray(bins, dtype=int)
+    n    = x.shape[-1]
+    g    = int(np.gcd.reduce(np.append(bins, n)))
+    if g > 1:
+        x    = x.reshape(*x.shape[:-1], g, n//g).sum(axis=-2)
+        bins = bins//g
+    return np.fft.rfft(x)[..., bins]
+
+
+
+
+class StreamingImpedance():
+    '''
+    Impedance at each applied frequency, estimated while a multisine is 
+    still being recorded (i.e. from ADC.pollingdata during an EIS 
+    measurement).
+    
+    Each sample is added to running DFT sums of V and I at every frequency
+    (X(f) += x(t)*exp(-2 pi i f t), which works with the ADC's unevenly 
+    spaced timestamps). When a period of the lowest frequency f0 is 
+    complete, its sums are added to the estimate, so Z = sum V / sum I is
+    exact for every applied frequency (all are multiples of f0). With 
+    window = n, only the last n periods are used.
+    
+    freqs: applied frequencies (Hz)
+    '''
+    def __init__(self, freqs, window=None):
+        self.freqs   = np.asarray(freqs, dtype=float)
+        self.f0      = self.freqs.min()
+        self.periods = deque(maxlen=window)  # (sum_V, sum_I, n) per period
+        
+        self.t_start = None
+        self.period  = 0     # Index of the period being recorded
+        self.sum_V   = np.zeros(len(self.freqs), dtype=complex)
+        self.sum_I   = np.zeros(len(self.freqs), dtype=complex)
+        self.count   = 0
+        
+        # Totals over self.periods
+        self.total_V = np.zeros(len(self.freqs), dtype=complex)
+        self.total_I = np.zeros(len(self.freqs), dtype=complex)
+        self.total_n = 0
+    
+    
+    @property
+    def n_periods(self):
+        return len(self.periods)
+    
+    
+    def append(self, t, V, I):
+        '''
+        Add a block of samples. Accepts floats or array-likes
+        '''
+        t, V, I = (np.atleast_1d(np.asarray(x, dtype=float)) 
+                   for x in (t, V, I))
+        n = min(len(t), len(V), len(I))
+        if n == 0:
+            return
+        if self.t_start is None:
+            self.t_start = t[0]
+        
+        # Split block at period boundaries
+        k = np.floor((t[:n] - self.t_start)*self.f0).astype(int)
+        periods, starts = np.unique(k, return_index=True)
+        ends = np.append(starts[1:], n)
+        for period, a, b in zip(periods, starts, ends):
+            if period != self.period:
+                self._end_period()
+                self.period = period
+            phasors = np.exp(-2j*np.pi*np.outer(t[a:b], self.freqs))
+            self.sum_V += V[a:b] @ phasors
+            self.sum_I += I[a:b] @ phasors
+            self.count += b - a
+    
+    
+    def _end_period(self):
+        if self.count > 0:
+            if len(self.periods) == self.periods.maxlen:
+                # Slide the window
+                old_V, old_I, old_n = self.periods[0]
+                self.total_V -= old_V
+                self.total_I -= old_I
+                self.total_n -= old_n
+            self.periods.append((self.sum_V, self.sum_I, self.count))
+            self.total_V = self.total_V + self.sum_V
+            self.total_I = self.total_I + self.sum_I
+            self.total_n += self.count
+        self.sum_V = np.zeros(len(self.freqs), dtype=complex)
+        self.sum_I = np.zeros(len(self.freqs), dtype=complex)
+        self.count = 0
+    
+    
+    def get_Z(self):
+        '''
+        Returns (freqs, Z) from the completed periods, or None if there 
+        are none yet. Frequencies above the Nyquist frequency of the 
+        recorded data are left out.
+        '''
+        if self.n_periods == 0:
+            return None
+        srate = self.total_n*self.f0/self.n_periods
+        valid = self.freqs < srate/2
+        return self.freqs[valid], self.total_V[valid]/self.total_I[valid]
+
+
+
+if __name__ == '__main__':
+    # Compare with a full rFFT for a typical multisine recording
+    import time
+
+    srate, f0, n_cycles = 100000, 1, 10
+    n = int(srate/f0*n_cycles)
+    f = f0*np.array([1, 2, 3, 5, 7, 11, 17, 23, 37, 59, 97, 151, 233, 379,
+                     613, 991, 1597, 2591, 4201, 6791])
+    t = np.arange(n)/srate
+    rng = np.random.default_rng(0)
+    V = np.sum([np.sin(2*np.pi*fi*t + p)
+                for fi, p in zip(f, rng.uniform(0, 2*np.pi, len(f)))], axis=0)
+    I = np.roll(V, 3) + 0.01*rng.standard_normal(n)
+    x = np.array([V, I])
+
+    st = time.perf_counter()
+    for _ in range(10):
+        full = np.fft.rfft(x)[:, 1:]
+        freqs = srate*np.fft.rfftfreq(n)[1:]
+        idxs = [np.abs(freqs - fi).argmin() for fi in f]
+        full = full[:, idxs]
+    full_time = (time.perf_counter() - st)/10
+
+    st = time.perf_counter()
+    for _ in range(10):
+        part = rfft_bins(x, bin_indices(f, n, srate))
+    part_time = (time.perf_counter() - st)/10
+
+    print(f'{n} points, {len(f)} frequencies')
+    print(f'full rfft + search: {1e3*full_time:0.2f} ms, '
+          f'rfft_bins: {1e3*part_time:0.2f} ms')
+    print(f'same result: {np.allclose(full, part)}')
+
+    # Stream ADC-sized blocks at a low, uneven sample rate
+    srate = 2000
+    t = np.sort(rng.uniform(0, n_cycles/f0, n_cycles*srate))
+    V = np.sum([np.sin(2*np.pi*fi*t + p) for fi, p in zip(f[:8], 
+                rng.uniform(0, 2*np.pi, 8))], axis=0)
+    I = V/1000
+    stream = StreamingImpedance(f[:8])
+    st = time.perf_counter()
+    for i in range(0, len(t), 100):
+        stream.append(t[i:i+100], V[i:i+100], I[i:i+100])
+    stream_time = time.perf_counter() - st
+    freqs, Z = stream.get_Z()
+    print(f'\nstreaming: {stream.n_periods} periods, '
+          f'{1e6*stream_time/(len(t)/100):0.1f} us/block, '
+          f'max |Z - 1000|: {np.abs(Z - 1000).max():0.2e}')
+
+    arr  = np.sort(rng.uniform(0, 100, 1000))
+    vals = rng.uniform(-10, 110, 500)
+    print('nearest_sorted matches argmin:',
+          np.array_equal(nearest_sorted(arr, vals),
+                         [np.abs(arr - v).argmin() for v in vals]))
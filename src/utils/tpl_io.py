@@ -0,0 +1,124 @@
+'''
+Reading and writing PATCHMASTER .tpl (stimulus template) files.
+
+A .tpl file is just the waveform as little-endian 32 bit floats, with no
+header. Next to each waveform we write, a <fname>.json sidecar records how
+it was made (frequencies, amplitudes, phases, sample rate, ...) so an
+identical waveform doesn't have to be generated and written again.
+'''
+import json
+import os
+import numpy as np
+
+
+TPL_DTYPE = np.dtype('<f4')
+
+
+
+def meta_path(fname):
+    return fname + '.json'
+
+
+def write_tpl(fname, voltages, meta=None):
+    '''
+    voltages: array-like of time-domain voltages
+    meta: (optional) dict of json-serializable waveform parameters to
+          save in the sidecar file
+    '''
+    voltages = np.asarray(voltages)
+
+    # Remove the old sidecar first, so it never describes the new waveform
+    # if writing fails halfway
+    if os.path.exists(meta_path(fname)):
+        os.remove(meta_path(fname))
+
+    with open(fname + '.tmp', 'wb') as f:
+        voltages.astype(TPL_DTYPE, copy=False).tofile(f)
+    os.replace(fname + '.tmp', fname)
+
+    if meta is not None:
+        meta = dict(meta, n_points=len(voltages))
+        with open(meta_path(fname), 'w') as f:
+            json.dump(_to_json(meta), f)
+
+
+def read_tpl(fname, mmap=False):
+    '''
+    Returns the waveform as a float32 array. With mmap=True, the array is a
+    read-only view of the file instead of a copy in memory.
+    '''
+    if mmap:
+        return np.memmap(fname, dtype=TPL_DTYPE, mode='r')
+    return np.fromfile(fname, dtype=TPL_DTYPE)
+
+
+def read_meta(fname):
+    '''
+    Returns dict from the sidecar file, or None if there isn't one
+    '''
+    try:
+        with open(meta_path(fname), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(fname, params):
+    '''
+    True if fname exists, is complete, and its sidecar matches every key
+    in params
+    '''
+    meta = read_meta(fname)
+    if meta is None or not os.path.exists(fname):
+        return False
+    if os.path.getsize(fname) != meta.get('n_points', -1)*TPL_DTYPE.itemsize:
+        return False
+    params = _to_json(params)
+    return all(meta.get(key) == val for key, val in params.items())
+
+
+def _to_json(d):
+    # Round trip through json so numpy values compare equal to loaded ones
+    return json.loads(json.dumps(d, default=lambda x: np.asarray(x).tolist()))
+
+
+
+if __name__ == '__main__':
+    # Compare with the old struct-based writer and reader
+    import struct
+    import tempfile
+    import time
+
+    v = np.random.default_rng(0).standard_normal(4000000)
+    fname = os.path.join(tempfile.mkdtemp(), 'test.tpl')
+
+    st = time.perf_counter()
+    with open(fname, 'wb') as f:
+        f.write(struct.pack('f'*len(v), *v))
+    old_write = time.perf_counter() - st
+
+    st = time.perf_counter()
+    unpack = struct.Struct('f').unpack_from
+    buff = []
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(4)
+            if not data:
+                break
+            buff.append(*unpack(data))
+    old_read = time.perf_counter() - st
+
+    st = time.perf_counter()
+    write_tpl(fname, v, meta={'freqs': np.arange(1., 5.)})
+    new_write = time.perf_counter() - st
+
+    st = time.perf_counter()
+    arr = read_tpl(fname)
+    new_read = time.perf_counter() - st
+
+    print(f'{len(v)} points')
+    print(f'write: struct {old_write:0.2f} s, tofile {1e3*new_write:0.1f} ms')
+    print(f'read:  struct {old_read:0.2f} s, fromfile {1e3*new_read:0.1f} ms')
+    print('same data:', np.array_equal(arr, np.array(buff, dtype=np.float32)))
+    print('is_current:', is_current(fname, {'freqs': [1., 2., 3., 4.]}),
+          is_current(fname, {'freqs': [1., 2., 3.]}))
@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+import pytest
+
+from src.utils.EIS_corrections import CorrectionStore, settings_key
+from src.utils.EIS_util import get_EIS_sample_rate
+
+
+def get_key(freqs):
+    # Same derivation as HekaIO.EIS_settings_key, without the filters
+    return settings_key(5, [], get_EIS_sample_rate(max(freqs)))
+
+
+def test_imported_corrections_are_found_by_applied_freqs(tmp_path):
+    # f1 = 2600 Hz, but the highest applied frequency is below the
+    # 2500 Hz sample rate step
+    applied = [100, 200, 500, 1000, 2400]
+    Z_corr  = [1.0, 1.01, 1.02, 1.05, 1.1]
+    phase   = [0.0, -1.0, -2.0, -4.0, -8.0]
+    old = tmp_path / 'EIS_waveforms.json'
+    old.write_text(json.dumps(
+        {str((10, 5, *applied)): list(zip(applied, Z_corr, phase))}))
+
+    store = CorrectionStore(str(tmp_path / 'corrections.npz'))
+    store.import_json(str(old), get_key)
+    corrections = store.get(get_key(applied), applied)
+    assert corrections is not None
+    f, Z, p = map(np.array, zip(*corrections))
+    assert Z == pytest.approx(Z_corr)
+    assert p == pytest.approx(phase)
+
+    # And the curve survives a reload from disk
+    store = CorrectionStore(str(tmp_path / 'corrections.npz'))
+    assert store.get(get_key(applied), [150, 2000]) is not None
@@ -0,0 +1,34 @@
+import numpy as np
+
+from src.utils.EIS_util import WaveformCache, plan_frequencies
+
+
+def test_planned_frequencies_fill_every_decade():
+    freqs = plan_frequencies(10, 10000, 50)
+    assert len(freqs) == 50
+    assert len(set(freqs)) == 50
+    assert np.allclose(freqs/10, np.rint(freqs/10))
+    assert not np.any(np.isclose(freqs % 60, 0))
+    # 10 - 90 Hz only has 8 multiples of f0 that aren't mains harmonics
+    per_decade = np.histogram(freqs, bins=[10, 100, 1000, 10001])[0]
+    assert per_decade[0] == 8
+    assert np.all(per_decade[1:] >= 15)
+
+
+def test_planned_frequencies_avoid_intermodulation_where_there_is_room():
+    freqs  = plan_frequencies(1, 100000, 40)
+    h      = np.rint(freqs[freqs >= 1000]).astype(int)
+    sums   = (h[:, None] + h[None, :])[np.triu_indices(len(h), k=1)]
+    diffs  = np.abs(h[:, None] - h[None, :])[np.triu_indices(len(h), k=1)]
+    assert not np.isin(2*h, h).any()
+    assert not np.isin(sums, h).any()
+    assert not np.isin(diffs, h).any()
+
+
+def test_cache_key_ignores_number_types(tmp_path):
+    cache = WaveformCache(str(tmp_path))
+    path  = cache.get_path(1.0, 1000.0, 20, 2, 10.0)
+    assert cache.get_path(1, 1000, 20, 2, 10) == path
+    assert cache.get_path(1, 1000, 20.0, 2.0, 10) == path
+    assert cache.get_path(1, 1000, 20, 2, 20) != path
+    assert cache.get_path(1, 1000, 20, 3, 10) != path
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from src.modules.DataStorage import CVDataPoint, Experiment
+
+
+SCRIPT = '''
+import sys
+from src.modules.BatchExporter import BatchExporter
+n = BatchExporter(['max', 'val_at:0.5'], ['I vs V'], dpi=20, echem_dpi=20,
+                  n_workers=2).export_folder(sys.argv[1])
+assert 'src.modules.Plotter' not in sys.modules
+print(n)
+'''
+
+
+def make_expt():
+    expt = Experiment()
+    t    = np.linspace(0, 1, 50)
+    for (i, j), _ in np.ndenumerate(expt.data):
+        expt.data[i][j] = CVDataPoint((i, j, 0), [t.tolist(),
+                                                  np.sin(t + i).tolist(),
+                                                  np.cos(t + j).tolist()])
+    return expt
+
+
+def test_exports_without_a_display(tmp_path):
+    make_expt().save(str(tmp_path / 'expt'))
+    env = {k: v for k, v in os.environ.items() if k != 'DISPLAY'}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', SCRIPT, str(tmp_path)],
+                         cwd=root, env=env, capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    heatmaps = os.listdir(tmp_path / 'export')
+    assert len([f for f in heatmaps if f.endswith('.png')]) == 2
+    assert int(out.stdout.split()[-1]) > 2
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from src.analysis.circuit_fitting import (fit_datapoints, fit_map,
+                                          get_models, model_Z)
+from src.modules.DataStorage import EISDataPoint
+
+
+FREQS = np.logspace(0, 5, 30)
+
+
+def make_point(Z, loc=(0, 0, 0)):
+    pt = EISDataPoint(loc, None, FREQS, transform=False)
+    pt.set_spectrum(FREQS, np.asarray(Z), np.ones(len(FREQS)))
+    return pt
+
+
+@pytest.mark.parametrize('model, true', [
+    ('Randles', {'Rs': 100, 'Rct': 5e3, 'Cdl': 2e-7}),
+    ('CPE',     {'Rs': 50, 'Rct': 2e4, 'Q': 1e-7, 'phi': 0.85}),
+    ])
+def test_fit_map_recovers_parameters(model, true):
+    rng  = np.random.default_rng(0)
+    _, names, _ = get_models()[model]
+    Z    = model_Z(model, true, FREQS)
+    Zs   = np.array([Z*(1 + 0.005*rng.standard_normal(len(FREQS)))
+                     for _ in range(9)])
+    locs = [(i, j) for i in range(3) for j in range(3)]
+    params, error = fit_map(model, FREQS, Zs, locs)
+    for k, name in enumerate(names):
+        assert np.allclose(params[:, k], true[name], rtol=0.05)
+    assert np.all(error < 0.02)
+
+
+def test_fits_are_redone_when_the_spectrum_changes():
+    true = {'Rs': 100, 'Rct': 1e3, 'Cdl': 1e-6}
+    Z  = model_Z('Randles', true, FREQS)
+    pt = make_point(Z)
+    fit = fit_datapoints([pt])[0].features['circuit_fits']['Randles']
+    assert fit['Rct'] == pytest.approx(1e3, rel=1e-6)
+
+    pt.set_spectrum(FREQS, 2*Z, np.ones(len(FREQS)))
+    fit = fit_datapoints([pt])[0].features['circuit_fits']['Randles']
+    assert fit['Rct'] == pytest.approx(2e3, rel=1e-6)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from src.analysis.drt import (data_resistances, drt_datapoints, drt_Z,
+                              find_peaks, invert_spectra)
+from src.modules.DataStorage import EISDataPoint
+
+
+FREQS = np.logspace(0, 5, 40)
+
+
+def RC(Rs, Rct, tau, freqs=FREQS):
+    return Rs + Rct/(1 + 2j*np.pi*np.asarray(freqs)*tau)
+
+
+def test_peak_time_constant_is_recovered():
+    tau  = np.array([1e-4, 1e-3, 1e-2])
+    Z    = np.array([RC(100, 1e4, t) for t in tau])
+    taus, _, gamma = invert_spectra(FREQS, Z)
+    peak_tau, height = find_peaks(taus, gamma)
+    assert np.all(np.abs(np.log10(peak_tau/tau)) < 0.05)
+    assert np.all(height > 0)
+
+
+def test_resistances_are_read_from_the_spectrum():
+    Z = RC(100, 1e4, 1e-3)
+    R_inf, R_pol = data_resistances(FREQS, Z)
+    assert R_inf[0] == pytest.approx(100, rel=1e-2)
+    assert R_pol[0] == pytest.approx(1e4, rel=1e-2)
+
+
+def test_drt_reproduces_the_spectrum():
+    Z  = RC(100, 1e4, 1e-3)
+    pt = EISDataPoint((0, 0, 0), None, FREQS, transform=False)
+    pt.set_spectrum(FREQS, Z, np.ones(len(FREQS)))
+    drt = drt_datapoints([pt])[0].features['drt']
+    drt = next(iter(drt.values()))
+    assert np.abs(drt_Z(drt, FREQS) - Z).max() < 0.01*np.abs(Z).max()
+
+
+def test_drt_is_redone_when_the_spectrum_changes():
+    pt = EISDataPoint((0, 0, 0), None, FREQS, transform=False)
+    pt.set_spectrum(FREQS, RC(100, 1e4, 1e-3), np.ones(len(FREQS)))
+    lam, drt = next(iter(drt_datapoints([pt])[0].features['drt'].items()))
+    assert drt['tau'] == pytest.approx(1e-3, rel=0.15)
+
+    pt.set_spectrum(FREQS, RC(100, 1e4, 1e-2), np.ones(len(FREQS)))
+    drt = drt_datapoints([pt], lam)[0].features['drt'][lam]
+    assert drt['tau'] == pytest.approx(1e-2, rel=0.15)
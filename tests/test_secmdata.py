@@ -0,0 +1,139 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from src.modules.DataStorage import (ADCDataPoint, CVDataPoint, Experiment,
+                                     PointsList, SECMDATA_MAGIC, 
+                                     SECMDATA_VERSION, iter_datapoints,
+                                     load_from_file, read_trace, 
+                                     read_trace_table)
+
+
+def make_expt(file_version=1):
+    expt = Experiment()
+    expt.file_version = file_version
+    rng  = np.random.default_rng(0)
+    t    = np.linspace(0, 1, 50)
+    for (i, j), _ in np.ndenumerate(expt.data):
+        V  = np.sin(t + i)
+        I  = rng.standard_normal(50)
+        pt = CVDataPoint((i, j, 0), [t.tolist(), V.tolist(), I.tolist()])
+        if (i, j) == (0, 0):
+            adc = ADCDataPoint((i, j, 0), [[0.0, 0.1], [1.0, 2.0], [3.0, 4.0]])
+            pt  = PointsList((i, j, 0), [pt, adc])
+        expt.data[i][j] = pt
+    return expt
+
+
+def assert_same_data(a, b):
+    pts_a, pts_b = dict(iter_datapoints(a)), dict(iter_datapoints(b))
+    assert pts_a.keys() == pts_b.keys()
+    for key, pt in pts_a.items():
+        assert str(pt) == str(pts_b[key])
+        assert pt.loc == pts_b[key].loc
+        if isinstance(pt.data, list):
+            for row_a, row_b in zip(pt.data, pts_b[key].data):
+                assert np.array_equal(np.asarray(row_a), np.asarray(row_b))
+        else:
+            assert pt.data == pts_b[key].data
+
+
+def test_version_1_is_default_and_a_plain_pickle(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt()
+    expt.save(path)
+    with open(path, 'rb') as f:
+        assert f.read(len(SECMDATA_MAGIC)) != SECMDATA_MAGIC
+        f.seek(0)
+        assert_same_data(expt, pickle.load(f))
+    assert_same_data(expt, load_from_file(path))
+
+
+def test_version_2_round_trip(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    with open(path, 'rb') as f:
+        assert f.read(len(SECMDATA_MAGIC)) == SECMDATA_MAGIC
+        assert int.from_bytes(f.read(4), 'little') == SECMDATA_VERSION
+    assert_same_data(expt, load_from_file(path))
+
+
+def test_version_2_single_trace_from_offsets(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    with open(path, 'rb') as f:
+        table, _, data_start = read_trace_table(f)
+        t, V, I = read_trace(f, table, data_start, (3, 4, 0))
+    assert np.array_equal(I, expt.data[3][4].data[2])
+
+
+def test_convert_between_versions(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    loaded = load_from_file(path)
+    loaded.file_version = 1
+    loaded.save(path)
+    with open(path, 'rb') as f:
+        assert read_trace_table(f)[0] is None
+    assert_same_data(expt, load_from_file(path))
+
+
+def test_newer_version_is_refused(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    make_expt(file_version=2).save(path)
+    with open(path, 'r+b') as f:
+        f.seek(len(SECMDATA_MAGIC))
+        f.write((SECMDATA_VERSION + 1).to_bytes(4, 'little'))
+    with pytest.raises(ValueError):
+        load_from_file(path)
+
+
+def test_appending_to_loaded_ADC_data(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    make_expt(file_version=2).save(path)
+    adc = load_from_file(path).data[0][0].data[1]
+    adc.append_data([0.2], [5.0], [6.0])
+    assert list(adc.data[1]) == [1.0, 2.0, 5.0]
+
+
+def test_lazy_load_reads_traces_on_demand(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    lazy = load_from_file(path, lazy=True)
+    pt   = lazy.data[3][4]
+    assert not hasattr(pt, '_data')
+    assert pt.get_val('max') == pytest.approx(max(expt.data[3][4].data[2]))
+    assert not hasattr(pt, '_data')
+    assert_same_data(expt, lazy)
+
+
+@pytest.mark.parametrize('file_version', [1, 2])
+def test_save_lazy_experiment_over_its_file(tmp_path, file_version):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    lazy = load_from_file(path, lazy=True)
+    lazy.file_version = file_version
+    lazy.save(path)
+    assert_same_data(expt, lazy)
+    assert_same_data(expt, load_from_file(path))
+
+
+def test_memory_mapped_traces_give_the_same_results(tmp_path):
+    path = str(tmp_path/'expt.secmdata')
+    expt = make_expt(file_version=2)
+    expt.save(path)
+    expected = expt.get_heatmap_data('val_at', 0.5)
+    
+    mapped = load_from_file(path, mmap=True)
+    assert mapped.get_arena().path == path
+    assert_same_data(expt, mapped)
+    assert np.allclose(mapped.get_heatmap_data('val_at', 0.5), expected)
+    
+    assert expt.get_arena().path is None
+    assert np.allclose(expt.get_heatmap_data('val_at', 0.5), expected)